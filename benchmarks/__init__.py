@@ -0,0 +1,16 @@
+# Copyright (c) Hynek Schlawack, Richard Wall
+# See LICENSE for details.
+
+"""
+Throughput and latency benchmarks for danex.
+
+Run them from the root of the checkout::
+
+    python -m benchmarks --output before.json
+    python -m benchmarks --output after.json --compare before.json
+
+End-to-end benchmarks talk to a stand-in DNS server and a TLS server on the
+loopback interface that run in the same process, so they measure the
+pipeline and not the network.  L{benchmarks.loadtest} drives the CLI batch
+path or the dane_doctor API at many targets, equally offline.
+"""
@@ -0,0 +1,120 @@
+# Copyright (c) Hynek Schlawack, Richard Wall
+# See LICENSE for details.
+
+from __future__ import absolute_import, division, print_function
+
+import json
+import platform
+import subprocess
+import sys
+import time
+
+from twisted.internet import defer, task
+from twisted.python import usage
+
+from . import endtoend, micro, startup
+from ._harness import compare, formatResult
+
+
+SUITES = ("startup", "micro", "endtoend")
+
+
+class Options(usage.Options):
+    synopsis = "Usage: python -m benchmarks [options]"
+
+    optParameters = [
+        ["output", "o", None, "Write the results as JSON to FILE."],
+        ["compare", None, None,
+         "Show the change in throughput relative to the JSON results in "
+         "FILE."],
+        ["concurrency", "c", "1,10,50",
+         "Comma-separated concurrency levels of the end-to-end benchmarks."],
+        ["operations", "n", 500,
+         "Operations per end-to-end benchmark and concurrency level.", int],
+        ["iterations", "i", 10000,
+         "Iterations per micro benchmark.", int],
+        ["startups", None, 20,
+         "Interpreter starts per startup benchmark.", int],
+        ["only", None, None,
+         "Run only one suite: " + ", ".join(SUITES) + "."],
+    ]
+
+    def postOptions(self):
+        try:
+            self["concurrency"] = [
+                int(c) for c in self["concurrency"].split(",")
+            ]
+        except ValueError:
+            raise usage.UsageError("--concurrency must be a list of numbers.")
+        if min(self["concurrency"]) < 1:
+            raise usage.UsageError("Concurrency levels must be at least 1.")
+        if self["only"] not in (None,) + SUITES:
+            raise usage.UsageError(
+                "Unknown suite {0!r}.".format(self["only"])
+            )
+
+
+def _revision():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], stderr=subprocess.STDOUT,
+        ).decode("ascii").strip()
+    except (EnvironmentError, subprocess.CalledProcessError):
+        return None
+
+
+def _report(results):
+    for result in results:
+        print(formatResult(result))
+        sys.stdout.flush()
+
+
+@defer.inlineCallbacks
+def _main(reactor, options):
+    results = []
+    if options["only"] in (None, "startup"):
+        startups = startup.run(options["startups"])
+        _report(startups)
+        results.extend(startups)
+    if options["only"] in (None, "micro"):
+        micros = micro.run(options["iterations"])
+        _report(micros)
+        results.extend(micros)
+    if options["only"] in (None, "endtoend"):
+        endToEnd = yield endtoend.run(
+            reactor, options["concurrency"], options["operations"]
+        )
+        _report(endToEnd)
+        results.extend(endToEnd)
+
+    report = {
+        "revision": _revision(),
+        "python": platform.python_version(),
+        "timestamp": time.time(),
+        "results": results,
+    }
+    if options["output"] is not None:
+        with open(options["output"], "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    if options["compare"] is not None:
+        with open(options["compare"]) as f:
+            old = json.load(f)
+        print()
+        print("Compared to {0}:".format(old.get("revision") or "baseline"))
+        for line in compare(old, report):
+            print(line)
+
+
+def main():
+    options = Options()
+    try:
+        options.parseOptions()
+    except usage.UsageError as e:
+        print("{0}: {1}".format(sys.argv[0], e))
+        print(options)
+        sys.exit(1)
+    task.react(_main, (options,))
+
+
+if __name__ == "__main__":
+    main()
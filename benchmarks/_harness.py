@@ -0,0 +1,153 @@
+# Copyright (c) Hynek Schlawack, Richard Wall
+# See LICENSE for details.
+
+"""
+Timing and reporting.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+from timeit import default_timer
+
+from twisted.internet import defer, task
+
+
+def percentile(sortedValues, fraction):
+    """
+    Return the value below which I{fraction} of I{sortedValues} lie, using
+    the nearest rank.
+    """
+    if not sortedValues:
+        return None
+    rank = int(round(fraction * (len(sortedValues) - 1)))
+    return sortedValues[rank]
+
+
+def summarize(name, latencies, elapsed, concurrency=1, errors=0):
+    """
+    Condense a benchmark run into a JSON-compatible dict.
+
+    @param latencies: Seconds each successful operation took.
+    @param elapsed: Seconds the whole run took.
+    """
+    latencies = sorted(latencies)
+    count = len(latencies)
+    return {
+        "name": name,
+        "concurrency": concurrency,
+        "operations": count,
+        "errors": errors,
+        "elapsed": elapsed,
+        "opsPerSec": count / elapsed if elapsed else None,
+        "latency": {
+            "mean": sum(latencies) / count if count else None,
+            "p50": percentile(latencies, 0.5),
+            "p90": percentile(latencies, 0.9),
+            "p99": percentile(latencies, 0.99),
+            "max": latencies[-1] if latencies else None,
+        },
+    }
+
+
+def runSync(name, operation, iterations):
+    """
+    Call I{operation} I{iterations} times in a row, timing each call.
+    """
+    latencies = []
+    append = latencies.append
+    start = default_timer()
+    for _ in range(iterations):
+        callStart = default_timer()
+        operation()
+        append(default_timer() - callStart)
+    return summarize(name, latencies, default_timer() - start)
+
+
+def runConcurrent(name, operation, operations, concurrency,
+                  cooperator=task):
+    """
+    Run I{operation} I{operations} times with at most I{concurrency} of them
+    in flight.
+
+    @param operation: Called without arguments, returns a
+        L{defer.Deferred}.
+
+    @rtype: L{defer.Deferred} that fires with the summary.
+    """
+    latencies = []
+    errors = [0]
+
+    def one():
+        callStart = default_timer()
+
+        def done(_):
+            latencies.append(default_timer() - callStart)
+
+        def failed(f):
+            errors[0] += 1
+            if errors[0] == 1:
+                print("{0}: first error: {1}".format(
+                    name, f.getErrorMessage()
+                ))
+
+        return defer.maybeDeferred(operation).addCallbacks(done, failed)
+
+    work = (one() for _ in range(operations))
+    start = default_timer()
+    d = defer.DeferredList([
+        cooperator.coiterate(work) for _ in range(concurrency)
+    ])
+    d.addCallback(lambda _: summarize(
+        name, latencies, default_timer() - start, concurrency, errors[0],
+    ))
+    return d
+
+
+def formatResult(result):
+    """
+    Return a one-line, human-readable summary of I{result}.
+    """
+    def ms(value):
+        return "-" if value is None else "{0:.3f}".format(value * 1000)
+
+    latency = result["latency"]
+    return (
+        "{name:<34} c={concurrency:<4} {opsPerSec:>11.1f} ops/s  "
+        "p50 {p50}ms  p90 {p90}ms  p99 {p99}ms{errors}".format(
+            name=result["name"],
+            concurrency=result["concurrency"],
+            opsPerSec=result["opsPerSec"] or 0,
+            p50=ms(latency["p50"]),
+            p90=ms(latency["p90"]),
+            p99=ms(latency["p99"]),
+            errors=(
+                "  ({0} errors)".format(result["errors"])
+                if result["errors"] else ""
+            ),
+        )
+    )
+
+
+def compare(old, new):
+    """
+    Return lines that show how the throughput of each benchmark in I{new}
+    changed relative to I{old}.
+
+    @param old: A report as written by the runner.
+    @param new: Another report.
+    """
+    previous = dict(
+        ((r["name"], r["concurrency"]), r) for r in old["results"]
+    )
+    lines = []
+    for result in new["results"]:
+        key = result["name"], result["concurrency"]
+        before = previous.get(key)
+        if before is None or not before["opsPerSec"] or \
+                not result["opsPerSec"]:
+            continue
+        change = result["opsPerSec"] / before["opsPerSec"] - 1
+        lines.append("{0:<34} c={1:<4} {2:>+7.1%}".format(
+            key[0], key[1], change
+        ))
+    return lines
@@ -0,0 +1,74 @@
+# Copyright (c) Hynek Schlawack, Richard Wall
+# See LICENSE for details.
+
+"""
+Benchmarks of TLSA lookups, certificate retrieval and whole checks against
+servers on the loopback interface.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+from twisted.internet import defer
+
+from danex import _check, _resolver, _tls
+from danex._cache import TLSACache
+from danex._dane import matchChain, tlsaDomainName
+from danex.testing import TLSFarm
+
+from ._harness import runConcurrent
+from .servers import TLSAServer, tlsaRData
+
+
+HOST = u"127.0.0.1"
+
+
+@defer.inlineCallbacks
+def run(reactor, concurrencies, operations):
+    """
+    Run all end-to-end benchmarks once per concurrency level.
+
+    The resolver cache is bypassed so every lookup reaches the stand-in DNS
+    server.
+
+    @rtype: L{defer.Deferred} that fires with a L{list} of result
+        L{dict}s.
+    """
+    farm = TLSFarm(reactor, size=1, interface=HOST)
+    yield farm.start()
+    [(port, chain)] = farm.servers
+
+    dnsServer = TLSAServer([
+        tlsaRData(chain[0], 3, 1, 1), tlsaRData(chain[1], 2, 0, 1),
+    ])
+    dnsPort = reactor.listenUDP(0, dnsServer, interface=HOST)
+    resolver = _resolver.TLSAResolver(
+        reactor, servers=[(HOST, dnsPort.getHost().port)]
+    )
+    oldCache = _resolver.getCache()
+    _resolver.setCache(TLSACache(resolver.lookupTLSA, reactor, maxSize=0))
+    name = tlsaDomainName(HOST, port, "tcp")
+
+    def check():
+        d = _check.checkTarget(HOST, port, "tcp", reactor=reactor)
+        d.addCallback(lambda res: matchChain(res[0][1], res[1]))
+        return d
+
+    benchmarks = [
+        ("dns.lookupTLSA", lambda: resolver.lookupTLSA(name)),
+        ("tls.retrieveCertificate",
+         lambda: _tls.retrieveCertificate(HOST, port, reactor=reactor)),
+        ("check", check),
+    ]
+    results = []
+    try:
+        for benchmarkName, operation in benchmarks:
+            for concurrency in concurrencies:
+                result = yield runConcurrent(
+                    benchmarkName, operation, operations, concurrency,
+                )
+                results.append(result)
+    finally:
+        _resolver.setCache(oldCache)
+        yield dnsPort.stopListening()
+        yield farm.stop()
+    defer.returnValue(results)
@@ -0,0 +1,188 @@
+# Copyright (c) Hynek Schlawack, Richard Wall
+# See LICENSE for details.
+
+"""
+Drive the CLI batch path or the dane_doctor check API with many targets
+without touching the network.
+
+    python -m benchmarks.loadtest --targets 10000 --servers 20
+    python -m benchmarks.loadtest --mode doctor --batch-size 200
+
+TLSA lookups are answered by a L{danex.testing.ScriptedGetdns} with the
+configured latency, certificates are served by a L{danex.testing.TLSFarm}.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import io
+import json
+import random
+import sys
+
+from timeit import default_timer
+
+from twisted.internet import defer, task
+from twisted.python import usage
+from twisted.web.client import Agent, FileBodyProducer, readBody
+from twisted.web.http_headers import Headers
+from twisted.web.server import Site
+
+from danex import _check, _resolver, _result
+from danex._cache import TLSACache
+from danex._dane import tlsaDomainName
+from danex.testing import ScriptedGetdns, ScriptedResolver, TLSFarm
+
+
+MODES = ("cli", "doctor")
+
+
+class Options(usage.Options):
+    synopsis = "Usage: python -m benchmarks.loadtest [options]"
+
+    optParameters = [
+        ["mode", "m", "cli", "What to drive: " + ", ".join(MODES) + "."],
+        ["targets", "n", 5000, "Number of targets to check.", int],
+        ["servers", "s", 20, "Number of loopback TLS servers.", int],
+        ["key-type", None, "ec", "Key type of the certificates: rsa, ec."],
+        ["concurrency", "c", 200,
+         "Checks in flight (cli) or concurrent requests (doctor).", int],
+        ["batch-size", "b", 100,
+         "Targets per API request (doctor), at most 1000.", int],
+        ["latency", "l", 0.002, "Seconds each TLSA lookup takes.", float],
+        ["jitter", "j", 0.0,
+         "Mean of an exponentially distributed delay added to each lookup.",
+         float],
+        ["ttl", None, 0,
+         "TTL of the TLSA records.  0 makes every check do a lookup.", int],
+        ["missing", None, 0.0,
+         "Fraction of servers that have no TLSA records.", float],
+    ]
+
+    def postOptions(self):
+        if self["mode"] not in MODES:
+            raise usage.UsageError("Unknown mode {0!r}.".format(self["mode"]))
+        if self["key-type"] not in ("rsa", "ec"):
+            raise usage.UsageError("--key-type must be rsa or ec.")
+        for key in ("targets", "servers", "concurrency", "batch-size"):
+            if self[key] < 1:
+                raise usage.UsageError("--{0} must be at least 1.".format(key))
+        if self["batch-size"] > 1000:
+            raise usage.UsageError("--batch-size must be at most 1000.")
+
+
+def _makeGetdns(options, farm):
+    if options["jitter"]:
+        base, mean = options["latency"], options["jitter"]
+        latency = lambda: base + random.expovariate(1 / mean)
+    else:
+        latency = options["latency"]
+    getdns = ScriptedGetdns(latency=latency)
+    farm.publish(getdns, ttl=options["ttl"])
+    missing = int(len(farm.servers) * options["missing"])
+    for port, _ in farm.servers[:missing]:
+        getdns.remove(tlsaDomainName(farm.interface, port, "tcp"))
+    return getdns
+
+
+def _driveCLI(reactor, options, targets, outcomes):
+    lines = ["{0} {1} {2}".format(*target) for target in targets]
+
+    def report(target, res):
+        _result.CheckResult.fromCheck(target, res)
+        key = _check.outcome(res)
+        outcomes[key] = outcomes.get(key, 0) + 1
+
+    return _check.checkTargets(
+        _check.parseTargets(lines), report,
+        concurrency=options["concurrency"], reactor=reactor,
+    )
+
+
+@defer.inlineCallbacks
+def _driveDoctor(reactor, options, targets, outcomes):
+    from dane_doctor import tap
+    from dane_doctor.protocol import DaneDoctorFactory
+
+    factory = DaneDoctorFactory(maxConcurrent=options["concurrency"] * 10,
+                                maxQueued=len(targets))
+    port = reactor.listenTCP(
+        0, Site(tap.makeRoot(factory, reactor)), interface="127.0.0.1"
+    )
+    url = "http://127.0.0.1:{0}/api/check".format(
+        port.getHost().port
+    ).encode("ascii")
+    agent = Agent(reactor)
+
+    def post(batch):
+        body = json.dumps([
+            {"domain": host, "port": p, "proto": proto}
+            for host, p, proto in batch
+        ]).encode("utf-8")
+        d = agent.request(
+            b"POST", url, Headers({b"content-type": [b"application/json"]}),
+            FileBodyProducer(io.BytesIO(body)),
+        )
+        d.addCallback(readBody)
+        d.addCallback(countResults)
+        return d
+
+    def countResults(body):
+        for result in json.loads(body.decode("utf-8")):
+            key = "ok" if result.get("error") is None else result["error"]
+            outcomes[key] = outcomes.get(key, 0) + 1
+
+    size = options["batch-size"]
+    batches = iter([
+        targets[i:i + size] for i in range(0, len(targets), size)
+    ])
+    work = (post(batch) for batch in batches)
+    try:
+        yield defer.DeferredList([
+            task.coiterate(work) for _ in range(options["concurrency"])
+        ])
+    finally:
+        yield port.stopListening()
+
+
+@defer.inlineCallbacks
+def _main(reactor, options):
+    farm = TLSFarm(reactor, size=options["servers"],
+                   keyType=options["key-type"])
+    yield farm.start()
+    getdns = _makeGetdns(options, farm)
+    oldCache = _resolver.getCache()
+    _resolver.setCache(TLSACache(
+        ScriptedResolver(getdns, reactor).lookupTLSA, reactor
+    ))
+    targets = farm.targets(options["targets"])
+    outcomes = {}
+    drive = _driveCLI if options["mode"] == "cli" else _driveDoctor
+    start = default_timer()
+    try:
+        yield drive(reactor, options, targets, outcomes)
+    finally:
+        elapsed = default_timer() - start
+        _resolver.setCache(oldCache)
+        yield farm.stop()
+
+    print("{0} targets in {1:.2f}s: {2:.1f} targets/s".format(
+        len(targets), elapsed, len(targets) / elapsed
+    ))
+    print("{0} TLSA lookups".format(sum(getdns.queries.values())))
+    for key, count in sorted(outcomes.items()):
+        print("  {0:<40} {1}".format(key, count))
+
+
+def main():
+    options = Options()
+    try:
+        options.parseOptions()
+    except usage.UsageError as e:
+        print("{0}: {1}".format(sys.argv[0], e))
+        print(options)
+        sys.exit(1)
+    task.react(_main, (options,))
+
+
+if __name__ == "__main__":
+    main()
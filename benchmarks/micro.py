@@ -0,0 +1,72 @@
+# Copyright (c) Hynek Schlawack, Richard Wall
+# See LICENSE for details.
+
+"""
+Benchmarks of the CPU-bound parts: parsing and matching TLSA records.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+from danex._dane import (
+    CertificateFingerprints, MATCHING_TYPE, SELECTOR, TLSARecord, matchChain,
+)
+from danex._resolver import parseTLSARecord
+from danex._x509 import extractPublicKey
+from danex.testing import makeChain
+
+from ._harness import runSync
+from .servers import tlsaRData
+
+
+def run(iterations):
+    """
+    Run all micro benchmarks.
+
+    @rtype: L{list} of result L{dict}s
+    """
+    results = []
+    _, chain = makeChain()
+    cert = chain[0]
+    rdata = tlsaRData(cert)
+
+    results.append(runSync(
+        "TLSARecord", lambda: TLSARecord(rdata[3:], 3, 1, 1), iterations,
+    ))
+    results.append(runSync(
+        "parseTLSARecord", lambda: parseTLSARecord(rdata), iterations,
+    ))
+
+    for keyType in ("rsa", "ec"):
+        _, keyChain = makeChain(keyType=keyType)
+        keyCert = keyChain[0]
+        results.append(runSync(
+            "extractPublicKey." + keyType,
+            lambda: extractPublicKey(keyCert), iterations,
+        ))
+
+    for selector in (SELECTOR.CERT, SELECTOR.SPKI):
+        for matchingType in (MATCHING_TYPE.FULL, MATCHING_TYPE.SHA_256,
+                             MATCHING_TYPE.SHA_512):
+            record = parseTLSARecord(
+                tlsaRData(cert, 3, selector.value, matchingType.value)
+            )
+            name = "matchesCertificate.{0}.{1}".format(
+                selector.name, matchingType.name
+            )
+            results.append(runSync(
+                name, lambda: record.matchesCertificate(cert), iterations,
+            ))
+
+    records = [
+        parseTLSARecord(tlsaRData(c, usage, 1, 1))
+        for c, usage in [(chain[0], 3), (chain[1], 2)]
+    ]
+    results.append(runSync(
+        "matchChain", lambda: matchChain(records, chain), iterations,
+    ))
+    fingerprints = [CertificateFingerprints(c) for c in chain]
+    results.append(runSync(
+        "matchChain.fingerprinted",
+        lambda: matchChain(records, fingerprints), iterations,
+    ))
+    return results
@@ -0,0 +1,57 @@
+# Copyright (c) Hynek Schlawack, Richard Wall
+# See LICENSE for details.
+
+"""
+A local stand-in for a validating resolver.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import struct
+
+from twisted.internet.protocol import DatagramProtocol
+from twisted.names import dns
+
+from danex import _resolver
+from danex.testing import associationData
+
+
+def tlsaRData(cert, usage=3, selector=1, matchingType=1):
+    """
+    Return the RDATA of a TLSA record for I{cert}.
+    """
+    return struct.pack("!BBB", usage, selector, matchingType) + \
+        associationData(cert, selector, matchingType)
+
+
+
+class TLSAServer(DatagramProtocol):
+    """
+    Answers every TLSA query with the same records and the AD bit set, like
+    a validating resolver would for a signed zone.
+
+    @ivar rdatas: The RDATA of the records to answer with.
+    @ivar queries: Number of queries answered.
+    """
+    ttl = 3600
+
+    def __init__(self, rdatas):
+        self.rdatas = list(rdatas)
+        self.queries = 0
+
+
+    def datagramReceived(self, data, address):
+        query = dns._EDNSMessage()
+        query.fromStr(data)
+        self.queries += 1
+        (q,) = query.queries
+        response = dns._EDNSMessage(
+            id=query.id, answer=True, recDes=query.recDes, recAv=True,
+            authenticData=True, queries=query.queries, maxSize=4096,
+            answers=[
+                dns.RRHeader(q.name.name, _resolver.TLSA, ttl=self.ttl,
+                             payload=dns.UnknownRecord(rdata, ttl=self.ttl))
+                for rdata in self.rdatas
+            ] if q.type == _resolver.TLSA else [],
+        )
+        self.transport.write(response.toStr(), address)
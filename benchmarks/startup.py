@@ -0,0 +1,42 @@
+# Copyright (c) Hynek Schlawack, Richard Wall
+# See LICENSE for details.
+
+"""
+Benchmarks of how long the CLI takes to start.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import os
+import subprocess
+import sys
+
+from ._harness import runSync
+
+
+COMMANDS = [
+    ("startup.import", ["-c", "import danex.__main__"]),
+    ("startup.help", [
+        "-c", "import sys; sys.argv = ['danex', '--help']; "
+        "from danex.__main__ import main; main()",
+    ]),
+]
+
+
+def run(iterations):
+    """
+    Start a fresh interpreter I{iterations} times per command.
+
+    Bytecode is compiled before, so only the imports are measured.
+
+    @rtype: L{list} of result L{dict}s
+    """
+    with open(os.devnull, "w") as devnull:
+        def python(args):
+            subprocess.check_call([sys.executable] + args, stdout=devnull)
+
+        results = []
+        for name, args in COMMANDS:
+            python(args)
+            results.append(runSync(name, lambda: python(args), iterations))
+        return results
@@ -0,0 +1,261 @@
+# -*- test-case-name: dane_doctor.test.test_assets -*-
+# Copyright (c) Hynek Schlawack, Richard Wall
+# See LICENSE for details.
+
+"""
+Serve static files from memory.
+
+All files are read and compressed once when the store is loaded.  Each
+response carries a strong ETag so clients can revalidate cheaply using
+C{If-None-Match}, which is compared weakly as RFC 7232 requires.  Files
+whose names contain a content hash -- like C{app.3f2a9c81.js} -- never
+change and are marked as cacheable forever.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import gzip
+import hashlib
+import io
+import mimetypes
+import re
+
+from twisted.web.resource import NoResource, Resource
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+FINGERPRINTED = re.compile(r"\.[0-9a-f]{8,}\.[^.]+$")
+
+IMMUTABLE = b"public, max-age=31536000, immutable"
+REVALIDATE = b"no-cache"
+
+# For smaller files, the compression overhead eats up the savings.
+MIN_COMPRESS_SIZE = 256
+
+
+def _isCompressible(contentType):
+    return (
+        contentType.startswith("text/")
+        or contentType in ("application/javascript", "application/json",
+                           "application/xml", "image/svg+xml")
+    )
+
+
+def _gzip(data):
+    buf = io.BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode="wb", compresslevel=9,
+                       mtime=0) as f:
+        f.write(data)
+    return buf.getvalue()
+
+
+def _etag(tag):
+    return '"{0}"'.format(tag).encode("ascii")
+
+
+_ENTITY_TAG = re.compile(br'(?:W/)?("[^"]*")')
+
+
+def _noneMatch(header, etag):
+    """
+    Whether an C{If-None-Match} header lists I{etag}.
+
+    @see: U{https://tools.ietf.org/html/rfc7232#section-3.2}
+
+    The header is a list of entity tags or C{*}.  Tags are compared weakly,
+    that is C{W/"x"} matches C{"x"}.
+
+    @type header: L{bytes}
+    @param etag: The strong ETag of the representation.
+    @type etag: L{bytes}
+
+    @rtype: L{bool}
+    """
+    if header.strip() == b"*":
+        return True
+    return etag in _ENTITY_TAG.findall(header)
+
+
+def _acceptedEncodings(header):
+    """
+    Return the content codings that an C{Accept-Encoding} header allows.
+
+    @type header: L{bytes} or C{None}
+    @rtype: L{set} of L{bytes}
+    """
+    accepted = set()
+    for coding in (header or b"").split(b","):
+        parts = coding.strip().split(b";")
+        name = parts[0].strip().lower()
+        q = 1.0
+        for param in parts[1:]:
+            key, _, value = param.strip().partition(b"=")
+            if key.strip() == b"q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if name and q > 0:
+            accepted.add(name)
+    return accepted
+
+
+class Asset(object):
+    """
+    A static file with all of its representations.
+
+    @ivar variants: A L{dict} mapping the content coding -- C{b"identity"},
+        C{b"gzip"} or C{b"br"} -- to the C{(body, etag)} tuple of that
+        representation.
+    @ivar contentType: The value of the C{Content-Type} header.
+    @ivar cacheControl: The value of the C{Cache-Control} header.
+    """
+    def __init__(self, name, content):
+        contentType = mimetypes.guess_type(name)[0] or \
+            "application/octet-stream"
+        digest = hashlib.sha256(content).hexdigest()[:32]
+
+        # Strong ETags must differ between representations.
+        self.variants = {b"identity": (content, _etag(digest))}
+        if _isCompressible(contentType) and \
+                len(content) >= MIN_COMPRESS_SIZE:
+            compressed = {b"gzip": _gzip(content)}
+            if brotli is not None:
+                compressed[b"br"] = brotli.compress(content)
+            for coding, body in compressed.items():
+                if len(body) < len(content):
+                    self.variants[coding] = (
+                        body, _etag(digest + "-" + coding.decode("ascii"))
+                    )
+
+        if contentType.startswith("text/"):
+            contentType += "; charset=utf-8"
+        self.contentType = contentType.encode("ascii")
+        self.cacheControl = (
+            IMMUTABLE if FINGERPRINTED.search(name) else REVALIDATE
+        )
+
+
+    def select(self, acceptEncoding):
+        """
+        Pick the smallest representation that the client accepts.
+
+        @param acceptEncoding: The C{Accept-Encoding} request header.
+
+        @return: The content coding, the body and the ETag.
+        @rtype: L{tuple}
+        """
+        accepted = _acceptedEncodings(acceptEncoding)
+        for coding in (b"br", b"gzip"):
+            if coding in accepted and coding in self.variants:
+                return (coding,) + self.variants[coding]
+        return (b"identity",) + self.variants[b"identity"]
+
+
+
+class AssetStore(object):
+    """
+    All files below a directory, kept in memory.
+    """
+    def __init__(self, path):
+        """
+        @param path: The directory to serve.
+        @type path: L{FilePath}
+        """
+        self._path = path
+        self._assets = {}
+
+
+    def load(self):
+        """
+        Read, compress and fingerprint all files.
+        """
+        assets = {}
+        for child in self._path.walk():
+            if child.isfile():
+                segments = child.segmentsFrom(self._path)
+                assets["/".join(segments)] = Asset(
+                    child.basename(), child.getContent()
+                )
+        self._assets = assets
+
+
+    def get(self, name):
+        """
+        Return the asset at I{name} or C{None}.
+
+        Directories are represented by their C{index.html}.
+
+        @param name: A C{/}-separated path relative to the directory.
+        @type name: L{str}
+        """
+        if name == "" or name.endswith("/"):
+            name += "index.html"
+        return self._assets.get(name)
+
+
+
+class AssetPage(Resource):
+    """
+    Renders one L{Asset}.
+    """
+    isLeaf = True
+
+    def __init__(self, asset):
+        Resource.__init__(self)
+        self._asset = asset
+
+
+    def render_GET(self, request):
+        coding, body, etag = self._asset.select(
+            request.getHeader(b"accept-encoding")
+        )
+        request.setHeader(b"etag", etag)
+        request.setHeader(b"cache-control", self._asset.cacheControl)
+        request.setHeader(b"vary", b"Accept-Encoding")
+
+        ifNoneMatch = request.getHeader(b"if-none-match")
+        if ifNoneMatch is not None and _noneMatch(ifNoneMatch, etag):
+            request.setResponseCode(304)
+            return b""
+
+        request.setHeader(b"content-type", self._asset.contentType)
+        if coding != b"identity":
+            request.setHeader(b"content-encoding", coding)
+        request.setHeader(b"content-length", str(len(body)).encode("ascii"))
+        return body
+
+    render_HEAD = render_GET
+
+
+
+class AssetResource(Resource):
+    """
+    Serves an L{AssetStore}.
+
+    Children added using C{putChild} take precedence over the assets.
+    """
+    def __init__(self, store):
+        Resource.__init__(self)
+        self._store = store
+
+
+    def getChild(self, path, request):
+        segments = [path] + request.postpath
+        request.postpath = []
+        try:
+            name = "/".join(s.decode("utf-8") for s in segments)
+        except UnicodeDecodeError:
+            return NoResource()
+        asset = self._store.get(name)
+        if asset is None:
+            return NoResource()
+        return AssetPage(asset)
+
+
+    def render_GET(self, request):
+        return self.getChild(b"", request).render(request)
@@ -0,0 +1,143 @@
+# -*- test-case-name: dane_doctor.test.test_config -*-
+# Copyright (c) Hynek Schlawack, Richard Wall
+# See LICENSE for details.
+
+"""
+Settings of the dane_doctor service.
+
+Settings come from built-in defaults, optionally overridden by a YAML file
+whose keys are named like the long command line options, which in turn are
+overridden by the command line.  For example::
+
+    listen:
+      - tcp:8080
+      - unix:/run/dane_doctor.sock
+    thread-pool-size: 20
+    dns-timeout: 3
+    max-concurrent: 500
+    cache-size: 100000
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import yaml
+
+from danex import _metrics, _resolver, _tls
+from danex._cache import TLSACache
+
+
+DEFAULTS = {
+    "listen": ["tcp:8080"],
+    "workers": 0,
+    "shared-cache": False,
+    "thread-pool-size": 10,
+    "dns-timeout": 5.0,
+    "trust-remote-resolvers": False,
+    "connect-timeout": 10.0,
+    "handshake-timeout": 10.0,
+    "resume-sessions": False,
+    "session-max-age": 3600,
+    "check-timeout": 60.0,
+    "max-concurrent": 200,
+    "max-per-client": 5,
+    "max-queued": 1000,
+    "cache-size": 4096,
+    "cache-max-ttl": 86400,
+    "metrics": True,
+}
+
+# Settings that are only read at startup.  With workers, "listen" is too.
+STARTUP_ONLY = ("workers", "shared-cache")
+
+# Limits that would stall every check if they were 0.
+AT_LEAST_ONE = ("max-concurrent", "max-per-client")
+
+
+def _check(key, value):
+    """
+    Return I{value} converted to the type of the default of I{key}.
+
+    @raises ValueError: If I{key} is unknown or I{value} has the wrong type.
+    """
+    try:
+        default = DEFAULTS[key]
+    except KeyError:
+        raise ValueError("Unknown setting {0!r}.".format(key))
+
+    if isinstance(default, list):
+        if isinstance(value, str):
+            value = [value]
+        if (not isinstance(value, list)
+                or not all(isinstance(v, str) for v in value)):
+            raise ValueError("{0!r} must be a list of strings.".format(key))
+        return value
+    if isinstance(default, bool):
+        if not isinstance(value, bool):
+            raise ValueError("{0!r} must be true or false.".format(key))
+        return value
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise ValueError("{0!r} must be a number.".format(key))
+    if value < 0:
+        raise ValueError("{0!r} must not be negative.".format(key))
+    if key in AT_LEAST_ONE and value < 1:
+        raise ValueError("{0!r} must be at least 1.".format(key))
+    if isinstance(default, int) and value != int(value):
+        raise ValueError("{0!r} must be an integer.".format(key))
+    return type(default)(value)
+
+
+def loadConfig(path=None, overrides=None):
+    """
+    Merge the defaults, the file at I{path} and I{overrides}.
+
+    @param path: Path of a YAML file or C{None}.
+    @param overrides: A L{dict} of settings that take precedence over the
+        file.  C{None} values are ignored.
+
+    @rtype: L{dict}
+
+    @raises ValueError: If a setting is unknown or invalid.
+    @raises EnvironmentError: If the file can't be read.
+    """
+    settings = dict(DEFAULTS)
+    if path is not None:
+        with open(path) as f:
+            loaded = yaml.safe_load(f) or {}
+        if not isinstance(loaded, dict):
+            raise ValueError("{0} must contain a mapping.".format(path))
+        for key, value in loaded.items():
+            settings[key] = _check(key, value)
+    for key, value in (overrides or {}).items():
+        if value is not None:
+            settings[key] = _check(key, value)
+    return settings
+
+
+def applySettings(settings, reactor, factory=None):
+    """
+    Apply all settings that may change at runtime.
+
+    @param factory: The L{dane_doctor.protocol.DaneDoctorFactory} to
+        configure or C{None} if this process doesn't serve checks.
+    """
+    _metrics.REGISTRY.enabled = settings["metrics"]
+    reactor.suggestThreadPoolSize(settings["thread-pool-size"])
+    resolver = _resolver.getResolver()
+    resolver.timeout = settings["dns-timeout"]
+    resolver.trustRemote = settings["trust-remote-resolvers"]
+
+    _tls.getSessionCache().maxAge = settings["session-max-age"]
+
+    cache = _resolver.getCache()
+    if isinstance(cache, TLSACache):
+        cache.maxSize = settings["cache-size"]
+        cache.maxTTL = settings["cache-max-ttl"]
+
+    if factory is not None:
+        factory.maxConcurrent = settings["max-concurrent"]
+        factory.maxPerClient = settings["max-per-client"]
+        factory.maxQueued = settings["max-queued"]
+        factory.timeout = settings["check-timeout"] or None
+        factory.connectTimeout = settings["connect-timeout"]
+        factory.handshakeTimeout = settings["handshake-timeout"]
+        factory.resumeSessions = settings["resume-sessions"]
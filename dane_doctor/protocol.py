@@ -1,54 +1,381 @@
 from __future__ import (absolute_import, division, print_function)
 
 import json
+from collections import deque
 
 from twisted.internet.protocol import Factory, Protocol, connectionDone
-from twisted.internet import task, threads, defer
+from twisted.internet import task, defer
+from twisted.protocols.basic import LineReceiver
+from twisted.python.failure import Failure
 
-from danex import _dane, _tls
+from danex import _check, _mail, _result
 
 
-class DaneDoctorProtocol(Protocol):
-    def dataReceived(self, data):
+class RequestError(ValueError):
+    """
+    A request is invalid.
 
-        domain = data.strip(" \n")
-        port = 443
-        proto = "tcp"
+    @ivar requestID: The C{id} of the request if it could be determined.
+    """
+    def __init__(self, message, requestID=None):
+        ValueError.__init__(self, message)
+        self.requestID = requestID
 
-        d = defer.gatherResults([
-            threads.deferToThread(
-                _dane.lookup_tlsa_records, domain, port, proto
-            ),
-            _tls.retrieveCertificate(domain, port)
-        ])
+
+
+def _isText(value):
+    return isinstance(value, type(u""))
+
+
+def targetFromRequest(request):
+    """
+    Extract the target from a decoded JSON request.
+
+    @param request: An object with the keys C{domain}, C{port}, C{proto},
+        C{mail} and C{id} -- all but C{domain} are optional.  If C{mail} is
+        true, C{domain} is a mail domain whose MX hosts are checked and
+        C{port} and C{proto} are ignored.
+
+    @return: The request ID and the C{(domain, port, proto)} target or the
+        C{(domain,)} target of a mail domain.
+    @rtype: L{tuple}
+
+    @raises RequestError: If I{request} isn't a valid request.
+    """
+    if not isinstance(request, dict):
+        raise RequestError("Request without domain.")
+    requestID = request.get("id")
+    domain = request.get("domain")
+    if not domain:
+        raise RequestError("Request without domain.", requestID)
+    if not _isText(domain):
+        raise RequestError("Domain must be a string.", requestID)
+    mail = request.get("mail", False)
+    if not isinstance(mail, bool):
+        raise RequestError("Mail must be a boolean.", requestID)
+    if mail:
+        return requestID, (domain,)
+    port = request.get("port", 443)
+    if (isinstance(port, bool) or not isinstance(port, int)
+            or not 0 < port < 65536):
+        raise RequestError("Port must be an integer between 1 and 65535.",
+                           requestID)
+    proto = request.get("proto", "tcp")
+    if not _isText(proto):
+        raise RequestError("Proto must be a string.", requestID)
+    return requestID, (domain, port, proto)
+
+
+def parseRequest(line):
+    """
+    Parse a request line.
+
+    A request is either a JSON object with the keys C{domain}, C{port},
+    C{proto} and C{id} -- all but C{domain} are optional -- or just a domain
+    name.
+
+    @type line: L{bytes}
+
+    @return: The request ID and the C{(domain, port, proto)} target.
+    @rtype: L{tuple}
+
+    @raises ValueError: If the line isn't a valid request.  If it's a
+        L{RequestError}, it may carry the ID of the request.
+    """
+    line = line.decode("utf-8").strip()
+    if not line:
+        raise RequestError("Request without domain.")
+    if not line.startswith("{"):
+        return None, (line, 443, "tcp")
+
+    return targetFromRequest(json.loads(line))
+
+
+def resultFromCheck(target, res):
+    """
+    Create the result of checking I{target}.
+
+    @param target: A target as returned by L{targetFromRequest}.
+    @param res: What the check fired with or a L{Failure}.
+
+    @rtype: L{_result.CheckResult} or L{_result.MailResult}
+    """
+    if len(target) == 1:
+        return _result.MailResult.fromCheck(target, res)
+    return _result.CheckResult.fromCheck(target, res)
+
+
+
+class DaneDoctorProtocol(LineReceiver):
+    """
+    Checks the targets it receives, one request per line.
+
+    Any number of requests may be sent over one connection.  Each response
+    is a JSON object on a line of its own that carries the C{id} of its
+    request, and is sent as soon as its check finishes, regardless of the
+    order of the requests.
+
+    Each client may only have C{factory.maxPerClient} checks in flight.
+    Once it reaches that quota, no more requests are read -- not even ones
+    that already arrived in the same segment -- until one of them finishes.
+    """
+    delimiter = b"\n"
+    MAX_LENGTH = 4096
+
+    def connectionMade(self):
+        self._inFlight = 0
+
+
+    def connectionLost(self, reason=connectionDone):
+        self.connected = False
+
+
+    def sendResponse(self, requestID, result):
+        """
+        Send I{result} tagged with I{requestID} if the client is still
+        there.
+
+        @type result: L{_result.CheckResult} or L{_result.MailResult}
+        """
+        if not self.connected:
+            return
+        rv = result.asDict()
+        rv["id"] = requestID
+        self.sendLine(json.dumps(rv).encode("utf-8"))
+
+
+    def lineReceived(self, line):
+        try:
+            requestID, target = parseRequest(line)
+        except ValueError as e:
+            self.sendResponse(
+                getattr(e, "requestID", None),
+                _result.CheckResult(
+                    line.decode("utf-8", "replace"), None, None,
+                    error=str(e),
+                ),
+            )
+            return
+
+        if self.factory.busy:
+            self.sendResponse(
+                requestID, resultFromCheck(target, Failure(ValueError("busy")))
+            )
+            return
+
+        self._inFlight += 1
+        if len(target) == 1:
+            d = self.factory.checkMail(*target)
+        else:
+            d = self.factory.check(*target)
+        self._updatePaused()
 
         def onResults(res):
-            (trusted, tlsaRecords), serverCertificate = res
-            numRecs = len(tlsaRecords)
-            doesMatch = False
-            recs = []
-
-            for tlsa in tlsaRecords:
-                newRec = {
-                    "usage": tlsa.usage.name,
-                    "selector": tlsa.selector.name,
-                    "matchingType": tlsa.matchingType.name,
-                    "errors": tlsa.errors,
-                    "valid": tlsa.valid,
-                }
-
-                if tlsa.valid and tlsa.matchesCertificate(serverCertificate):
-                    newRec["matches"] = doesMatch = True
-                recs.append(newRec)
-
-            rv = {
-                "trusted": trusted,
-                "doesMatch": doesMatch,
-                "numRecs": numRecs,
-                "tlsaRecords": recs,
-            }
-            self.transport.write(json.dumps(rv))
-            self.transport.loseConnection()
-
-        d.addCallback(onResults)
-        return d
+            self._inFlight -= 1
+            self.sendResponse(requestID, resultFromCheck(target, res))
+            self._updatePaused()
+
+        d.addBoth(onResults)
+
+
+    def lineLengthExceeded(self, line):
+        self.sendResponse(None, _result.CheckResult(
+            None, None, None, error="Request too long."
+        ))
+        self.transport.loseConnection()
+
+
+    def _updatePaused(self):
+        """
+        Pause reading while the client is over its quota and resume once
+        it isn't anymore.
+
+        Resuming dispatches the requests that have been buffered meanwhile.
+        """
+        if not self.connected:
+            return
+        overQuota = self._inFlight >= self.factory.maxPerClient
+        if overQuota and not self.paused:
+            self.pauseProducing()
+        elif not overQuota and self.paused:
+            self.resumeProducing()
+
+
+
+class _Slots(object):
+    """
+    Limits the number of concurrent calls like
+    L{defer.DeferredSemaphore}, but its limit may be changed at any time.
+
+    @ivar inUse: Number of calls that are running.
+    @ivar waiting: The L{defer.Deferred}s of the calls that wait for a
+        slot, in order.
+    """
+    def __init__(self, limit):
+        self._limit = limit
+        self.inUse = 0
+        self.waiting = deque()
+
+
+    @property
+    def limit(self):
+        """
+        Maximum number of concurrent calls.
+
+        Raising it starts waiting calls immediately, lowering it lets the
+        running ones finish.
+        """
+        return self._limit
+
+
+    @limit.setter
+    def limit(self, limit):
+        self._limit = limit
+        self._startWaiting()
+
+
+    def run(self, f, *args, **kw):
+        """
+        Call I{f} with I{args} and I{kw} once a slot is free.
+
+        @rtype: L{defer.Deferred} that fires with the result of I{f}.
+            Cancelling it while it waits gives up its place in the queue.
+        """
+        acquired = defer.Deferred(self.waiting.remove)
+        self.waiting.append(acquired)
+        self._startWaiting()
+
+        def call(_):
+            return defer.maybeDeferred(f, *args, **kw).addBoth(self._release)
+
+        return acquired.addCallback(call)
+
+
+    def _release(self, result):
+        self.inUse -= 1
+        self._startWaiting()
+        return result
+
+
+    def _startWaiting(self):
+        while self.waiting and self.inUse < self._limit:
+            self.inUse += 1
+            self.waiting.popleft().callback(None)
+
+
+
+class DaneDoctorFactory(Factory):
+    """
+    Creates L{DaneDoctorProtocol}s and limits the number of checks in
+    flight across all of them.
+
+    All limits and timeouts may be changed while the factory is in use.
+    Connections pick up a changed per-client limit the next time one of
+    their checks starts or finishes.
+
+    @ivar maxPerClient: Limit for checks in flight per connection.
+    @ivar maxQueued: Number of checks that may wait for a free slot before
+        new ones are refused as busy.
+    @ivar timeout: Seconds after which a check is given up or C{None}.
+    @ivar connectTimeout: Seconds to wait for the TCP connection.
+    @ivar handshakeTimeout: Seconds to wait for the TLS handshake.
+    @ivar resumeSessions: Whether checks may resume TLS sessions, see
+        L{danex._check.checkTarget}.
+    """
+    protocol = DaneDoctorProtocol
+
+    def __init__(self, maxConcurrent=200, maxPerClient=5, maxQueued=1000,
+                 timeout=None, connectTimeout=10, handshakeTimeout=10,
+                 resumeSessions=False):
+        self.maxPerClient = maxPerClient
+        self.maxQueued = maxQueued
+        self.timeout = timeout
+        self.connectTimeout = connectTimeout
+        self.handshakeTimeout = handshakeTimeout
+        self.resumeSessions = resumeSessions
+        self._slots = _Slots(maxConcurrent)
+
+
+    @property
+    def maxConcurrent(self):
+        """
+        Global limit for checks in flight.
+
+        Lowering it doesn't interrupt checks that are already running.
+        """
+        return self._slots.limit
+
+
+    @maxConcurrent.setter
+    def maxConcurrent(self, limit):
+        self._slots.limit = limit
+
+
+    @property
+    def inFlight(self):
+        """
+        Number of checks that are running.
+        """
+        return self._slots.inUse
+
+
+    @property
+    def queued(self):
+        """
+        Number of checks that wait for a slot.
+        """
+        return len(self._slots.waiting)
+
+
+    @property
+    def busy(self):
+        """
+        Whether all check slots are taken and the queue is full.
+        """
+        return (
+            self._slots.inUse >= self._slots.limit
+            and len(self._slots.waiting) >= self.maxQueued
+        )
+
+
+    def check(self, host, port, proto, starttls=None):
+        """
+        Check a target once a global slot is free.
+
+        @rtype: L{defer.Deferred} that fires like
+            L{danex._check.checkTarget}.
+        """
+        return self._slots.run(
+            _check.checkTarget, host, port, proto, timeout=self.timeout,
+            connectTimeout=self.connectTimeout,
+            handshakeTimeout=self.handshakeTimeout, starttls=starttls,
+            resume=self.resumeSessions,
+        )
+
+
+    def mailChecker(self):
+        """
+        Create a L{_mail.MailChecker} whose MX host checks take global slots
+        like L{check}.
+
+        Each MX host is checked only once per checker, so share one between
+        the domains of a batch.
+        """
+        return _mail.MailChecker(checkHost=lambda host: self.check(
+            host, _mail.SMTP_PORT, "tcp", starttls="smtp",
+        ))
+
+
+    def checkMail(self, domain, checker=None):
+        """
+        Check the MX hosts of a mail domain.
+
+        @param checker: The L{_mail.MailChecker} to use.  If C{None}, a new
+            one is created using L{mailChecker}.
+
+        @rtype: L{defer.Deferred} that fires like
+            L{danex._mail.MailChecker.check}.
+        """
+        if checker is None:
+            checker = self.mailChecker()
+        return checker.check(domain)
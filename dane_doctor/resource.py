@@ -0,0 +1,131 @@
+# -*- test-case-name: dane_doctor.test.test_resource -*-
+# Copyright (c) Hynek Schlawack, Richard Wall
+# See LICENSE for details.
+
+from __future__ import absolute_import, division, print_function
+
+import json
+
+from twisted.internet import defer
+from twisted.python import log
+from twisted.web.resource import Resource
+from twisted.web.server import NOT_DONE_YET
+
+from .protocol import resultFromCheck, targetFromRequest
+
+
+class CheckResource(Resource):
+    """
+    Checks a list of targets per C{POST} request.
+
+    The body must be a JSON array of objects with the keys C{domain},
+    C{port}, C{proto}, C{mail} and C{id} -- all but C{domain} are optional.
+    The targets are checked concurrently and the response is a JSON array
+    whose elements are written as soon as the respective check finishes.  If
+    no C{id} is given, the index of the target in the request is used.
+
+    MX hosts that several mail domains of a request share are only checked
+    once.
+
+    @ivar maxTargets: Maximum number of targets per request.
+    """
+    isLeaf = True
+
+    def __init__(self, factory, maxTargets=1000):
+        """
+        @param factory: The L{dane_doctor.protocol.DaneDoctorFactory} whose
+            limits apply to the checks.
+        """
+        Resource.__init__(self)
+        self._factory = factory
+        self.maxTargets = maxTargets
+
+
+    def _badRequest(self, request, message):
+        request.setResponseCode(400)
+        request.setHeader(b"content-type", b"application/json")
+        return json.dumps({"error": message}).encode("utf-8")
+
+
+    def render_POST(self, request):
+        try:
+            items = json.loads(request.content.read().decode("utf-8"))
+            if not isinstance(items, list):
+                raise ValueError("Expected a list of targets.")
+            targets = []
+            for i, item in enumerate(items):
+                requestID, target = targetFromRequest(item)
+                targets.append((i if requestID is None else requestID, target))
+        except ValueError as e:
+            return self._badRequest(request, str(e))
+        if len(targets) > self.maxTargets:
+            return self._badRequest(request, "At most {0} targets allowed."
+                                    .format(self.maxTargets))
+
+        request.setHeader(b"content-type", b"application/json")
+        request.write(b"[")
+        state = {"first": True, "gone": False}
+        pending = []
+
+        def write(res, requestID, target):
+            if state["gone"]:
+                return
+            rv = resultFromCheck(target, res).asDict()
+            rv["id"] = requestID
+            request.write(
+                (b"" if state["first"] else b",\n")
+                + json.dumps(rv).encode("utf-8")
+            )
+            state["first"] = False
+
+        def clientGone(reason):
+            state["gone"] = True
+            for d in pending:
+                d.cancel()
+
+        request.notifyFinish().addErrback(clientGone)
+
+        mailChecker = None
+        for requestID, target in targets:
+            if self._factory.busy:
+                d = defer.fail(ValueError("busy"))
+            elif len(target) == 1:
+                if mailChecker is None:
+                    mailChecker = self._factory.mailChecker()
+                d = self._factory.checkMail(target[0], mailChecker)
+            else:
+                d = self._factory.check(*target)
+            d.addBoth(write, requestID, target)
+            pending.append(d)
+
+        def finish(_):
+            if not state["gone"]:
+                request.write(b"]")
+                request.finish()
+
+        def failed(failure):
+            failure.trap(defer.FirstError)
+            log.err(failure.value.subFailure, "Couldn't write a check result.")
+
+        d = defer.gatherResults(pending, consumeErrors=True)
+        d.addErrback(failed)
+        d.addBoth(finish)
+        return NOT_DONE_YET
+
+
+
+class MetricsResource(Resource):
+    """
+    Renders a L{danex._metrics.Registry} for Prometheus.
+    """
+    isLeaf = True
+
+    def __init__(self, registry):
+        Resource.__init__(self)
+        self._registry = registry
+
+
+    def render_GET(self, request):
+        request.setHeader(b"content-type",
+                          b"text/plain; version=0.0.4; charset=utf-8")
+        return self._registry.render()
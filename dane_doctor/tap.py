@@ -3,60 +3,342 @@
 
 from __future__ import absolute_import, division, print_function
 
+import json
+import os
+import shutil
+import signal
+import tempfile
+
 from twisted.application.internet import StreamServerEndpointService
 from twisted.application.service import MultiService
-from twisted.internet.endpoints import serverFromString
-from twisted.python import usage
+from twisted.internet import defer
+from twisted.internet.endpoints import UNIXServerEndpoint, serverFromString
+from twisted.python import log, usage
 from twisted.internet.protocol import Factory, Protocol, connectionDone
 from twisted.python.filepath import FilePath
-from twisted.web.resource import ForbiddenResource, Resource
 from twisted.web.server import Site
-from twisted.web.static import File
 
 from txsockjs.factory import SockJSResource
 
-from .protocol import DaneDoctorProtocol
+from danex import _metrics, _resolver
+from danex._cache import TLSACache
+from danex._metrics import CallbackMetric
+
+from . import config
+from .assets import AssetResource, AssetStore
+from .protocol import DaneDoctorFactory
+from .resource import CheckResource, MetricsResource
+from .workers import CacheServerFactory, WorkerSupervisor
 
 
 class Options(usage.Options):
-    pass
+    optParameters = [
+        ["config", "c", None,
+         "YAML file with settings named like the long options."],
+        ["workers", "w", None,
+         "Number of worker processes that share the listening sockets.  0 "
+         "serves from the main process.", int],
+        ["thread-pool-size", None, None,
+         "Maximum size of the reactor thread pool.", int],
+        ["dns-timeout", None, None,
+         "Seconds to wait for each DNS server.", float],
+        ["connect-timeout", None, None,
+         "Seconds to wait for TCP connections.", float],
+        ["handshake-timeout", None, None,
+         "Seconds to wait for TLS handshakes.", float],
+        ["check-timeout", None, None,
+         "Seconds after which a check is given up.  0 for no limit.", float],
+        ["max-concurrent", None, None,
+         "Maximum number of checks in flight.", int],
+        ["max-per-client", None, None,
+         "Maximum number of checks in flight per connection.", int],
+        ["max-queued", None, None,
+         "Maximum number of checks waiting for a slot.", int],
+        ["cache-size", None, None,
+         "Maximum number of cached TLSA lookups.", int],
+        ["cache-max-ttl", None, None,
+         "Maximum number of seconds a TLSA lookup is cached.", int],
+        ["session-max-age", None, None,
+         "With --resume-sessions, seconds after a full handshake during "
+         "which TLS sessions are resumed.", int],
+    ]
+    optFlags = [
+        ["shared-cache", None,
+         "Let all workers share one TLSA cache in the main process."],
+        ["no-metrics", None,
+         "Don't collect metrics.  /metrics only reports counters then."],
+        ["resume-sessions", None,
+         "Resume TLS sessions with servers that have been checked before.  "
+         "The certificate chain may then be up to --session-max-age "
+         "seconds old."],
+        ["trust-remote-resolvers", None,
+         "Trust the DNSSEC validation of DNS servers that aren't on the "
+         "loopback interface.  Only if the path to them is secure."],
+    ]
+
+    def __init__(self):
+        usage.Options.__init__(self)
+        self["listen"] = []
+
+    def opt_listen(self, description):
+        """
+        Endpoint description to listen on, e.g. tcp:8080 or
+        unix:/run/dane_doctor.sock.  May be repeated.  [default: tcp:8080]
+        """
+        self["listen"].append(description)
+
+    def postOptions(self):
+        try:
+            self["settings"] = self.loadSettings()
+        except (EnvironmentError, ValueError) as e:
+            raise usage.UsageError(str(e))
+
+    def loadSettings(self):
+        """
+        Read the config file again and apply the command line on top.
+
+        @rtype: L{dict}
+        """
+        overrides = dict(
+            (key, self[key]) for key in config.DEFAULTS if key in self
+        )
+        overrides["listen"] = self["listen"] or None
+        overrides["shared-cache"] = True if self["shared-cache"] else None
+        overrides["metrics"] = False if self["no-metrics"] else None
+        overrides["resume-sessions"] = (
+            True if self["resume-sessions"] else None
+        )
+        overrides["trust-remote-resolvers"] = (
+            True if self["trust-remote-resolvers"] else None
+        )
+        return config.loadConfig(self["config"], overrides)
 
 
-class NoListDirFile(File):
+def registerMetrics(registry, factory, reactor):
     """
-    Behaves like Twisted's File but refuses to list directories.
+    Report the load of I{factory}, the TLSA cache and the thread pool of
+    I{reactor} in I{registry}.
     """
-    def directoryListing(self):
-        return ForbiddenResource(message=b'Nope.')
+    def cacheStat(stat):
+        def get():
+            cache = _resolver.getCache()
+            if not isinstance(cache, TLSACache):
+                return 0
+            return stat(cache)
+        return get
+
+    def hitRatio(cache):
+        total = cache.hits + cache.misses + cache.coalesced
+        return cache.hits / total if total else 0.0
+
+    for name, help, callback, type in [
+        ("dane_doctor_checks_in_flight", "Checks that are running.",
+         lambda: factory.inFlight, "gauge"),
+        ("dane_doctor_checks_queued", "Checks that wait for a slot.",
+         lambda: factory.queued, "gauge"),
+        ("danex_tlsa_cache_hits_total", "TLSA lookups answered from cache.",
+         cacheStat(lambda cache: cache.hits), "counter"),
+        ("danex_tlsa_cache_misses_total", "TLSA lookups that resolved.",
+         cacheStat(lambda cache: cache.misses), "counter"),
+        ("danex_tlsa_cache_coalesced_total",
+         "TLSA lookups that waited for a running resolution.",
+         cacheStat(lambda cache: cache.coalesced), "counter"),
+        ("danex_tlsa_cache_hit_ratio", "Share of TLSA lookups from cache.",
+         cacheStat(hitRatio), "gauge"),
+        ("danex_tlsa_cache_entries", "Cached TLSA lookups.",
+         cacheStat(len), "gauge"),
+        ("twisted_threadpool_queue_depth",
+         "Calls waiting for a thread of the reactor thread pool.",
+         lambda: reactor.getThreadPool().q.qsize(), "gauge"),
+        ("twisted_threadpool_busy_threads",
+         "Busy threads of the reactor thread pool.",
+         lambda: len(reactor.getThreadPool().working), "gauge"),
+    ]:
+        registry.register(CallbackMetric(name, help, callback, type))
+
+
+def makeRoot(factory, reactor):
+    """
+    Create the resource tree of the web interface and its APIs.
+
+    The static files are loaded into memory right away.
+
+    @param factory: The L{DaneDoctorFactory} that runs the checks.
+    """
+    store = AssetStore(FilePath(__file__).sibling("static"))
+    store.load()
+    root = AssetResource(store)
+    api = SockJSResource(factory)
+    api.putChild(b'check', CheckResource(factory))
+    root.putChild(b'api', api)
+    registerMetrics(_metrics.REGISTRY, factory, reactor)
+    root.putChild(b'metrics', MetricsResource(_metrics.REGISTRY))
+    return root
 
 
 class DaneDoctorService(MultiService, object):
-    def __init__(self, reactor, config):
+    """
+    Serves dane_doctor, either itself or from worker processes.
+
+    On C{SIGHUP}, the settings are loaded again and applied without dropping
+    any connections.  Listen endpoints that have been added or removed are
+    opened or closed unless workers are used.
+    """
+    def __init__(self, reactor, settings, loadSettings=None):
+        """
+        @param settings: The settings as returned by
+            L{config.loadConfig}.
+        @param loadSettings: Called without arguments to get fresh settings
+            on reload.
+        """
         MultiService.__init__(self)
-        self._config = config
+        self._settings = settings
+        self._loadSettings = loadSettings
         self._reactor = reactor
+        self._factory = None
+        self._site = None
+        self._listeners = {}
+        self._ports = []
+        self._supervisor = None
+        self._tempDir = None
+        self._previousHandler = None
 
     def startService(self):
         MultiService.startService(self)
-
-        staticPath = FilePath(__file__).sibling("static")
-        root = NoListDirFile(staticPath.path)
-        root.putChild('api', SockJSResource(
-            Factory.forProtocol(DaneDoctorProtocol))
+        self._previousHandler = signal.signal(
+            signal.SIGHUP,
+            lambda *args: self._reactor.callFromThread(self.reload)
         )
 
-        webService = StreamServerEndpointService(
-            serverFromString(self._reactor, "tcp:8080"),
-            Site(root)
+        if self._settings["workers"]:
+            config.applySettings(self._settings, self._reactor)
+            self._startWorkers().addErrback(self._workersFailed)
+            return
+
+        self._factory = DaneDoctorFactory()
+        config.applySettings(self._settings, self._reactor, self._factory)
+        self._site = Site(makeRoot(self._factory, self._reactor))
+        self._updateListeners(self._settings["listen"])
+
+    def _updateListeners(self, descriptions):
+        """
+        Listen on exactly the endpoints in I{descriptions}.
+        """
+        for description in set(self._listeners) - set(descriptions):
+            self._listeners.pop(description).disownServiceParent()
+        for description in descriptions:
+            if description in self._listeners:
+                continue
+            service = StreamServerEndpointService(
+                serverFromString(self._reactor, description), self._site
+            )
+            self._listeners[description] = service
+            service.setServiceParent(self)
+
+    @defer.inlineCallbacks
+    def _startWorkers(self):
+        """
+        Bind the listening sockets and let worker processes serve from them.
+        """
+        self._tempDir = tempfile.mkdtemp(prefix="dane_doctor-")
+        settingsPath = os.path.join(self._tempDir, "settings.json")
+        self._writeSettings(settingsPath)
+
+        sockets = []
+        for description in self._settings["listen"]:
+            # Workers accept the connections; we only hold the socket.
+            port = yield serverFromString(
+                self._reactor, description
+            ).listen(Factory())
+            port.stopReading()
+            self._ports.append(port)
+            sockets.append((port.fileno(), port.addressFamily))
+
+        cacheSocket = None
+        if self._settings["shared-cache"]:
+            cacheSocket = os.path.join(self._tempDir, "cache.sock")
+            StreamServerEndpointService(
+                UNIXServerEndpoint(self._reactor, cacheSocket),
+                CacheServerFactory(_resolver.getCache()),
+            ).setServiceParent(self)
+
+        self._supervisor = WorkerSupervisor(
+            self._reactor, self._settings["workers"], sockets,
+            settingsPath=settingsPath, cacheSocket=cacheSocket,
         )
-        webService.setServiceParent(self)
+        self._supervisor.setServiceParent(self)
+
+    def _workersFailed(self, failure):
+        """
+        Without its sockets or workers the service is useless, so give up.
+        """
+        log.err(failure, "Couldn't start the workers.")
+        self._reactor.stop()
+
+    def _writeSettings(self, path):
+        with open(path + ".new", "w") as f:
+            json.dump(self._settings, f)
+        os.rename(path + ".new", path)
+
+    def reload(self):
+        """
+        Load the settings again and apply them.
+
+        If the new settings are invalid, the current ones are kept.
+        """
+        if self._loadSettings is None:
+            return
+        try:
+            settings = self._loadSettings()
+        except (EnvironmentError, ValueError):
+            log.err(None, "Invalid settings, keeping the current ones.")
+            return
+
+        workers = self._settings["workers"]
+        ignored = [
+            key for key in config.STARTUP_ONLY
+            if settings[key] != self._settings[key]
+        ]
+        if workers and settings["listen"] != self._settings["listen"]:
+            ignored.append("listen")
+        if ignored:
+            log.msg("Changes of {0} need a restart.".format(
+                ", ".join(ignored)
+            ))
+        for key in ignored:
+            settings[key] = self._settings[key]
+
+        self._settings = settings
+        config.applySettings(settings, self._reactor, self._factory)
+        if workers:
+            self._writeSettings(
+                os.path.join(self._tempDir, "settings.json")
+            )
+            if self._supervisor is not None:
+                self._supervisor.signalWorkers(signal.SIGHUP)
+        else:
+            self._updateListeners(settings["listen"])
+        log.msg("Settings reloaded.")
+
+    def stopService(self):
+        signal.signal(signal.SIGHUP, self._previousHandler or signal.SIG_DFL)
+        d = MultiService.stopService(self)
+
+        @d.addCallback
+        def cleanUp(_):
+            ports, self._ports = self._ports, []
+            for port in ports:
+                port.stopListening()
+            if self._tempDir is not None:
+                shutil.rmtree(self._tempDir, ignore_errors=True)
+                self._tempDir = None
+
+        return d
 
 
 def makeService(options):
     from twisted.internet import reactor
 
-    # with open(options[b'config']) as f:
-    #     config = yaml.safe_load(f)
-    config = {}
-
-    return DaneDoctorService(reactor, config)
+    return DaneDoctorService(
+        reactor, options["settings"], options.loadSettings
+    )
@@ -0,0 +1,182 @@
+# Copyright (c) Hynek Schlawack, Richard Wall
+# See LICENSE for details.
+
+from __future__ import absolute_import, division, print_function
+
+import gzip
+import io
+
+from twisted.python.filepath import FilePath
+from twisted.trial.unittest import SynchronousTestCase
+from twisted.web.resource import Resource, getChildForRequest
+from twisted.web.test.requesthelper import DummyRequest
+
+from dane_doctor import assets
+
+
+CSS = b"body { padding-top: 50px; }\n" * 20
+
+
+class AssetResourceTests(SynchronousTestCase):
+    def setUp(self):
+        path = FilePath(self.mktemp())
+        path.child("css").makedirs()
+        path.child("index.html").setContent(b"<html></html>")
+        path.child("css").child("site.css").setContent(CSS)
+        path.child("app.0123456789abcdef.js").setContent(b"alert(1);")
+        self.store = assets.AssetStore(path)
+        self.store.load()
+        self.root = assets.AssetResource(self.store)
+        self.root.putChild(b"api", Resource())
+
+
+    def get(self, path, **headers):
+        request = DummyRequest(path.split(b"/"))
+        for name, value in headers.items():
+            request.requestHeaders.setRawHeaders(
+                name.replace("_", "-").encode("ascii"), [value]
+            )
+        body = getChildForRequest(self.root, request).render(request)
+        return request, body
+
+
+    def header(self, request, name):
+        values = request.responseHeaders.getRawHeaders(name)
+        return values[0] if values else None
+
+
+    def test_identity(self):
+        """
+        Without C{Accept-Encoding}, the file is sent as it is together with
+        its type, length and a strong ETag.
+        """
+        request, body = self.get(b"css/site.css")
+
+        self.assertEqual(CSS, body)
+        self.assertEqual(b"text/css; charset=utf-8",
+                         self.header(request, b"content-type"))
+        self.assertEqual(str(len(CSS)).encode("ascii"),
+                         self.header(request, b"content-length"))
+        self.assertIs(None, self.header(request, b"content-encoding"))
+        self.assertTrue(self.header(request, b"etag").startswith(b'"'))
+        self.assertEqual(b"no-cache", self.header(request, b"cache-control"))
+
+
+    def test_gzip(self):
+        """
+        Clients that accept gzip get the precompressed variant with an ETag
+        of its own.
+        """
+        plain, _ = self.get(b"css/site.css")
+        request, body = self.get(b"css/site.css",
+                                 accept_encoding=b"deflate, gzip;q=0.5")
+
+        self.assertEqual(b"gzip", self.header(request, b"content-encoding"))
+        self.assertEqual(CSS, gzip.GzipFile(fileobj=io.BytesIO(body)).read())
+        self.assertNotEqual(self.header(plain, b"etag"),
+                            self.header(request, b"etag"))
+        self.assertEqual(b"Accept-Encoding", self.header(request, b"vary"))
+
+
+    def test_gzipRefused(self):
+        """
+        Codings with a q-value of 0 aren't used.
+        """
+        request, body = self.get(b"css/site.css",
+                                 accept_encoding=b"gzip;q=0")
+
+        self.assertEqual(CSS, body)
+
+
+    def test_notModified(self):
+        """
+        If the client already has the representation, 304 is returned
+        without a body.
+        """
+        request, _ = self.get(b"css/site.css")
+        etag = self.header(request, b"etag")
+
+        request, body = self.get(b"css/site.css",
+                                 if_none_match=b'"other", ' + etag)
+
+        self.assertEqual(304, request.responseCode)
+        self.assertEqual(b"", body)
+
+
+    def test_notModifiedWeak(self):
+        """
+        C{If-None-Match} is compared weakly, so a weak version of the ETag
+        matches, even next to tags that contain commas.
+        """
+        request, _ = self.get(b"css/site.css")
+        etag = self.header(request, b"etag")
+
+        request, body = self.get(b"css/site.css",
+                                 if_none_match=b'"a, b",W/' + etag)
+
+        self.assertEqual((304, b""), (request.responseCode, body))
+
+
+    def test_modified(self):
+        """
+        Tags that merely contain the ETag or a C{*} don't match.
+        """
+        request, _ = self.get(b"css/site.css")
+        etag = self.header(request, b"etag")
+
+        for header in [b'"x' + etag[1:], b'"*"', b'"other"']:
+            request, body = self.get(b"css/site.css", if_none_match=header)
+
+            self.assertNotEqual(304, request.responseCode)
+            self.assertEqual(CSS, body)
+
+
+    def test_notModifiedAny(self):
+        """
+        C{If-None-Match: *} matches any representation.
+        """
+        request, _ = self.get(b"css/site.css", if_none_match=b" * ")
+
+        self.assertEqual(304, request.responseCode)
+
+
+    def test_fingerprinted(self):
+        """
+        Files with a content hash in their name may be cached forever.
+        """
+        request, body = self.get(b"app.0123456789abcdef.js")
+
+        self.assertEqual(b"alert(1);", body)
+        self.assertEqual(assets.IMMUTABLE,
+                         self.header(request, b"cache-control"))
+
+
+    def test_index(self):
+        """
+        The root is served by C{index.html}.
+        """
+        request, body = self.get(b"")
+
+        self.assertEqual(b"<html></html>", body)
+
+
+    def test_notFound(self):
+        """
+        Unknown files and directories are 404s.
+        """
+        for path in [b"nope.css", b"css", b"css/nope/site.css"]:
+            request, _ = self.get(path)
+
+            self.assertEqual(404, request.responseCode)
+
+
+    def test_childrenFirst(self):
+        """
+        Children added using C{putChild} aren't shadowed.
+        """
+        request = DummyRequest([b"api"])
+
+        self.assertIs(
+            self.root.children[b"api"],
+            getChildForRequest(self.root, request)
+        )
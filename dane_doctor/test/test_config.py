@@ -0,0 +1,148 @@
+# Copyright (c) Hynek Schlawack, Richard Wall
+# See LICENSE for details.
+
+from __future__ import absolute_import, division, print_function
+
+from twisted.internet.task import Clock
+from twisted.trial.unittest import SynchronousTestCase
+
+from danex import _metrics, _resolver, _tls
+from danex._cache import TLSACache
+from dane_doctor import config
+from dane_doctor.protocol import DaneDoctorFactory
+
+
+class LoadConfigTests(SynchronousTestCase):
+    def writeConfig(self, content):
+        path = self.mktemp()
+        with open(path, "w") as f:
+            f.write(content)
+        return path
+
+
+    def test_defaults(self):
+        """
+        Without a file or overrides, the defaults are used.
+        """
+        self.assertEqual(config.DEFAULTS, config.loadConfig())
+
+
+    def test_file(self):
+        """
+        Settings from the file take precedence over the defaults and are
+        converted to the type of the default.
+        """
+        path = self.writeConfig(
+            "listen:\n"
+            "  - tcp:8080\n"
+            "  - unix:/tmp/dd.sock\n"
+            "dns-timeout: 3\n"
+        )
+
+        settings = config.loadConfig(path)
+
+        self.assertEqual(["tcp:8080", "unix:/tmp/dd.sock"], settings["listen"])
+        self.assertEqual(3.0, settings["dns-timeout"])
+        self.assertIsInstance(settings["dns-timeout"], float)
+        self.assertEqual(200, settings["max-concurrent"])
+
+
+    def test_overrides(self):
+        """
+        Overrides take precedence over the file unless they are C{None}.
+        """
+        path = self.writeConfig("max-concurrent: 10\nmax-queued: 20\n")
+
+        settings = config.loadConfig(
+            path, {"max-concurrent": 30, "max-queued": None}
+        )
+
+        self.assertEqual((30, 20), (settings["max-concurrent"],
+                                    settings["max-queued"]))
+
+
+    def test_invalid(self):
+        """
+        Unknown settings and values of the wrong type are refused.
+        """
+        for content in ["nope: 1\n", "max-concurrent: many\n",
+                        "shared-cache: 1\n", "listen: [1]\n",
+                        "dns-timeout: -1\n", "- tcp:8080\n",
+                        "max-concurrent: 1.5\n"]:
+            self.assertRaises(
+                ValueError, config.loadConfig, self.writeConfig(content)
+            )
+
+
+    def test_atLeastOne(self):
+        """
+        Check limits must be at least 1 while other settings may be 0.
+        """
+        for content in ["max-concurrent: 0\n", "max-per-client: 0\n"]:
+            self.assertRaises(
+                ValueError, config.loadConfig, self.writeConfig(content)
+            )
+        settings = config.loadConfig(self.writeConfig(
+            "workers: 0\nthread-pool-size: 0\ncache-size: 0\n"
+        ))
+
+        self.assertEqual(
+            (0, 0, 0),
+            (settings["workers"], settings["thread-pool-size"],
+             settings["cache-size"]),
+        )
+
+
+    def test_integralFloat(self):
+        """
+        Integer settings accept floats without a fractional part.
+        """
+        settings = config.loadConfig(self.writeConfig("workers: 2.0\n"))
+
+        self.assertEqual(2, settings["workers"])
+        self.assertIsInstance(settings["workers"], int)
+
+
+
+class FakeReactor(Clock):
+    threadPoolSize = None
+
+    def suggestThreadPoolSize(self, size):
+        self.threadPoolSize = size
+
+
+
+class ApplySettingsTests(SynchronousTestCase):
+    def test_apply(self):
+        """
+        L{config.applySettings} configures the thread pool, the resolver,
+        the cache and the factory.
+        """
+        self.patch(_metrics.REGISTRY, "enabled", False)
+        reactor = FakeReactor()
+        resolver = _resolver.TLSAResolver(reactor, servers=[("::1", 53)])
+        cache = TLSACache(resolver.lookupTLSA, reactor)
+        self.patch(_resolver, "_resolver", resolver)
+        self.patch(_resolver, "_cache", cache)
+        sessions = _tls.SessionCache(clock=reactor)
+        self.patch(_tls, "_sessions", sessions)
+        factory = DaneDoctorFactory()
+        settings = dict(config.DEFAULTS, **{
+            "thread-pool-size": 3, "dns-timeout": 1.0, "cache-size": 7,
+            "max-concurrent": 11, "check-timeout": 0.0,
+            "handshake-timeout": 2.0, "trust-remote-resolvers": True,
+            "resume-sessions": True, "session-max-age": 60,
+        })
+
+        config.applySettings(settings, reactor, factory)
+
+        self.assertTrue(_metrics.REGISTRY.enabled)
+        self.assertEqual(3, reactor.threadPoolSize)
+        self.assertEqual(1.0, resolver.timeout)
+        self.assertTrue(resolver.trustRemote)
+        self.assertEqual(60, sessions.maxAge)
+        self.assertTrue(factory.resumeSessions)
+        self.assertEqual(7, cache.maxSize)
+        self.assertEqual(11, factory.maxConcurrent)
+        self.assertIs(None, factory.timeout)
+        self.assertEqual(2.0, factory.handshakeTimeout)
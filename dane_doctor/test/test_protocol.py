@@ -0,0 +1,338 @@
+# Copyright (c) Hynek Schlawack, Richard Wall
+# See LICENSE for details.
+
+from __future__ import absolute_import, division, print_function
+
+import json
+
+from twisted.internet import defer
+from twisted.test.proto_helpers import StringTransport
+from twisted.trial.unittest import SynchronousTestCase
+
+from danex import _mail
+from dane_doctor.protocol import (
+    DaneDoctorFactory, RequestError, _Slots, parseRequest,
+)
+
+
+class FakeCheckFactory(DaneDoctorFactory):
+    """
+    A L{DaneDoctorFactory} whose checks never finish on their own.
+
+    @ivar mx: Maps mail domains to their MX hosts.
+    """
+    def __init__(self, **kw):
+        DaneDoctorFactory.__init__(self, **kw)
+        self.pending = []
+        self.mx = {}
+
+
+    def check(self, host, port, proto, starttls=None):
+        return self._slots.run(self._check, host)
+
+
+    def mailChecker(self):
+        return _mail.MailChecker(
+            lookupMX=lambda domain: defer.succeed(
+                (True, self.mx[domain], 300)
+            ),
+            checkHost=lambda host: self.check(host, 25, "tcp", "smtp"),
+        )
+
+
+    def _check(self, host):
+        d = defer.Deferred()
+        self.pending.append((host, d))
+        return d
+
+
+
+def responses(transport):
+    """
+    Return the JSON responses written to I{transport}.
+    """
+    return [
+        json.loads(line.decode("utf-8"))
+        for line in transport.value().splitlines()
+    ]
+
+
+
+class ParseRequestTests(SynchronousTestCase):
+    def test_domain(self):
+        """
+        A bare domain is checked on port 443/tcp without an ID.
+        """
+        self.assertEqual(
+            (None, ("example.com", 443, "tcp")),
+            parseRequest(b"example.com\r")
+        )
+
+
+    def test_json(self):
+        """
+        JSON requests may carry an ID, port and protocol.
+        """
+        self.assertEqual(
+            (42, ("example.com", 25, "tcp")),
+            parseRequest(
+                b'{"id": 42, "domain": "example.com", "port": 25}'
+            )
+        )
+
+
+    def test_mail(self):
+        """
+        Mail domains are requested using C{mail} and have no port.
+        """
+        self.assertEqual(
+            (1, ("example.com",)),
+            parseRequest(
+                b'{"id": 1, "domain": "example.com", "mail": true}'
+            )
+        )
+
+
+    def test_invalid(self):
+        """
+        Requests without a domain or with an invalid domain, port, protocol
+        or mail flag are rejected.
+        """
+        for line in [b'{"id": 1}', b'{"domain": "a", "port": "443"}',
+                     b'{"domain": "a", "mail": 1}', b'{"domain": ',
+                     b'{"domain": "a", "port": true}',
+                     b'{"domain": "a", "port": 0}',
+                     b'{"domain": "a", "port": 65536}',
+                     b'{"domain": 1}', b'{"domain": "a", "proto": 6}']:
+            self.assertRaises(ValueError, parseRequest, line)
+
+
+    def test_empty(self):
+        """
+        Empty lines are rejected like requests without a domain.
+        """
+        for line in [b"", b" \r"]:
+            e = self.assertRaises(RequestError, parseRequest, line)
+            self.assertEqual("Request without domain.", str(e))
+
+
+
+class SlotsTests(SynchronousTestCase):
+    def test_limit(self):
+        """
+        Calls beyond the limit wait and start once the limit is raised or a
+        running call finishes.
+        """
+        slots = _Slots(1)
+        running = [defer.Deferred() for _ in range(3)]
+        results = [slots.run(lambda d=d: d) for d in running]
+
+        self.assertEqual((1, 2), (slots.inUse, len(slots.waiting)))
+        slots.limit = 2
+        self.assertEqual((2, 1), (slots.inUse, len(slots.waiting)))
+        slots.limit = 1
+        running[0].callback("a")
+        self.assertEqual((1, 1), (slots.inUse, len(slots.waiting)))
+        running[1].callback("b")
+        self.assertEqual((1, 0), (slots.inUse, len(slots.waiting)))
+        self.assertEqual(["a", "b"],
+                         [self.successResultOf(d) for d in results[:2]])
+
+
+    def test_cancelWaiting(self):
+        """
+        Cancelling a waiting call gives up its place without calling it.
+        """
+        slots = _Slots(0)
+        calls = []
+        d = slots.run(calls.append, 1)
+
+        d.cancel()
+        slots.limit = 1
+
+        self.failureResultOf(d, defer.CancelledError)
+        self.assertEqual(([], 0), (calls, slots.inUse))
+
+
+
+class DaneDoctorProtocolTests(SynchronousTestCase):
+    def connect(self, factory):
+        proto = factory.buildProtocol(None)
+        transport = StringTransport()
+        proto.makeConnection(transport)
+        return proto, transport
+
+
+    def test_busy(self):
+        """
+        If all global slots are taken, a busy reply is sent.
+        """
+        factory = FakeCheckFactory(maxConcurrent=1, maxQueued=0)
+        self.connect(factory)[0].dataReceived(b"example.com\n")
+        proto, transport = self.connect(factory)
+
+        proto.dataReceived(b'{"id": 1, "domain": "example.org"}\n')
+
+        (response,) = responses(transport)
+        self.assertEqual(
+            (1, "example.org", "busy"),
+            (response["id"], response["host"], response["error"])
+        )
+        self.assertFalse(transport.disconnecting)
+        self.assertEqual(1, len(factory.pending))
+
+
+    def test_changeMaxConcurrent(self):
+        """
+        Raising C{maxConcurrent} starts waiting checks immediately, lowering
+        it doesn't interrupt running ones.
+        """
+        factory = FakeCheckFactory(maxConcurrent=1, maxPerClient=3)
+        proto, transport = self.connect(factory)
+        proto.dataReceived(b"a.com\nb.com\nc.com\n")
+
+        factory.maxConcurrent = 3
+
+        self.assertEqual(["a.com", "b.com", "c.com"],
+                         [host for host, _ in factory.pending])
+
+        factory.maxConcurrent = 1
+        factory.pending[0][1].callback(((True, []), []))
+        proto.dataReceived(b"d.com\n")
+
+        self.assertEqual(3, len(factory.pending))
+
+
+    def test_pauseOverQuota(self):
+        """
+        Reading is paused while a client has C{maxPerClient} checks in
+        flight and resumed afterwards.
+        """
+        factory = FakeCheckFactory(maxPerClient=1)
+        proto, transport = self.connect(factory)
+
+        proto.dataReceived(b"example.com\n")
+
+        self.assertEqual("paused", transport.producerState)
+
+        factory.pending[0][1].callback(((True, []), []))
+
+        self.assertEqual("producing", transport.producerState)
+
+
+    def test_pipelining(self):
+        """
+        Many requests can be sent over one connection and responses are
+        sent as soon as they are ready.
+        """
+        factory = FakeCheckFactory()
+        proto, transport = self.connect(factory)
+
+        proto.dataReceived(
+            b'{"id": "a", "domain": "example.com"}\n'
+            b'{"id": "b", "domain": "example.org"}\n'
+        )
+        factory.pending[1][1].callback(((True, []), []))
+        factory.pending[0][1].callback(((False, []), []))
+
+        self.assertEqual(
+            [("b", "example.org", True), ("a", "example.com", False)],
+            [(r["id"], r["host"], r["trusted"]) for r in responses(transport)]
+        )
+        self.assertFalse(transport.disconnecting)
+
+
+    def test_mail(self):
+        """
+        Mail domains are answered with the results of all of their MX hosts.
+        """
+        factory = FakeCheckFactory()
+        factory.mx["example.com"] = ["mx1.example.com", "mx2.example.com"]
+        proto, transport = self.connect(factory)
+
+        proto.dataReceived(
+            b'{"id": 1, "domain": "example.com", "mail": true}\n'
+        )
+        for _, d in factory.pending:
+            d.callback(((True, []), []))
+
+        (response,) = responses(transport)
+        self.assertEqual(
+            (1, "example.com", True,
+             [("mx1.example.com", 25), ("mx2.example.com", 25)]),
+            (response["id"], response["domain"], response["mxTrusted"],
+             [(mx["host"], mx["port"]) for mx in response["mx"]])
+        )
+
+
+    def test_invalidRequest(self):
+        """
+        Invalid requests are answered with an error that carries their ID
+        if it could be parsed.
+        """
+        proto, transport = self.connect(FakeCheckFactory())
+
+        proto.dataReceived(
+            b'{"id": 1}\n{"id": 2, "domain": "a", "port": -1}\n'
+        )
+
+        self.assertEqual(
+            [(1, "Request without domain."),
+             (2, "Port must be an integer between 1 and 65535.")],
+            [(r["id"], r["error"]) for r in responses(transport)]
+        )
+
+
+    def test_pipelinedOverQuota(self):
+        """
+        Requests that arrive in one segment beyond the client's quota aren't
+        read until a check finishes.
+        """
+        factory = FakeCheckFactory(maxPerClient=2)
+        proto, transport = self.connect(factory)
+
+        proto.dataReceived(b"".join(
+            b"host%d.example.com\n" % (i,) for i in range(10)
+        ))
+
+        self.assertEqual((2, 0, "paused"),
+                         (factory.inFlight, factory.queued,
+                          transport.producerState))
+        factory.pending[0][1].callback(((True, []), []))
+        self.assertEqual(
+            ["host0.example.com", "host1.example.com", "host2.example.com"],
+            [host for host, _ in factory.pending]
+        )
+        self.assertEqual((2, "paused"),
+                         (factory.inFlight, transport.producerState))
+
+
+    def test_changedQuota(self):
+        """
+        Existing connections follow changes of C{maxPerClient}.
+        """
+        factory = FakeCheckFactory(maxPerClient=1)
+        proto, transport = self.connect(factory)
+        proto.dataReceived(b"".join(
+            b"host%d.example.com\n" % (i,) for i in range(5)
+        ))
+
+        factory.maxPerClient = 3
+        factory.pending[0][1].callback(((True, []), []))
+
+        self.assertEqual((3, "paused"),
+                         (factory.inFlight, transport.producerState))
+
+
+    def test_connectionLost(self):
+        """
+        Results of checks that finish after the client left are dropped.
+        """
+        factory = FakeCheckFactory()
+        proto, transport = self.connect(factory)
+        proto.dataReceived(b"example.com\n")
+        proto.connectionLost()
+
+        factory.pending[0][1].callback(((True, []), []))
+
+        self.assertEqual(b"", transport.value())
@@ -0,0 +1,163 @@
+# Copyright (c) Hynek Schlawack, Richard Wall
+# See LICENSE for details.
+
+from __future__ import absolute_import, division, print_function
+
+import io
+import json
+
+from twisted.python.failure import Failure
+from twisted.trial.unittest import SynchronousTestCase
+from twisted.web.server import NOT_DONE_YET
+from twisted.web.test.requesthelper import DummyRequest
+
+from danex import _metrics
+from dane_doctor import resource
+from dane_doctor.resource import CheckResource, MetricsResource
+from dane_doctor.test.test_protocol import FakeCheckFactory
+
+
+def postRequest(body):
+    request = DummyRequest([b"check"])
+    request.method = b"POST"
+    request.content = io.BytesIO(body)
+    return request
+
+
+
+class CheckResourceTests(SynchronousTestCase):
+    def setUp(self):
+        self.factory = FakeCheckFactory()
+        self.resource = CheckResource(self.factory)
+
+
+    def test_streamsResults(self):
+        """
+        Results are written as soon as they are ready and the array is
+        closed once all targets are done.
+        """
+        request = postRequest(
+            b'[{"domain": "example.com"}, {"domain": "example.org", "id": "x"}]'
+        )
+
+        self.assertEqual(NOT_DONE_YET, self.resource.render(request))
+
+        self.factory.pending[1][1].callback(((True, []), []))
+
+        self.assertEqual(b"[", request.written[0])
+        self.assertEqual(0, request.finished)
+
+        self.factory.pending[0][1].errback(Failure(ValueError("nope")))
+
+        self.assertEqual(1, request.finished)
+        rv = json.loads(b"".join(request.written).decode("utf-8"))
+        self.assertEqual(
+            [("x", "example.org", None), (0, "example.com", "nope")],
+            [(r["id"], r["host"], r["error"]) for r in rv]
+        )
+
+
+    def test_sharedMX(self):
+        """
+        MX hosts shared by the mail domains of a request are checked once.
+        """
+        self.factory.mx = {
+            "example.com": ["mx.example.net"],
+            "example.org": ["mx.example.net"],
+        }
+        request = postRequest(
+            b'[{"domain": "example.com", "mail": true},'
+            b' {"domain": "example.org", "mail": true}]'
+        )
+        self.resource.render(request)
+
+        [(host, d)] = self.factory.pending
+        d.callback(((True, []), []))
+
+        self.assertEqual(1, request.finished)
+        rv = json.loads(b"".join(request.written).decode("utf-8"))
+        self.assertEqual(
+            [(0, "example.com", ["mx.example.net"]),
+             (1, "example.org", ["mx.example.net"])],
+            [(r["id"], r["domain"], [mx["host"] for mx in r["mx"]])
+             for r in rv]
+        )
+
+
+    def test_badRequest(self):
+        """
+        Malformed bodies are answered with 400.
+        """
+        for body in [b'{"domain": "example.com"}', b'[{"port": 443}]', b'[']:
+            request = postRequest(body)
+            rv = self.resource.render(request)
+
+            self.assertEqual(400, request.responseCode)
+            self.assertIn("error", json.loads(rv.decode("utf-8")))
+
+
+    def test_tooManyTargets(self):
+        """
+        Requests with more than C{maxTargets} targets are refused.
+        """
+        self.resource.maxTargets = 1
+        request = postRequest(
+            b'[{"domain": "example.com"}, {"domain": "example.org"}]'
+        )
+        self.resource.render(request)
+
+        self.assertEqual(400, request.responseCode)
+        self.assertEqual([], self.factory.pending)
+
+
+    def test_clientGone(self):
+        """
+        If the client disconnects, pending checks are cancelled.
+        """
+        request = postRequest(b'[{"domain": "example.com"}]')
+        self.resource.render(request)
+
+        request.processingFailed(Failure(Exception("gone")))
+
+        self.assertEqual(1, len(request.written))
+        self.assertTrue(self.factory.pending[0][1].called)
+
+
+    def test_writeFails(self):
+        """
+        If writing a result fails, the error is logged and the request is
+        still finished.
+        """
+        def resultFromCheck(target, res):
+            raise RuntimeError("boom")
+
+        self.patch(resource, "resultFromCheck", resultFromCheck)
+        request = postRequest(b'[{"domain": "example.com"}]')
+        self.resource.render(request)
+
+        self.factory.pending[0][1].callback(((True, []), []))
+
+        self.assertEqual(1, request.finished)
+        self.assertEqual([b"[", b"]"], request.written)
+        self.assertEqual(1, len(self.flushLoggedErrors(RuntimeError)))
+
+
+
+class MetricsResourceTests(SynchronousTestCase):
+    def test_render(self):
+        """
+        The registry is rendered in the Prometheus text format.
+        """
+        registry = _metrics.Registry()
+        registry.register(_metrics.CallbackMetric("test", "Test.", lambda: 1))
+        request = DummyRequest([b"metrics"])
+
+        rv = MetricsResource(registry).render(request)
+
+        self.assertEqual(
+            b"# HELP test Test.\n# TYPE test gauge\ntest 1\n", rv
+        )
+        self.assertEqual(
+            [b"text/plain; version=0.0.4; charset=utf-8"],
+            request.responseHeaders.getRawHeaders(b"content-type")
+        )
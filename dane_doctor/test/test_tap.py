@@ -0,0 +1,194 @@
+# Copyright (c) Hynek Schlawack, Richard Wall
+# See LICENSE for details.
+
+from __future__ import absolute_import, division, print_function
+
+import signal
+
+from twisted.internet.error import CannotListenError
+from twisted.internet.testing import MemoryReactorClock
+from twisted.python.usage import UsageError
+from twisted.trial.unittest import SynchronousTestCase
+
+from danex import _metrics, _resolver
+from danex._cache import TLSACache
+from dane_doctor import config, tap
+from dane_doctor.test.test_protocol import FakeCheckFactory
+
+
+class FakeThreadPool(object):
+    working = [object()]
+
+    class q(object):
+        @staticmethod
+        def qsize():
+            return 4
+
+
+
+class FakeReactor(MemoryReactorClock):
+    def suggestThreadPoolSize(self, size):
+        pass
+
+
+    def getThreadPool(self):
+        return FakeThreadPool
+
+
+
+class OptionsTests(SynchronousTestCase):
+    def test_defaults(self):
+        """
+        Without arguments, the defaults are used.
+        """
+        options = tap.Options()
+        options.parseOptions([])
+
+        self.assertEqual(config.DEFAULTS, options["settings"])
+
+
+    def test_commandLineOverridesFile(self):
+        """
+        Command line options take precedence over the config file and
+        C{--listen} may be repeated.
+        """
+        path = self.mktemp()
+        with open(path, "w") as f:
+            f.write("max-concurrent: 10\nmax-queued: 20\n")
+        options = tap.Options()
+        options.parseOptions([
+            "--config", path, "--max-concurrent", "30",
+            "--listen", "tcp:80", "--listen", "unix:/tmp/dd.sock",
+        ])
+
+        self.assertEqual(
+            (30, 20, ["tcp:80", "unix:/tmp/dd.sock"]),
+            (options["settings"]["max-concurrent"],
+             options["settings"]["max-queued"],
+             options["settings"]["listen"])
+        )
+
+
+    def test_invalidConfig(self):
+        """
+        Invalid config files are reported as usage errors.
+        """
+        path = self.mktemp()
+        with open(path, "w") as f:
+            f.write("nope: 1\n")
+
+        self.assertRaises(
+            UsageError, tap.Options().parseOptions, ["--config", path]
+        )
+
+
+
+class DaneDoctorServiceTests(SynchronousTestCase):
+    def setUp(self):
+        self.patch(_metrics.REGISTRY, "enabled", False)
+        self.reactor = FakeReactor()
+        self.settings = dict(config.DEFAULTS, listen=["tcp:8080"])
+        self.service = tap.DaneDoctorService(
+            self.reactor, self.settings, lambda: self.settings
+        )
+        self.service.startService()
+        self.addCleanup(self.service.stopService)
+
+
+    def test_listens(self):
+        """
+        The service listens on all endpoints and installs a C{SIGHUP}
+        handler.
+        """
+        self.assertEqual([8080], [p[0] for p in self.reactor.tcpServers])
+        self.assertNotEqual(signal.SIG_DFL, signal.getsignal(signal.SIGHUP))
+
+
+    def test_reloadListeners(self):
+        """
+        On reload, new endpoints are listened on and removed ones are
+        closed.
+        """
+        self.settings = dict(self.settings, listen=["tcp:8081"])
+
+        self.service.reload()
+
+        self.assertEqual([8080, 8081],
+                         [p[0] for p in self.reactor.tcpServers])
+        self.assertEqual(["tcp:8081"], list(self.service._listeners))
+
+
+    def test_reloadLimits(self):
+        """
+        On reload, the factory gets the new limits.
+        """
+        self.settings = dict(self.settings, **{"max-concurrent": 7})
+
+        self.service.reload()
+
+        self.assertEqual(7, self.service._factory.maxConcurrent)
+
+
+    def test_reloadInvalid(self):
+        """
+        If loading the settings fails, the current ones are kept.
+        """
+        def fail():
+            raise ValueError("nope")
+        self.service._loadSettings = fail
+
+        self.service.reload()
+
+        self.assertEqual(1, len(self.flushLoggedErrors(ValueError)))
+        self.assertEqual(200, self.service._factory.maxConcurrent)
+
+
+
+class FailingListenReactor(FakeReactor):
+    def listenTCP(self, port, factory, backlog=50, interface=""):
+        raise CannotListenError(interface, port, OSError("in use"))
+
+
+
+class WorkerStartupTests(SynchronousTestCase):
+    def test_listenFails(self):
+        """
+        If the sockets for the workers can't be bound, the error is logged
+        and the reactor is stopped.
+        """
+        self.patch(_metrics.REGISTRY, "enabled", False)
+        reactor = FailingListenReactor()
+        service = tap.DaneDoctorService(
+            reactor, dict(config.DEFAULTS, workers=2),
+        )
+        service.startService()
+        self.addCleanup(service.stopService)
+
+        self.assertEqual(1, len(self.flushLoggedErrors(CannotListenError)))
+        self.assertTrue(reactor.hasStopped)
+        self.assertIs(None, service._supervisor)
+
+
+
+class RegisterMetricsTests(SynchronousTestCase):
+    def test_metrics(self):
+        """
+        The load of the factory, the cache and the thread pool are reported.
+        """
+        registry = _metrics.Registry()
+        factory = FakeCheckFactory(maxConcurrent=1)
+        factory.check("a.com", 443, "tcp")
+        factory.check("b.com", 443, "tcp")
+        cache = TLSACache(None, FakeReactor())
+        cache.hits, cache.misses = 3, 1
+        self.patch(_resolver, "_cache", cache)
+
+        tap.registerMetrics(registry, factory, FakeReactor())
+
+        rendered = registry.render().decode("utf-8").splitlines()
+        for line in ["dane_doctor_checks_in_flight 1",
+                     "dane_doctor_checks_queued 1",
+                     "danex_tlsa_cache_hit_ratio 0.75",
+                     "twisted_threadpool_queue_depth 4",
+                     "twisted_threadpool_busy_threads 1"]:
+            self.assertIn(line, rendered)
@@ -0,0 +1,301 @@
+# Copyright (c) Hynek Schlawack, Richard Wall
+# See LICENSE for details.
+
+from __future__ import absolute_import, division, print_function
+
+import signal
+
+from twisted.internet import defer
+from twisted.internet.error import ConnectionRefusedError, ProcessTerminated
+from twisted.internet.task import Clock
+from twisted.protocols import amp
+from twisted.python.failure import Failure
+from twisted.python.usage import UsageError
+from twisted.test import iosim
+from twisted.trial.unittest import SynchronousTestCase
+
+from danex._cache import TLSACache
+from danex._dane import GetdnsResponseError, TLSARecord
+from dane_doctor.workers import (
+    CacheServer, RemoteTLSACache, WorkerOptions, WorkerSupervisor
+)
+
+
+class FakeCacheEndpoint(object):
+    """
+    Connects to a L{CacheServer} in memory.
+
+    @ivar pumps: The L{iosim.IOPump}s of all connections.
+    @ivar refuse: Whether connection attempts fail.
+    """
+    def __init__(self, cache):
+        self._cache = cache
+        self.pumps = []
+        self.refuse = False
+
+
+    def connect(self, factory):
+        if self.refuse:
+            return defer.fail(ConnectionRefusedError())
+        client = factory.buildProtocol(None)
+        server = CacheServer(self._cache)
+        self.pumps.append(iosim.connect(
+            server, iosim.makeFakeServer(server),
+            client, iosim.makeFakeClient(client),
+        ))
+        return defer.succeed(client)
+
+
+
+class RemoteTLSACacheTests(SynchronousTestCase):
+    def setUp(self):
+        self.answers = {}
+        self.resolved = []
+        self.clock = Clock()
+        self.endpoint = FakeCacheEndpoint(TLSACache(self.resolve, Clock()))
+        self.remote = RemoteTLSACache(self.endpoint, self.clock,
+                                      retryPolicy=lambda attempt: 1)
+        self.addCleanup(self.remote.stop)
+
+
+    def resolve(self, name):
+        self.resolved.append(name)
+        answer = self.answers[name]
+        if isinstance(answer, Exception):
+            return defer.fail(answer)
+        return defer.succeed(answer)
+
+
+    def lookup(self, name):
+        d = self.remote.lookup(name)
+        self.endpoint.pumps[-1].flush()
+        return d
+
+
+    def test_records(self):
+        """
+        Records are passed over the wire, even invalid ones.
+        """
+        self.answers[u"_443._tcp.example.com"] = (True, [
+            TLSARecord(b"\x01\x02", 3, 1, 1),
+            TLSARecord(b"\x03", 7, 1, 1),
+        ], 300)
+
+        trusted, records = self.successResultOf(
+            self.lookup(u"_443._tcp.example.com")
+        )
+
+        self.assertTrue(trusted)
+        self.assertEqual(
+            [(b"\x01\x02", True), (b"\x03", False)],
+            [(r.payload, r.valid) for r in records]
+        )
+        self.assertEqual({"usage": [("Invalid parameter", 7)]},
+                         records[1].errors)
+
+
+    def test_sharedCache(self):
+        """
+        Lookups are answered from the cache of the server.
+        """
+        self.answers[u"_443._tcp.example.com"] = (False, [], 300)
+
+        self.lookup(u"_443._tcp.example.com")
+        self.lookup(u"_443._tcp.example.com")
+
+        self.assertEqual([u"_443._tcp.example.com"], self.resolved)
+
+
+    def test_error(self):
+        """
+        L{GetdnsResponseError}s are raised again with the same code.
+        """
+        self.answers[u"_443._tcp.example.com"] = GetdnsResponseError(901, 60)
+
+        f = self.failureResultOf(
+            self.lookup(u"_443._tcp.example.com"), GetdnsResponseError
+        )
+
+        self.assertEqual(901, f.value.errorCode)
+
+
+    def test_largeRRset(self):
+        """
+        RRsets that exceed the size limit of AMP values are passed in
+        chunks.
+        """
+        records = [TLSARecord(bytes(bytearray([i % 256])) * 1024, 3, 1, 0)
+                   for i in range(100)]
+        self.answers[u"_443._tcp.example.com"] = (True, records, 300)
+
+        _, received = self.successResultOf(
+            self.lookup(u"_443._tcp.example.com")
+        )
+
+        self.assertEqual([r.payload for r in records],
+                         [r.payload for r in received])
+
+
+    def test_reconnects(self):
+        """
+        If the connection is lost, lookups fail until it's been
+        reconnected.
+        """
+        self.answers[u"_443._tcp.example.com"] = (False, [], 300)
+        self.successResultOf(self.lookup(u"_443._tcp.example.com"))
+        pump = self.endpoint.pumps[-1]
+        pump.clientIO.loseConnection()
+        pump.flush()
+        self.endpoint.refuse = True
+
+        d = self.remote.lookup(u"_443._tcp.example.com")
+        self.assertNoResult(d)
+        self.clock.advance(1)
+        self.failureResultOf(d, ConnectionRefusedError)
+
+        self.endpoint.refuse = False
+        self.clock.advance(1)
+
+        self.assertEqual(2, len(self.endpoint.pumps))
+        self.successResultOf(self.lookup(u"_443._tcp.example.com"))
+
+
+
+class FakeProcessTransport(object):
+    def __init__(self):
+        self.signals = []
+
+
+    def signalProcess(self, signalID):
+        self.signals.append(signalID)
+
+
+
+class FakeProcessReactor(Clock):
+    def __init__(self):
+        Clock.__init__(self)
+        self.spawned = []
+
+
+    def spawnProcess(self, protocol, executable, args, env, childFDs):
+        protocol.transport = FakeProcessTransport()
+        self.spawned.append((protocol, args, childFDs))
+
+
+
+class WorkerSupervisorTests(SynchronousTestCase):
+    def setUp(self):
+        self.reactor = FakeProcessReactor()
+        self.supervisor = WorkerSupervisor(
+            self.reactor, 2, [(7, 2), (8, 1)],
+            settingsPath="/tmp/settings.json", cacheSocket="/tmp/cache.sock",
+        )
+        self.supervisor.startService()
+
+
+    def test_spawns(self):
+        """
+        The workers get the listening sockets mapped to the same descriptors
+        and are told where the settings and the cache are.
+        """
+        self.assertEqual(2, len(self.reactor.spawned))
+        protocol, args, childFDs = self.reactor.spawned[0]
+
+        self.assertEqual((7, 8), (childFDs[7], childFDs[8]))
+        self.assertEqual("w", childFDs[0])
+        self.assertEqual(
+            ["--socket", "7:2", "--socket", "8:1",
+             "--settings", "/tmp/settings.json",
+             "--cache", "/tmp/cache.sock"],
+            args[3:]
+        )
+
+
+    def test_restarts(self):
+        """
+        Dead workers are restarted after C{restartDelay} seconds.
+        """
+        protocol = self.reactor.spawned[0][0]
+        protocol.processEnded(Failure(ProcessTerminated(1)))
+
+        self.assertEqual(2, len(self.reactor.spawned))
+
+        self.reactor.advance(self.supervisor.restartDelay)
+
+        self.assertEqual(3, len(self.reactor.spawned))
+        self.assertEqual(protocol.number, self.reactor.spawned[2][0].number)
+
+
+    def test_backoff(self):
+        """
+        A worker that keeps dying is restarted after exponentially growing
+        delays up to C{maxRestartDelay}.  Once it stayed up for that long,
+        the delay starts over.
+        """
+        delays = []
+        protocol = self.reactor.spawned[0][0]
+        for lifetime in [0, 0, 0, 0, 0, 0, 0, 60]:
+            self.reactor.advance(lifetime)
+            protocol.processEnded(Failure(ProcessTerminated(1)))
+            [call] = self.reactor.getDelayedCalls()
+            delays.append(call.getTime() - self.reactor.seconds())
+            self.reactor.advance(delays[-1])
+            restarted = self.reactor.spawned[-1][0]
+            self.assertEqual(protocol.number, restarted.number)
+            protocol = restarted
+
+        self.assertEqual([1, 2, 4, 8, 16, 32, 60, 1], delays)
+
+
+    def test_signalWorkers(self):
+        """
+        L{WorkerSupervisor.signalWorkers} signals all running workers.
+        """
+        self.supervisor.signalWorkers(signal.SIGHUP)
+
+        self.assertEqual(
+            [[signal.SIGHUP]] * 2,
+            [protocol.transport.signals
+             for protocol, _, _ in self.reactor.spawned]
+        )
+
+
+    def test_stop(self):
+        """
+        Stopping terminates all workers, doesn't restart them and fires once
+        they are all gone.
+        """
+        d = self.supervisor.stopService()
+        protocols = [protocol for protocol, _, _ in self.reactor.spawned]
+
+        self.assertEqual(
+            [[signal.SIGTERM]] * 2,
+            [protocol.transport.signals for protocol in protocols]
+        )
+        self.assertNoResult(d)
+
+        for protocol in protocols:
+            protocol.processEnded(Failure(ProcessTerminated(1)))
+        self.reactor.advance(self.supervisor.restartDelay)
+
+        self.successResultOf(d)
+        self.assertEqual(2, len(self.reactor.spawned))
+
+
+
+class WorkerOptionsTests(SynchronousTestCase):
+    def test_sockets(self):
+        """
+        Any number of sockets may be passed.
+        """
+        options = WorkerOptions()
+        options.parseOptions(["--socket", "3:2", "--socket", "4:1"])
+
+        self.assertEqual([(3, 2), (4, 1)], options["sockets"])
+
+
+    def test_noSockets(self):
+        """
+        At least one socket is required.
+        """
+        self.assertRaises(UsageError, WorkerOptions().parseOptions, [])
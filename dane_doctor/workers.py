@@ -0,0 +1,440 @@
+# -*- test-case-name: dane_doctor.test.test_workers -*-
+# Copyright (c) Hynek Schlawack, Richard Wall
+# See LICENSE for details.
+
+"""
+Serve dane_doctor from several processes that share one listening socket.
+
+The parent process binds the sockets and spawns the workers with the sockets
+mapped into them.  Each worker adopts the sockets using
+L{IReactorSocket.adoptStreamPort} and serves requests on its own.  Workers
+that die are restarted by the parent.
+
+Optionally, the parent keeps the only TLSA cache and the workers look up
+records through it over an AMP connection on a UNIX socket.  That way, all
+workers profit from each other's lookups.  Workers reconnect to the cache if
+the connection is lost.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import json
+import os
+import signal
+import sys
+
+from twisted.application.internet import ClientService
+from twisted.application.service import Service
+from twisted.internet import defer, stdio, task
+from twisted.internet.endpoints import UNIXClientEndpoint
+from twisted.internet.error import ProcessExitedAlready
+from twisted.internet.protocol import Factory, ProcessProtocol, Protocol
+from twisted.protocols import amp
+from twisted.python import log, usage
+from twisted.web.server import Site
+
+from danex import _resolver
+from danex._dane import GetdnsResponseError
+from danex._store import packRecords, unpackRecords
+
+from . import config
+from .protocol import DaneDoctorFactory
+
+
+class ChunkedString(amp.Argument):
+    """
+    A byte string of any length.
+
+    AMP values are limited to C{amp.MAX_VALUE_LENGTH} bytes, so it's sent in
+    chunks as the values of C{name.0}, C{name.1} and so on.
+    """
+    def toBox(self, name, strings, objects, proto):
+        value = self.retrieve(objects, str(name.decode("ascii")), proto)
+        for i, offset in enumerate(
+                range(0, len(value) or 1, amp.MAX_VALUE_LENGTH)):
+            strings[name + b"." + str(i).encode("ascii")] = value[
+                offset:offset + amp.MAX_VALUE_LENGTH
+            ]
+
+
+    def fromBox(self, name, strings, objects, proto):
+        chunks = []
+        while True:
+            key = name + b"." + str(len(chunks)).encode("ascii")
+            if key not in strings:
+                break
+            chunks.append(strings[key])
+        objects[str(name.decode("ascii"))] = b"".join(chunks)
+
+
+
+class LookupTLSA(amp.Command):
+    """
+    Look up the TLSA records at C{name} in the parent's cache.
+
+    The records are passed as serialized by L{danex._store.packRecords}.  If
+    the lookup fails with a L{GetdnsResponseError}, its code is passed as
+    C{errorCode}.
+    """
+    arguments = [
+        (b"name", amp.Unicode()),
+    ]
+    response = [
+        (b"trusted", amp.Boolean()),
+        (b"records", ChunkedString()),
+        (b"errorCode", amp.Integer(optional=True)),
+    ]
+
+
+
+class CacheServer(amp.AMP):
+    """
+    Answers L{LookupTLSA} from a L{danex._cache.TLSACache}.
+    """
+    def __init__(self, cache):
+        amp.AMP.__init__(self)
+        self._cache = cache
+
+
+    @LookupTLSA.responder
+    def lookupTLSA(self, name):
+        def found(res):
+            trusted, records = res
+            return {"trusted": trusted, "records": packRecords(records)}
+
+        def failed(failure):
+            failure.trap(GetdnsResponseError)
+            return {
+                "trusted": False,
+                "records": b"",
+                "errorCode": failure.value.errorCode,
+            }
+
+        return self._cache.lookup(name).addCallbacks(found, failed)
+
+
+
+class CacheServerFactory(Factory):
+    def __init__(self, cache):
+        self._cache = cache
+
+
+    def buildProtocol(self, addr):
+        return CacheServer(self._cache)
+
+
+
+class RemoteTLSACache(object):
+    """
+    Looks up TLSA records through a L{CacheServer}.
+
+    Can be used wherever a L{danex._cache.TLSACache} is expected.
+
+    If the connection is lost, it's reconnected with an exponential backoff.
+    Lookups that are made meanwhile fail if the next attempt fails, too.
+    """
+    def __init__(self, endpoint, clock, retryPolicy=None):
+        """
+        @param endpoint: The L{IStreamClientEndpoint} of the
+            L{CacheServer}.
+        @param clock: The L{IReactorTime} to schedule reconnects with.
+        @param retryPolicy: Called with the number of failed attempts,
+            returns the seconds to wait before the next one.  If C{None},
+            L{twisted.application.internet.backoffPolicy} is used.
+        """
+        self._service = ClientService(
+            endpoint, Factory.forProtocol(amp.AMP), retryPolicy=retryPolicy,
+            clock=clock,
+        )
+        self._service.startService()
+
+
+    def whenConnected(self):
+        """
+        @rtype: L{defer.Deferred} that fires with the L{amp.AMP} connected
+            to the L{CacheServer} or fails if the next attempt to connect
+            fails.
+        """
+        return self._service.whenConnected(failAfterFailures=1)
+
+
+    def stop(self):
+        """
+        Disconnect and stop reconnecting.
+
+        @rtype: L{defer.Deferred} that fires once disconnected.
+        """
+        return self._service.stopService()
+
+
+    def lookup(self, name):
+        """
+        @see: L{danex._cache.TLSACache.lookup}
+        """
+        def received(response):
+            if response.get("errorCode") is not None:
+                raise GetdnsResponseError(response["errorCode"])
+            return response["trusted"], unpackRecords(response["records"])
+
+        # AMP drops the connection on failures that reach the end of the
+        # callRemote Deferred, so hand them over to a Deferred of our own.
+        d = defer.Deferred()
+        self.whenConnected().addCallback(
+            lambda protocol: protocol.callRemote(LookupTLSA, name=name)
+        ).addCallback(received).addCallbacks(d.callback, d.errback)
+        return d
+
+
+
+class WorkerProcessProtocol(ProcessProtocol):
+    """
+    Logs the output of a worker and tells the supervisor once it ended.
+    """
+    def __init__(self, supervisor, number, started):
+        """
+        @param started: When the worker has been spawned.
+        """
+        self._supervisor = supervisor
+        self.number = number
+        self.started = started
+        self.ended = defer.Deferred()
+
+
+    def _log(self, data):
+        for line in data.decode("utf-8", "replace").splitlines():
+            log.msg("[worker {0}] {1}".format(self.number, line))
+
+
+    def outReceived(self, data):
+        self._log(data)
+
+
+    def errReceived(self, data):
+        self._log(data)
+
+
+    def processEnded(self, reason):
+        self.ended.callback(None)
+        self._supervisor.workerEnded(self, reason)
+
+
+
+class WorkerSupervisor(Service, object):
+    """
+    Spawns worker processes that serve from listening sockets and restarts
+    them when they die.
+
+    A worker that keeps dying is restarted with an exponential backoff so
+    that it doesn't burn CPU and flood the log.
+
+    @ivar restartDelay: Seconds to wait before a dead worker is restarted
+        the first time.  It's doubled for each consecutive death.
+    @ivar maxRestartDelay: Upper bound for the delay.  A worker that has
+        been running for at least as long is restarted after
+        C{restartDelay} again.
+    """
+    restartDelay = 1
+    maxRestartDelay = 60
+
+    def __init__(self, reactor, workers, sockets, settingsPath=None,
+                 cacheSocket=None):
+        """
+        @param workers: Number of worker processes.
+        @param sockets: The listening sockets as C{(fileno, family)} tuples.
+        @param settingsPath: Path of a JSON file with the settings of the
+            workers or C{None} for the defaults.
+        @param cacheSocket: Path of the UNIX socket of a L{CacheServer} or
+            C{None} if each worker should cache on its own.
+        """
+        self._reactor = reactor
+        self._workers = workers
+        self._sockets = sockets
+        self._settingsPath = settingsPath
+        self._cacheSocket = cacheSocket
+        self._processes = {}
+        self._deaths = {}
+
+
+    def _spawn(self, number):
+        args = [sys.executable, "-m", "dane_doctor.workers"]
+        childFDs = {0: "w", 1: "r", 2: "r"}
+        for fileno, family in self._sockets:
+            args += ["--socket", "{0}:{1}".format(fileno, int(family))]
+            childFDs[fileno] = fileno
+        if self._settingsPath is not None:
+            args += ["--settings", self._settingsPath]
+        if self._cacheSocket is not None:
+            args += ["--cache", self._cacheSocket]
+        protocol = WorkerProcessProtocol(self, number,
+                                         self._reactor.seconds())
+        self._reactor.spawnProcess(
+            protocol, sys.executable, args=args, env=os.environ,
+            childFDs=childFDs,
+        )
+        self._processes[number] = protocol
+        log.msg("Started worker {0}.".format(number))
+
+
+    def signalWorkers(self, signalID):
+        """
+        Send I{signalID} to all running workers.
+        """
+        for protocol in self._processes.values():
+            try:
+                protocol.transport.signalProcess(signalID)
+            except ProcessExitedAlready:
+                pass
+
+
+    def workerEnded(self, protocol, reason):
+        """
+        Restart the worker that I{protocol} belongs to unless we're stopping.
+        """
+        if self._processes.get(protocol.number) is not protocol:
+            return
+        del self._processes[protocol.number]
+        if not self.running:
+            return
+        deaths = self._deaths.get(protocol.number, 0)
+        if self._reactor.seconds() - protocol.started >= self.maxRestartDelay:
+            deaths = 0
+        self._deaths[protocol.number] = deaths + 1
+        delay = min(self.restartDelay * 2 ** deaths, self.maxRestartDelay)
+        log.msg("Worker {0} died ({1}), restarting it in {2}s.".format(
+            protocol.number, reason.getErrorMessage(), delay,
+        ))
+        self._reactor.callLater(delay, self._restart, protocol.number)
+
+
+    def _restart(self, number):
+        if self.running and number not in self._processes:
+            self._spawn(number)
+
+
+    def startService(self):
+        Service.startService(self)
+        for number in range(self._workers):
+            self._spawn(number)
+
+
+    def stopService(self):
+        Service.stopService(self)
+        ended = [protocol.ended for protocol in self._processes.values()]
+        self.signalWorkers(signal.SIGTERM)
+        self._processes = {}
+        return defer.gatherResults(ended)
+
+
+
+class _ParentWatcher(Protocol):
+    """
+    Fires C{gone} once the parent closes our stdin, usually because it died.
+    """
+    def __init__(self):
+        self.gone = defer.Deferred()
+
+
+    def connectionLost(self, reason):
+        self.gone.callback(None)
+
+
+
+class WorkerOptions(usage.Options):
+    optParameters = [
+        ["settings", None, None, "JSON file with the settings."],
+        ["cache", None, None, "UNIX socket of the shared TLSA cache."],
+    ]
+
+    def __init__(self):
+        usage.Options.__init__(self)
+        self["sockets"] = []
+
+
+    def opt_socket(self, value):
+        """
+        A listening socket to adopt as FD:FAMILY.  May be repeated.
+        """
+        try:
+            fileno, family = (int(part) for part in value.split(":"))
+        except ValueError:
+            raise usage.UsageError("Expected FD:FAMILY, got {0!r}."
+                                   .format(value))
+        self["sockets"].append((fileno, family))
+
+
+    def postOptions(self):
+        if not self["sockets"]:
+            raise usage.UsageError("At least one --socket is required.")
+
+
+
+def _readSettings(path):
+    if path is None:
+        return config.DEFAULTS
+    with open(path) as f:
+        return json.load(f)
+
+
+
+@defer.inlineCallbacks
+def runWorker(reactor, options):
+    """
+    Serve from the listening sockets that have been passed by the parent
+    until the parent goes away.
+
+    On C{SIGHUP}, the settings file is read again and applied.
+    """
+    from .tap import makeRoot
+
+    log.startLogging(sys.stderr, setStdout=False)
+    if options["cache"] is not None:
+        cache = RemoteTLSACache(
+            UNIXClientEndpoint(reactor, options["cache"]), reactor
+        )
+        yield cache.whenConnected()
+        reactor.addSystemEventTrigger("before", "shutdown", cache.stop)
+        _resolver.setCache(cache)
+
+    factory = DaneDoctorFactory()
+
+    def reload():
+        try:
+            settings = _readSettings(options["settings"])
+        except (EnvironmentError, ValueError):
+            log.err(None, "Can't read settings, keeping the current ones.")
+        else:
+            config.applySettings(settings, reactor, factory)
+
+    reload()
+    signal.signal(
+        signal.SIGHUP, lambda *args: reactor.callFromThread(reload)
+    )
+
+    watcher = _ParentWatcher()
+    stdio.StandardIO(watcher, reactor=reactor)
+    site = Site(makeRoot(factory, reactor))
+    ports = [
+        reactor.adoptStreamPort(fileno, family, site)
+        for fileno, family in options["sockets"]
+    ]
+
+    def stopAccepting():
+        # The parent owns the sockets.  Closing them here would also remove
+        # the files of UNIX sockets that the parent and other workers use.
+        for port in ports:
+            port.stopReading()
+
+    reactor.addSystemEventTrigger("before", "shutdown", stopAccepting)
+    yield watcher.gone
+
+
+
+def main(argv=None):
+    options = WorkerOptions()
+    options.parseOptions(sys.argv[1:] if argv is None else argv)
+    task.react(runWorker, (options,))
+
+
+
+if __name__ == "__main__":
+    main()
@@ -7,58 +7,246 @@ from __future__ import absolute_import, division, print_function
 
 """
 eg danex full.cert.getdnsapi.net 443 tcp
+   danex --batch targets.txt --concurrency 200
+   danex --batch targets.txt --store scans.db --incremental
+   danex --all-addresses www.example.com 443 tcp
+   danex --mail example.com
+   danex --mail --batch domains.txt
 """
 
+import importlib.util
 import sys
 
-from twisted.internet import task, threads, defer
+from twisted.python import usage
 
-from . import _dane, _tls
 
+# The keys of danex._result.WRITERS.  Spelled out so that parsing the
+# command line doesn't import Twisted's networking, getdns and pyOpenSSL.
+FORMATS = ("csv", "jsonl", "msgpack", "text")
 
-def printResult(res):
-    (trusted, tlsaRecords), serverCertificate = res
-    numRecs = len(tlsaRecords)
-    print("{} TLSA record{} found.{}".format(
-        numRecs,
-        "s" if numRecs != 1 else "",
-        " (UNTRUSTED)" if numRecs and not trusted else "",
+
+class Options(usage.Options):
+    synopsis = ("Usage: danex [options] parent_domain port protocol\n"
+                "       danex [options] --mail mail_domain\n"
+                "       danex [options] --batch FILE")
+
+    optParameters = [
+        ["batch", "b", None,
+         "Check the 'host port proto' targets in FILE, one per line.  "
+         "'-' reads from stdin."],
+        ["concurrency", "c", 50,
+         "Maximum number of targets that are checked at once.  With --mail, "
+         "also the maximum number of MX hosts.", int],
+        ["timeout", "t", 60,
+         "Seconds after which a target is given up.", float],
+        ["format", "f", "text",
+         "Output format: " + ", ".join(FORMATS) + "."],
+        ["store", "s", None,
+         "Record the results of a batch in the SQLite database FILE."],
+        ["max-cert-age", None, 86400,
+         "With --incremental, retrieve certificates again after this many "
+         "seconds or if they expire within them.", float],
+        ["per-host", None, 4,
+         "With --all-addresses, maximum number of concurrent handshakes "
+         "with one host.", int],
+    ]
+
+    optFlags = [
+        ["incremental", "i",
+         "Reuse the results in the --store: only resolve expired TLSA "
+         "answers and only retrieve certificates that might have changed."],
+        ["all-addresses", "A",
+         "Retrieve the certificate chain from every IPv4 and IPv6 address "
+         "of the host and require all of them to match."],
+        ["trust-remote-resolvers", None,
+         "Trust the DNSSEC validation of DNS servers that aren't on the "
+         "loopback interface.  Only if the path to them is secure."],
+        ["mail", "m",
+         "Check mail domains instead of services: check the TLSA records "
+         "of every MX host on port 25 using STARTTLS.  In batch mode, FILE "
+         "contains one domain per line."],
+    ]
+
+    def parseArgs(self, *args):
+        if self["batch"] is not None:
+            if args:
+                raise usage.UsageError("No targets allowed with --batch.")
+        elif len(args) != (1 if self["mail"] else 3):
+            raise usage.UsageError("Wrong number of arguments.")
+        self["target"] = args
+
+    def postOptions(self):
+        if self["store"] is not None and self["batch"] is None:
+            raise usage.UsageError("--store requires --batch.")
+        if self["incremental"] and self["store"] is None:
+            raise usage.UsageError("--incremental requires --store.")
+        if self["all-addresses"] and self["store"] is not None:
+            raise usage.UsageError(
+                "--all-addresses can't be combined with --store."
+            )
+        if self["mail"] and self["store"] is not None:
+            raise usage.UsageError("--mail can't be combined with --store.")
+        if self["per-host"] < 1:
+            raise usage.UsageError("--per-host must be at least 1.")
+        if self["concurrency"] < 1:
+            raise usage.UsageError("--concurrency must be at least 1.")
+        if self["format"] not in FORMATS:
+            raise usage.UsageError(
+                "Unknown format {0!r}.".format(self["format"])
+            )
+        if (self["format"] == "msgpack"
+                and importlib.util.find_spec("msgpack") is None):
+            raise usage.UsageError(
+                "The msgpack format requires the msgpack package."
+            )
+        # Open the batch file last so that it isn't leaked if another
+        # option is invalid.
+        if self["batch"] == "-":
+            self["batch-file"] = sys.stdin
+        elif self["batch"] is not None:
+            try:
+                self["batch-file"] = open(self["batch"])
+            except EnvironmentError as e:
+                raise usage.UsageError("Can't read {0!r}: {1}.".format(
+                    self["batch"], e.strerror
+                ))
+
+
+def _makeWriter(options, headers):
+    from . import _result
+    writerType = _result.WRITERS[options["format"]]
+    if writerType is _result.TextWriter:
+        return writerType(sys.stdout, headers=headers)
+    if writerType is _result.CSVWriter:
+        return writerType(sys.stdout, mail=options["mail"])
+    return writerType(sys.stdout)
+
+
+def _mailChecker(reactor, options):
+    from ._mail import MailChecker
+    return MailChecker(
+        reactor=reactor, timeout=options["timeout"],
+        allAddresses=options["all-addresses"],
+        maxPerHost=options["per-host"],
+        maxConcurrent=options["concurrency"],
+    )
+
+
+def _report(result, writer):
+    """
+    Write I{result} and exit with status 1 if the check failed.
+    """
+    writer.write(result)
+    if result.error is not None:
+        raise SystemExit(1)
+
+
+def _main(reactor, options):
+    from . import _check, _result
+    target = options["target"]
+    writer = _makeWriter(options, headers=False)
+    if options["mail"]:
+        d = _mailChecker(reactor, options).check(target[0])
+        d.addBoth(lambda res: _report(
+            _result.MailResult.fromCheck(target, res), writer
+        ))
+        return d
+
+    d = _check.checkTarget(*target, timeout=options["timeout"],
+                           reactor=reactor,
+                           allAddresses=options["all-addresses"],
+                           maxPerHost=options["per-host"])
+    d.addBoth(lambda res: _report(
+        _result.CheckResult.fromCheck(target, res), writer
     ))
+    return d
 
-    hasInvalid = False
-    for tlsa in tlsaRecords:
-        if not tlsa.valid:
-            hasInvalid = True
-        print(tlsa)
 
-    print()
-    if hasInvalid:
-        print(
-            "INVALID TLSA records received."
-        )
-    elif tlsa.matchesCertificate(serverCertificate):
-        print(
-            "The server-sent certificate matches at least one of the TLSA "
-            "records."
-        )
+def _batch(reactor, options):
+    from . import _check, _result
+    lines = options["batch-file"]
+
+    def close(res):
+        if lines is not sys.stdin:
+            lines.close()
+        return res
+
+    writer = _makeWriter(options, headers=True)
+    if options["mail"]:
+        from ._mail import parseDomains
+        targets = parseDomains(lines)
+        resultType = _result.MailResult
     else:
-        print("The server-sent certificate did NOT match any TLSA record.")
+        targets = _check.parseTargets(lines)
+        resultType = _result.CheckResult
+
+    def report(target, res):
+        writer.write(resultType.fromCheck(target, res))
 
+    check = None
+    if options["mail"]:
+        mailChecker = _mailChecker(reactor, options)
+        check = mailChecker.check
+    elif options["store"] is not None:
+        from ._store import IncrementalChecker, ScanStore
+        store = ScanStore(options["store"])
+        checker = IncrementalChecker(
+            store, reactor=reactor, incremental=options["incremental"],
+            maxCertAge=options["max-cert-age"], timeout=options["timeout"],
+        )
+        check = checker.check
+    elif options["all-addresses"]:
+        def check(host, port, proto):
+            return _check.checkTarget(
+                host, port, proto, timeout=options["timeout"],
+                reactor=reactor, allAddresses=True,
+                maxPerHost=options["per-host"],
+            )
 
-def _main(reactor, parent_domain, port, proto):
-    d = defer.gatherResults([
-        threads.deferToThread(
-            _dane.lookup_tlsa_records, parent_domain, port, proto
-        ),
-        _tls.retrieveCertificate(parent_domain, port)
-    ])
-    d.addCallback(printResult)
+    d = _check.checkTargets(
+        targets, report,
+        concurrency=options["concurrency"], timeout=options["timeout"],
+        reactor=reactor, check=check,
+    )
+    d.addBoth(close)
+    if options["store"] is not None:
+        d.addBoth(_closeStore, store, checker)
+    if options["mail"]:
+        d.addBoth(_mailSummary, mailChecker)
     return d
 
 
+def _mailSummary(res, checker):
+    sys.stderr.write(
+        "{0} MX hosts checked, {1} shared between domains.\n".format(
+            checker.checked, checker.deduplicated
+        )
+    )
+    return res
+
+
+def _closeStore(res, store, checker):
+    store.close()
+    sys.stderr.write(
+        "{0} TLSA lookups, {1} handshakes, {2} results reused.\n".format(
+            checker.resolved, checker.handshakes, checker.reused
+        )
+    )
+    return res
+
+
 def main():
-    if len(sys.argv) != 4:
-        print("Usage: {0} parent_domain port protocol".format(sys.argv[0]))
+    options = Options()
+    try:
+        options.parseOptions(sys.argv[1:])
+    except usage.UsageError as e:
+        print("{0}\n\n{1}".format(options, e))
         sys.exit(1)
 
-    task.react(_main, sys.argv[1:])
+    from twisted.internet import task
+    from ._resolver import getResolver
+    getResolver().trustRemote = bool(options["trust-remote-resolvers"])
+    if options["batch"] is not None:
+        task.react(_batch, [options])
+    else:
+        task.react(_main, [options])
@@ -0,0 +1,119 @@
+# -*- test-case-name: danex.test.test_cache -*-
+# Copyright (c) Hynek Schlawack, Richard Wall
+# See LICENSE for details.
+
+from __future__ import absolute_import, division, print_function
+
+from collections import OrderedDict
+
+from twisted.internet import defer
+
+from ._dane import GetdnsResponseError
+
+
+class TLSACache(object):
+    """
+    An LRU cache of TLSA lookup results that honours the TTLs of the answers.
+
+    Negative answers are cached too if the resolver reports for how long.
+    Concurrent lookups of a name that isn't cached are coalesced into a
+    single resolution.
+
+    @ivar hits: Number of lookups answered from the cache.
+    @ivar misses: Number of lookups that started a resolution.
+    @ivar coalesced: Number of lookups that waited for a resolution already
+        in progress.
+    """
+    def __init__(self, resolve, clock, maxSize=4096, maxTTL=86400):
+        """
+        @param resolve: Called with a TLSA domain name.  Must return a
+            L{defer.Deferred} that fires with a tuple of whether the answer
+            is trusted, a list of L{TLSARecord}s and the answer's TTL or
+            fails with a L{GetdnsResponseError} whose C{ttl} is set if the
+            negative answer may be cached.
+        @param clock: An L{IReactorTime} provider.
+        @param maxSize: Maximum number of cached names.
+        @param maxTTL: Upper bound for the time an answer is kept.
+        """
+        self._resolve = resolve
+        self._clock = clock
+        self.maxSize = maxSize
+        self.maxTTL = maxTTL
+        self._entries = OrderedDict()
+        self._waiting = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+
+    def __len__(self):
+        return len(self._entries)
+
+
+    def lookup(self, name):
+        """
+        Look up the TLSA records at I{name}.
+
+        @param name: A TLSA domain name as returned by L{tlsaDomainName}.
+
+        @rtype: L{defer.Deferred} that fires with a tuple of whether the
+            answer is trusted and a list of L{TLSARecord}s.  Each caller gets
+            its own list.
+        """
+        try:
+            expires, result = self._entries.pop(name)
+        except KeyError:
+            pass
+        else:
+            if expires > self._clock.seconds():
+                self._entries[name] = expires, result
+                self.hits += 1
+                if isinstance(result, GetdnsResponseError):
+                    return defer.fail(result)
+                trusted, records = result
+                return defer.succeed((trusted, list(records)))
+
+        d = defer.Deferred()
+        if name in self._waiting:
+            self.coalesced += 1
+            self._waiting[name].append(d)
+            return d
+
+        self.misses += 1
+        self._waiting[name] = [d]
+        self._resolve(name).addCallbacks(
+            self._resolved, self._failed,
+            callbackArgs=(name,), errbackArgs=(name,),
+        )
+        return d
+
+
+    def _resolved(self, res, name):
+        trusted, records, ttl = res
+        records = tuple(records)
+        self._store(name, (trusted, records), ttl)
+        for d in self._waiting.pop(name):
+            d.callback((trusted, list(records)))
+
+
+    def _failed(self, failure, name):
+        if failure.check(GetdnsResponseError):
+            self._store(name, failure.value, failure.value.ttl)
+        for d in self._waiting.pop(name):
+            d.errback(failure)
+
+
+    def _store(self, name, result, ttl):
+        if not ttl or self.maxSize <= 0:
+            return
+        ttl = min(ttl, self.maxTTL)
+        self._entries[name] = self._clock.seconds() + ttl, result
+        while len(self._entries) > self.maxSize:
+            self._entries.popitem(last=False)
+
+
+    def clear(self):
+        """
+        Forget all cached results.
+        """
+        self._entries.clear()
@@ -0,0 +1,201 @@
+# -*- test-case-name: danex.test.test_check -*-
+# Copyright (c) Hynek Schlawack, Richard Wall
+# See LICENSE for details.
+
+from __future__ import absolute_import, division, print_function
+
+from twisted.internet import defer, task
+from twisted.python import log
+from twisted.python.failure import Failure
+
+from . import _metrics, _resolver, _tls
+from ._dane import GetdnsResponseError
+
+
+def checkTarget(host, port, proto, timeout=None, reactor=None,
+                connectTimeout=10, handshakeTimeout=10, allAddresses=False,
+                maxPerHost=4, starttls=None, resume=False):
+    """
+    Look up the TLSA records of a service and retrieve its certificate chain
+    concurrently.
+
+    @param host: The host name of the service.
+    @param port: The port of the service.
+    @param proto: The IP protocol of the service.
+    @param timeout: Seconds after which the check is given up.  C{None} for
+        no limit besides the DNS and TLS timeouts.
+    @param reactor: The reactor to use.  If C{None}, the global reactor is
+        used.
+    @param connectTimeout: Seconds to wait for the TCP connection.
+    @param handshakeTimeout: Seconds to wait for the TLS handshake.
+    @param allAddresses: Whether to retrieve the certificate chain from
+        every address of I{host} instead of only the first one that
+        answers.
+    @param maxPerHost: Maximum number of concurrent handshakes with I{host}
+        if I{allAddresses} is true.
+    @param starttls: The application protocol to start TLS with, see
+        L{danex._tls.retrieveCertificateChain}.
+    @param resume: Whether to resume TLS sessions, see
+        L{danex._tls.retrieveCertificateChain}.  Sessions are only resumed
+        if the TLSA RRset is the same as when they have been established,
+        so the TLSA records are looked up before connecting.
+
+    @rtype: L{defer.Deferred} that fires with a tuple of the TLSA lookup
+        result and the certificate chain.  If I{allAddresses} is true, a
+        list of C{(address, chain)} tuples as returned by
+        L{danex._tls.retrieveCertificateChains} is added and the chain is
+        the one of the first address that presented one.
+    """
+    if reactor is None:
+        from twisted.internet import reactor
+
+    def retrieve(sessionTag):
+        kw = dict(
+            reactor=reactor, connectTimeout=connectTimeout,
+            handshakeTimeout=handshakeTimeout, starttls=starttls,
+            resume=resume, sessionTag=sessionTag,
+        )
+        if allAddresses:
+            tls = _tls.retrieveCertificateChains(
+                host, port, maxConcurrent=maxPerHost, **kw
+            )
+            return tls.addCallback(_firstChain)
+        tls = _tls.retrieveCertificateChain(host, port, **kw)
+        return tls.addCallback(lambda chain: (chain,))
+
+    lookup = _resolver.lookupTLSARecords(host, port, proto)
+    if resume:
+        def lookedUp(res):
+            tls = retrieve(rrsetTag(res[1]))
+            return tls.addCallback(lambda tlsRes: (res,) + tlsRes)
+
+        d = lookup.addCallback(lookedUp)
+    else:
+        d = defer.gatherResults([lookup, retrieve(None)], consumeErrors=True)
+        d.addCallback(lambda res: (res[0],) + res[1])
+        d.addErrback(
+            lambda f: f.value.subFailure if f.check(defer.FirstError) else f
+        )
+    if timeout is not None:
+        d.addTimeout(timeout, reactor)
+    d.addBoth(_countOutcome)
+    return d
+
+
+def rrsetTag(records):
+    """
+    Return a value that identifies the TLSA RRset I{records} regardless of
+    the order of the records.
+
+    @rtype: L{frozenset}
+    """
+    return frozenset(
+        (record.rawValues(), record.payload) for record in records
+    )
+
+
+def _firstChain(endpoints):
+    """
+    Return the first chain of I{endpoints} together with all of them or
+    fail like the first one if none presented a chain.
+    """
+    for _, chain in endpoints:
+        if not isinstance(chain, Failure):
+            return chain, endpoints
+    return endpoints[0][1]
+
+
+def outcome(result):
+    """
+    Return a label for the outcome of a check.
+
+    Anything but C{"ok"} is the C{errorText} of a L{GetdnsResponseError} or
+    the name of the exception type, so the number of distinct labels stays
+    small.
+
+    @param result: What L{checkTarget} fired with.
+    @rtype: L{str}
+    """
+    if not isinstance(result, Failure):
+        return "ok"
+    if result.check(GetdnsResponseError):
+        return result.value.errorText or str(result.value.errorCode)
+    return result.type.__name__
+
+
+def _countOutcome(result):
+    if _metrics.REGISTRY.enabled:
+        _metrics.CHECK_OUTCOMES.inc(outcome(result))
+    return result
+
+
+def parseTargets(lines):
+    """
+    Parse one C{host port proto} target per line.
+
+    Empty lines and lines starting with C{#} are skipped.
+
+    @param lines: An iterable of L{str}.
+
+    @return: An iterator of C{(target, error)} tuples.  C{target} is the
+        C{(host, port, proto)} tuple or the offending line if it can't be
+        parsed in which case C{error} is a L{ValueError}.
+    """
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        parts = line.split()
+        if len(parts) != 3 or not parts[1].isdigit():
+            yield line, ValueError("Expected 'host port proto'.")
+            continue
+        yield (parts[0], int(parts[1]), parts[2]), None
+
+
+def checkTargets(targets, report, concurrency=50, timeout=None,
+                 reactor=None, cooperator=task, check=None):
+    """
+    Check I{targets} with at most I{concurrency} checks in flight.
+
+    I{targets} is consumed lazily and nothing is kept after I{report} has
+    been called, so memory use doesn't depend on the number of targets.
+
+    @param targets: An iterable as returned by L{parseTargets}.
+    @param report: Called with each target and either its result or a
+        L{twisted.python.failure.Failure} as soon as it is done.  If it
+        raises, the exception is logged and the remaining targets are still
+        checked.
+    @param concurrency: Maximum number of concurrent checks.
+    @param timeout: Per-target timeout in seconds.
+    @param cooperator: The L{task.Cooperator} to schedule the checks with.
+        For testing purposes.
+    @param check: Called with the host, port and proto of each target
+        instead of L{checkTarget}.  Must return a L{defer.Deferred} that
+        fires like L{checkTarget}'s.
+
+    @rtype: L{defer.Deferred} that fires once all targets have been checked.
+    """
+    def safeReport(target, res):
+        try:
+            report(target, res)
+        except Exception:
+            log.err(None, "Couldn't report the result of {0!r}.".format(
+                target
+            ))
+
+    def work():
+        for target, error in targets:
+            if error is not None:
+                safeReport(target, Failure(error))
+                continue
+            if check is None:
+                d = checkTarget(*target, timeout=timeout, reactor=reactor)
+            else:
+                d = check(*target)
+            d.addBoth(lambda res, target=target: safeReport(target, res))
+            yield d
+
+    iterator = work()
+    return defer.DeferredList([
+        cooperator.coiterate(iterator) for _ in range(concurrency)
+    ])
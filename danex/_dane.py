@@ -4,6 +4,7 @@
 
 from __future__ import absolute_import, division, print_function
 
+import array
 import hashlib
 
 import getdns
@@ -12,6 +13,8 @@ from OpenSSL import crypto
 from twisted.python.constants import ValueConstant, Values
 from twisted.python.util import FancyStrMixin
 
+from . import _metrics
+from ._pool import contextPoolFor
 from ._x509 import extractPublicKey
 
 
@@ -32,16 +35,42 @@ class GetdnsResponseError(FancyStrMixin, Exception):
     """
     showAttributes = ('errorCode', 'errorText')
 
-    def __init__(self, errorCode):
+    def __init__(self, errorCode, ttl=None):
+        """
+        @param errorCode: The getdns response status.
+        @param ttl: For how many seconds the negative answer may be cached,
+            C{None} if it mustn't.
+        """
         self.errorCode = errorCode
+        self.ttl = ttl
 
 
     @property
     def errorText(self):
+        """
+        The name of the C{GETDNS_RESPSTATUS_*} constant of C{errorCode} or
+        C{None}.
+        """
+        return _responseStatusNames().get(self.errorCode)
+
+
+
+_statusNames = None
+
+
+def _responseStatusNames():
+    """
+    Return a dict that maps getdns response statuses to the names of their
+    constants.  It's built on first use.
+    """
+    global _statusNames
+    if _statusNames is None:
+        names = {}
         for k, v in getdns.__dict__.items():
             if k.startswith('GETDNS_RESPSTATUS_'):
-                if getattr(getdns, k) == self.errorCode:
-                    return k
+                names.setdefault(v, k)
+        _statusNames = names
+    return _statusNames
 
 
 class USAGE(Values):
@@ -80,86 +109,462 @@ MATCHING_TYPE_MAP = {
 }
 
 
-class TLSARecord(FancyStrMixin, object):
+_USAGES = dict((c.value, c) for c in USAGE.iterconstants())
+_SELECTORS = dict((c.value, c) for c in SELECTOR.iterconstants())
+_MATCHING_TYPES = dict((c.value, c) for c in MATCHING_TYPE.iterconstants())
+
+_FIELDS = (
+    ("usage", _USAGES, USAGE.INVALID),
+    ("selector", _SELECTORS, SELECTOR.INVALID),
+    ("matchingType", _MATCHING_TYPES, MATCHING_TYPE.INVALID),
+)
+
+
+
+class TLSARecord(object):
+    """
+    An immutable TLSA record.
+
+    Fields with values that aren't defined are set to the respective
+    C{INVALID} constant and the record isn't valid.  Only invalid records
+    carry an C{errors} dict.
+    """
+    __slots__ = ("payload", "usage", "selector", "matchingType", "_errors")
+
     showAttributes = ('usage', 'selector', 'matchingType', 'valid', 'errors')
-    valid = True
 
     def __init__(self, payload, usage, selector, matchingType):
-        self.errors = {}
-        self.payload = bytes(payload)
+        errors = None
+        values = []
+        for (field, table, invalid), value in zip(
+                _FIELDS, (usage, selector, matchingType)):
+            constant = table.get(value, invalid)
+            if constant is invalid:
+                if errors is None:
+                    errors = {}
+                errors[field] = [("Invalid parameter", value)]
+            values.append(constant)
 
-        try:
-            self.usage = USAGE.lookupByValue(usage)
-        except ValueError:
-            self.usage = USAGE.INVALID
-            self.errors['usage'] = [
-                ("Invalid parameter", usage)
-            ]
-            self.valid = False
-        try:
-            self.selector = SELECTOR.lookupByValue(selector)
-            self._select = SELECTOR_MAP[self.selector]
-        except ValueError:
-            self.selector = SELECTOR.INVALID
-            self.errors['selector'] = [
-                ("Invalid parameter", selector)
-            ]
-            self.valid = False
-        try:
-            self.matchingType = MATCHING_TYPE.lookupByValue(matchingType)
-            self._transform = MATCHING_TYPE_MAP[self.matchingType]
-        except ValueError:
-            self.matchingType = MATCHING_TYPE.INVALID
-            self.errors['matchingType'] = [
-                ("Invalid parameter", matchingType),
-            ]
-        self.valid = self.errors == {}
+        setattr_ = object.__setattr__
+        setattr_(self, "payload", bytes(payload))
+        setattr_(self, "usage", values[0])
+        setattr_(self, "selector", values[1])
+        setattr_(self, "matchingType", values[2])
+        setattr_(self, "_errors", errors)
+
+
+    def __setattr__(self, name, value):
+        raise AttributeError("TLSARecord is immutable.")
+
+
+    def __delattr__(self, name):
+        raise AttributeError("TLSARecord is immutable.")
+
+
+    def __repr__(self):
+        return "<TLSARecord" + "".join(
+            " {0}={1!r}".format(attr, getattr(self, attr))
+            for attr in self.showAttributes
+        ) + ">"
+
+    __str__ = __repr__
+
+
+    @property
+    def valid(self):
+        return self._errors is None
+
+
+    @property
+    def errors(self):
+        """
+        The invalid fields mapped to a list of C{(message, value)} tuples.
+
+        A new, empty dict for valid records.
+        """
+        if self._errors is None:
+            return {}
+        return dict((k, list(v)) for k, v in self._errors.items())
+
+
+    def rawValues(self):
+        """
+        Return the usage, selector and matching type as they have been
+        passed, even if they're invalid.
+
+        @rtype: L{tuple} of L{int}
+        """
+        errors = self._errors or {}
+        return tuple(
+            errors[field][0][1] if field in errors
+            else getattr(self, field).value
+            for field, _, _ in _FIELDS
+        )
 
 
     def matchesCertificate(self, cert):
         """
-        @type cert: x509
+        @param cert: The certificate to match or its fingerprints if it is
+            matched more than once.
+        @type cert: x509 or L{CertificateFingerprints}
 
         @rtype: bool
         """
         if not self.valid:
             raise ValueError("Can't match invalid record.")
-        return self.payload == self._transform(self._select(cert))
+        if not isinstance(cert, CertificateFingerprints):
+            cert = CertificateFingerprints(cert)
+        return self.payload == cert.digest(self.selector, self.matchingType)
 
 
 
-def lookup_tlsa_records(parentDomain, port, proto, getdns=getdns):
+class TLSARecordBatch(object):
     """
-    Lookup a TLSA record and return a TLSA type depending on the TLSA
-    selector type in the record.
+    Many TLSA records packed into a few arrays, for keeping whole scan
+    results in memory.
 
-    @see: U{http://tools.ietf.org/html/draft-ietf-dane-registry-acronyms-01#section-2.2}
+    Each record takes four bytes for its offset and three for its fields
+    plus the payload itself.  L{TLSARecord}s are created only when records
+    are accessed.  Payloads may add up to 4 GiB.
+    """
+    def __init__(self):
+        self._fields = array.array("B")
+        self._offsets = array.array("I", [0])
+        self._payloads = bytearray()
 
-    @param parentDomain: The domain with which the TLSA record is associated.
-    @param port: The port number with which the TLSA record is associated.
-    @param proto: The IP protocol with which the TLSA record is associated.
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+
+    def append(self, usage, selector, matchingType, payload):
+        """
+        Add a record.
+
+        @param usage: The usage as an integer between 0 and 255.
+        @param selector: The selector as an integer between 0 and 255.
+        @param matchingType: The matching type as an integer between 0 and
+            255.
+        @type payload: L{bytes}
+
+        @return: The index of the record.
+        @rtype: L{int}
+
+        @raises OverflowError: If a field isn't between 0 and 255 or the
+            payloads would exceed 4 GiB.  The batch is left unchanged.
+        """
+        # Validate everything before touching the arrays so that they stay
+        # in step.
+        fields = array.array("B", (usage, selector, matchingType))
+        end = len(self._payloads) + len(payload)
+        if end >= 1 << (8 * self._offsets.itemsize):
+            raise OverflowError("TLSA payloads exceed the batch's size.")
+        index = len(self)
+        self._fields.extend(fields)
+        self._payloads += payload
+        self._offsets.append(end)
+        return index
+
+
+    def extend(self, records):
+        """
+        Add L{TLSARecord}s.
+
+        Either all records are added or, if one of them can't be, none.
+
+        @return: The indexes of the first and behind the last added record,
+            suitable for L{records}.
+        @rtype: L{tuple}
+
+        @raises OverflowError: Like L{append}.
+        """
+        start = len(self)
+        try:
+            for record in records:
+                self.append(*record.rawValues() + (record.payload,))
+        except Exception:
+            del self._payloads[self._offsets[start]:]
+            del self._offsets[start + 1:]
+            del self._fields[3 * start:]
+            raise
+        return start, len(self)
+
+
+    def payload(self, index):
+        """
+        Return the payload of the record at I{index}.
+
+        @rtype: L{bytes}
+        """
+        return bytes(self._payloads[
+            self._offsets[index]:self._offsets[index + 1]
+        ])
+
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        usage, selector, matchingType = self._fields[3 * index:3 * index + 3]
+        return TLSARecord(self.payload(index), usage, selector, matchingType)
+
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+    def records(self, start, stop):
+        """
+        Return the records from I{start} up to I{stop}.
+
+        @rtype: L{list} of L{TLSARecord}
+        """
+        return [self[i] for i in range(start, stop)]
+
+
+
+class CertificateFingerprints(object):
+    """
+    The selector and matching type outputs of a certificate.
+
+    Each of the six (selector, matching type) combinations is computed on
+    first use and then remembered.
+
+    @ivar certificate: The certificate.
+    @type certificate: x509
+    """
+    def __init__(self, certificate):
+        self.certificate = certificate
+        self._selected = {}
+        self._digests = {}
+
+
+    def selected(self, selector):
+        """
+        Return the part of the certificate that I{selector} refers to.
+
+        @type selector: L{SELECTOR}
+
+        @rtype: L{bytes}
+        """
+        try:
+            return self._selected[selector]
+        except KeyError:
+            rv = self._selected[selector] = SELECTOR_MAP[selector](
+                self.certificate
+            )
+            return rv
+
+
+    @property
+    def spki(self):
+        """
+        The DER-encoded SubjectPublicKeyInfo of the certificate.
+
+        @rtype: L{bytes}
+        """
+        return self.selected(SELECTOR.SPKI)
+
+
+    def digest(self, selector, matchingType):
+        """
+        Return the certificate association data that a record with
+        I{selector} and I{matchingType} must contain to match.
+
+        @type selector: L{SELECTOR}
+        @type matchingType: L{MATCHING_TYPE}
+
+        @rtype: L{bytes}
+        """
+        key = (selector, matchingType)
+        try:
+            return self._digests[key]
+        except KeyError:
+            rv = self._digests[key] = MATCHING_TYPE_MAP[matchingType](
+                self.selected(selector)
+            )
+            return rv
+
+
+    def matchRecords(self, records):
+        """
+        Match a whole RRset against the certificate.
+
+        Only the (selector, matching type) combinations that the records use
+        are computed.  Each record is then a set lookup.
+
+        @type records: L{list} of L{TLSARecord}
+
+        @return: Whether the respective record matches.  Invalid records
+            never match.
+        @rtype: L{list} of L{bool}
+        """
+        records = [
+            (record.selector, record.matchingType, record.payload)
+            if record.valid else None
+            for record in records
+        ]
+        digests = frozenset(
+            (selector, matchingType, self.digest(selector, matchingType))
+            for selector, matchingType in set(
+                key[:2] for key in records if key is not None
+            )
+        )
+        return [key in digests for key in records]
+
+
+
+TRUST_ANCHOR_USAGES = frozenset([USAGE.PKIX_TA, USAGE.DANE_TA])
+
+
+def matchChain(records, chain):
+    """
+    Match each record against the certificates of I{chain} its usage refers
+    to: the end entity certificate for PKIX-EE and DANE-EE, any of the
+    issuing certificates for PKIX-TA and DANE-TA.
+
+    The selector and matching type of each certificate is computed only once,
+    no matter how many records use them.
+
+    PKIX-TA and PKIX-EE records additionally require the chain to pass PKIX
+    validation which is not checked here.
+
+    @param records: The TLSA records to check.
+    @type records: L{list} of L{TLSARecord}
+
+    @param chain: The certificates presented by the server, end entity
+        certificate first.  Fingerprints may be passed instead of
+        certificates if they're matched more than once.
+    @type chain: L{list} of x509 or L{CertificateFingerprints}
+
+    @return: Whether the respective record matches.  Invalid records never
+        match.
+    @rtype: L{list} of L{bool}
+    """
+    timer = _metrics.MATCH_TIME.time()
+    chain = [
+        c if isinstance(c, CertificateFingerprints)
+        else CertificateFingerprints(c)
+        for c in chain
+    ]
+    rv = [False] * len(records)
+    if not chain:
+        return timer.stop(rv)
+
+    ee, ta = [], []
+    for i, record in enumerate(records):
+        (ta if record.usage in TRUST_ANCHOR_USAGES else ee).append(i)
+
+    for i, match in zip(ee, chain[0].matchRecords([records[i] for i in ee])):
+        rv[i] = match
+    taRecords = [records[i] for i in ta]
+    for fingerprints in chain[1:]:
+        for i, match in zip(ta, fingerprints.matchRecords(taRecords)):
+            rv[i] = rv[i] or match
+    return timer.stop(rv)
+
+
+
+def answerTTL(results):
+    """
+    Return the minimum TTL of all answers in a getdns response.
+
+    @param results: A getdns response dict.
+
+    @rtype: int or None
+    """
+    ttls = [
+        answer["ttl"]
+        for reply in results.get("replies_tree", [])
+        for answer in reply.get("answer", [])
+        if "ttl" in answer
+    ]
+    return min(ttls) if ttls else None
+
+
+def negativeTTL(results, getdns=getdns):
+    """
+    Return for how long a negative getdns response may be cached.
+
+    @see: U{https://tools.ietf.org/html/rfc2308#section-5}
+
+    @param results: A getdns response dict.
+
+    @return: The lesser of the TTL and the minimum field of the SOA record in
+        the authority section or C{None} if there is no SOA record.
+    @rtype: int or None
+    """
+    ttls = [
+        min(rr["ttl"], rr["rdata"]["minimum"])
+        for reply in results.get("replies_tree", [])
+        for rr in reply.get("authority", [])
+        if rr["type"] == getdns.GETDNS_RRTYPE_SOA
+    ]
+    return min(ttls) if ttls else None
+
+
+def queryTLSA(name, getdns=getdns, pool=None):
+    """
+    Look up the TLSA records at I{name}.
+
+    @param name: A TLSA domain name as returned by L{tlsaDomainName}.
     @param getdns: An optional getdnsapi object. For testing purposes.
+    @param pool: The L{ContextPool} to take the getdns context from.  If
+        C{None}, the shared pool for I{getdns} is used.
 
-    @returns: A list of TLSA record instances corresponding to the selector
-        type of the record.
+    @return: Whether the answer is DNSSEC-validated, a list of
+        L{TLSARecord}s and for how many seconds the answer may be cached.
+    @rtype: L{tuple}
+
+    @raises GetdnsResponseError: If the response status isn't GOOD.  A
+        bogus answer or a response without replies is reported as
+        C{GETDNS_RESPSTATUS_ALL_BOGUS_ANSWERS}, like the Twisted resolver
+        does if a validating resolver answers with SERVFAIL.
     """
-    ctx = getdns.context_create()
+    if pool is None:
+        pool = contextPoolFor(getdns)
+    # Only ask for the validation status: the context validates against the
+    # DNSKEY and DS RRsets in its cache, which honours their TTLs and
+    # signature expiry.  Asking for the validation chain would copy the
+    # whole chain of every answer into the response without us using it.
+    # Without dnssec_return_all_statuses, getdns drops bogus replies and
+    # leaves us with an empty replies_tree.
     extensions = {
         "return_both_v4_and_v6": getdns.GETDNS_EXTENSION_TRUE,
-        "dnssec_return_validation_chain": getdns.GETDNS_EXTENSION_TRUE,
+        "dnssec_return_status": getdns.GETDNS_EXTENSION_TRUE,
+        "dnssec_return_all_statuses": getdns.GETDNS_EXTENSION_TRUE,
     }
-    results = getdns.general(ctx,
-                             request_type=getdns.GETDNS_RRTYPE_TLSA,
-                             name=tlsaDomainName(parentDomain, port, proto),
-                             extensions=extensions)
+    with pool.context() as ctx, _metrics.DNS_LATENCY.time():
+        results = getdns.general(ctx,
+                                 request_type=getdns.GETDNS_RRTYPE_TLSA,
+                                 name=name,
+                                 extensions=extensions)
+    return tlsaFromResults(results, getdns)
 
+
+def tlsaFromResults(results, getdns=getdns):
+    """
+    Extract the result of a TLSA lookup from a getdns response.
+
+    @param results: A getdns response dict.
+    @param getdns: The getdns API that produced I{results}.
+
+    @return: Like L{queryTLSA}.
+    @raises GetdnsResponseError: Like L{queryTLSA}.
+    """
     if results["status"] == getdns.GETDNS_RESPSTATUS_GOOD:
+        replies = results.get('replies_tree')
+        if (not replies
+                or replies[0].get('dnssec_status')
+                == getdns.GETDNS_DNSSEC_BOGUS):
+            raise GetdnsResponseError(
+                getdns.GETDNS_RESPSTATUS_ALL_BOGUS_ANSWERS
+            )
         rv = []
-        trusted = (
-            results['replies_tree'][0]['dnssec_status']
-            == getdns.GETDNS_DNSSEC_SECURE
-        )
-        for answer in results['replies_tree'][0]['answer']:
+        trusted = replies[0]['dnssec_status'] == getdns.GETDNS_DNSSEC_SECURE
+        for answer in replies[0]['answer']:
             if answer["type"] != getdns.GETDNS_RRTYPE_TLSA:
                 continue
             rdata = answer['rdata']
@@ -172,6 +577,29 @@ def lookup_tlsa_records(parentDomain, port, proto, getdns=getdns):
                 ))
             except ValueError as e:
                 rv.append(InvalidTLSARecord(e.args[0]))
-        return trusted, rv
+        return trusted, rv, answerTTL(results)
+
+    raise GetdnsResponseError(results['status'], negativeTTL(results, getdns))
+
+
+def lookup_tlsa_records(parentDomain, port, proto, getdns=getdns, pool=None):
+    """
+    Lookup a TLSA record and return a TLSA type depending on the TLSA
+    selector type in the record.
 
-    raise GetdnsResponseError(results['status'])
+    @see: U{http://tools.ietf.org/html/draft-ietf-dane-registry-acronyms-01#section-2.2}
+
+    @param parentDomain: The domain with which the TLSA record is associated.
+    @param port: The port number with which the TLSA record is associated.
+    @param proto: The IP protocol with which the TLSA record is associated.
+    @param getdns: An optional getdnsapi object. For testing purposes.
+    @param pool: The L{ContextPool} to take the getdns context from.  If
+        C{None}, the shared pool for I{getdns} is used.
+
+    @returns: A list of TLSA record instances corresponding to the selector
+        type of the record.
+    """
+    trusted, rv, _ = queryTLSA(
+        tlsaDomainName(parentDomain, port, proto), getdns, pool
+    )
+    return trusted, rv
@@ -0,0 +1,180 @@
+# -*- test-case-name: danex.test.test_mail -*-
+# Copyright (c) Hynek Schlawack, Richard Wall
+# See LICENSE for details.
+
+"""
+Checks of mail domains: DANE for SMTP as described in RFC 7672.
+
+The TLSA records of a mail domain are those of its MX hosts at
+C{_25._tcp.<mx host>} and the certificates are retrieved using STARTTLS.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+from collections import OrderedDict
+from functools import partial
+
+from twisted.internet import defer
+from twisted.python.failure import Failure
+
+from . import _check, _resolver
+
+
+SMTP_PORT = 25
+
+
+class NullMXError(Exception):
+    """
+    The domain has a null MX record and doesn't accept mail.
+    """
+    def __str__(self):
+        return "The domain doesn't accept mail (null MX)."
+
+
+
+def parseDomains(lines):
+    """
+    Parse one mail domain per line.
+
+    Empty lines and lines starting with C{#} are skipped.
+
+    @param lines: An iterable of L{str}.
+
+    @return: An iterator of C{(target, error)} tuples like
+        L{danex._check.parseTargets}.  C{target} is a C{(domain,)} tuple or
+        the offending line.
+    """
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        if len(line.split()) != 1:
+            yield line, ValueError("Expected a mail domain.")
+            continue
+        yield (line,), None
+
+
+
+class MailChecker(object):
+    """
+    Checks mail domains by checking all of their MX hosts concurrently.
+
+    An MX host that several domains share is checked only once while its
+    check runs, and its result is reused for later domains as long as it's
+    among the C{maxSize} most recently used ones.  Failures aren't reused,
+    so a transient error doesn't spread to other domains.
+
+    @ivar checked: Number of MX hosts that have been checked.
+    @ivar deduplicated: Number of MX hosts whose check has been shared with
+        another domain.
+    """
+    def __init__(self, reactor=None, timeout=None, connectTimeout=10,
+                 handshakeTimeout=10, allAddresses=False, maxPerHost=4,
+                 lookupMX=None, checkHost=None, maxConcurrent=None,
+                 maxSize=1024):
+        """
+        I{connectTimeout}, I{handshakeTimeout}, I{allAddresses} and
+        I{maxPerHost} are passed to L{danex._check.checkTarget}.
+
+        @param reactor: The reactor to use.  If C{None}, the global reactor
+            is used.
+        @param timeout: Seconds after which the check of an MX host is
+            given up.
+        @param lookupMX: Called with a domain, returns a
+            L{defer.Deferred} like
+            L{danex._resolver.TLSAResolver.lookupMX}.  The process-wide
+            resolver is used if C{None}.
+        @param checkHost: Called with an MX host, returns a
+            L{defer.Deferred} that fires like
+            L{danex._check.checkTarget}.  If C{None}, the host is checked
+            using L{danex._check.checkTarget} and STARTTLS.
+        @param maxConcurrent: Maximum number of MX hosts that are checked
+            at once across all domains or C{None} for no limit.
+        @param maxSize: Maximum number of MX host results to keep for
+            reuse.
+        """
+        if lookupMX is None:
+            lookupMX = _resolver.getResolver().lookupMX
+        if checkHost is None:
+            def checkHost(host):
+                return _check.checkTarget(
+                    host, SMTP_PORT, "tcp", timeout=timeout, reactor=reactor,
+                    connectTimeout=connectTimeout,
+                    handshakeTimeout=handshakeTimeout,
+                    allAddresses=allAddresses, maxPerHost=maxPerHost,
+                    starttls="smtp",
+                )
+        if maxConcurrent is not None:
+            semaphore = defer.DeferredSemaphore(maxConcurrent)
+            checkHost = partial(semaphore.run, checkHost)
+        self._lookupMX = lookupMX
+        self._checkHost = checkHost
+        self.maxSize = maxSize
+        self._results = OrderedDict()
+        self._waiting = {}
+        self.checked = 0
+        self.deduplicated = 0
+
+
+    def check(self, domain):
+        """
+        Check the MX hosts of I{domain}.
+
+        @rtype: L{defer.Deferred} that fires with a tuple of whether the MX
+            records are DNSSEC-validated and a list of C{(target, result)}
+            tuples in order of preference.  C{target} is the C{(host, port,
+            proto)} tuple of an MX host and C{result} is what
+            L{danex._check.checkTarget} fired with or a L{Failure}.  If the
+            MX lookup fails, so does the L{defer.Deferred}.
+        """
+        d = self._lookupMX(domain)
+        d.addCallback(self._checkHosts)
+        return d
+
+
+    def _checkHosts(self, res):
+        trusted, hosts, _ = res
+        if not hosts:
+            raise NullMXError()
+        d = defer.DeferredList(
+            [self._hostResult(host) for host in hosts], consumeErrors=True,
+        )
+        d.addCallback(lambda results: (trusted, [
+            ((host, SMTP_PORT, "tcp"), value)
+            for host, (_, value) in zip(hosts, results)
+        ]))
+        return d
+
+
+    def _hostResult(self, host):
+        """
+        Return a L{defer.Deferred} that fires like the check of I{host}.
+        """
+        if host in self._results:
+            self.deduplicated += 1
+            res = self._results.pop(host)
+            self._results[host] = res
+            return defer.succeed(res)
+
+        d = defer.Deferred()
+        if host in self._waiting:
+            self.deduplicated += 1
+            self._waiting[host].append(d)
+            return d
+
+        self.checked += 1
+        self._waiting[host] = [d]
+        self._checkHost(host).addBoth(self._checkedHost, host)
+        return d
+
+
+    def _checkedHost(self, res, host):
+        if not isinstance(res, Failure) and self.maxSize > 0:
+            self._results[host] = res
+            while len(self._results) > self.maxSize:
+                self._results.popitem(last=False)
+        for d in self._waiting.pop(host):
+            if isinstance(res, Failure):
+                d.errback(res)
+            else:
+                d.callback(res)
@@ -0,0 +1,252 @@
+# -*- test-case-name: danex.test.test_metrics -*-
+# Copyright (c) Hynek Schlawack, Richard Wall
+# See LICENSE for details.
+
+"""
+Counters, gauges and latency histograms in the Prometheus text format.
+
+Collection is off until L{REGISTRY} is enabled.  While it's off, the timing
+hooks on the hot paths cost one attribute lookup and a comparison.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import bisect
+
+from timeit import default_timer
+
+
+# Seconds, from a cached answer to a slow handshake.
+DEFAULT_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+    2.5, 5.0, 10.0,
+)
+
+
+def _formatValue(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+def _formatLabels(names, values):
+    if not names:
+        return ""
+    return "{" + ",".join(
+        '{0}="{1}"'.format(name, str(value).replace("\\", "\\\\")
+                           .replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in zip(names, values)
+    ) + "}"
+
+
+
+class Counter(object):
+    """
+    A value that only goes up, optionally split up by labels.
+    """
+    type = "counter"
+
+    def __init__(self, name, help, labelNames=()):
+        self.name = name
+        self.help = help
+        self.labelNames = tuple(labelNames)
+        self._values = {}
+
+
+    def inc(self, *labelValues, **kw):
+        """
+        Add C{amount} -- 1 by default -- to the value for I{labelValues}.
+        """
+        amount = kw.get("amount", 1)
+        self._values[labelValues] = self._values.get(labelValues, 0) + amount
+
+
+    def value(self, *labelValues):
+        return self._values.get(labelValues, 0)
+
+
+    def samples(self):
+        for labelValues, value in sorted(self._values.items()):
+            yield self.name, self.labelNames, labelValues, value
+
+
+
+class CallbackMetric(object):
+    """
+    A counter or gauge whose value is computed when it's collected.
+    """
+    def __init__(self, name, help, callback, type="gauge"):
+        """
+        @param callback: Called without arguments, returns the value.
+        @param type: C{"gauge"} or C{"counter"}.
+        """
+        self.name = name
+        self.help = help
+        self.type = type
+        self._callback = callback
+
+
+    def samples(self):
+        yield self.name, (), (), self._callback()
+
+
+
+class _Timer(object):
+    """
+    Observes the seconds between its creation and L{stop} in a histogram.
+    """
+    def __init__(self, histogram):
+        self._histogram = histogram
+        self._start = default_timer()
+
+
+    def stop(self, result=None):
+        """
+        Stop the timer.  Returns I{result} so it may be used as a callback.
+        """
+        self._histogram.observe(default_timer() - self._start)
+        return result
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+
+class _NullTimer(object):
+    def stop(self, result=None):
+        return result
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc):
+        pass
+
+
+_NULL_TIMER = _NullTimer()
+
+
+
+class Histogram(object):
+    """
+    Counts observations in cumulative buckets.
+    """
+    type = "histogram"
+
+    def __init__(self, name, help, buckets=DEFAULT_BUCKETS, registry=None):
+        """
+        @param registry: The L{Registry} that decides whether L{time}
+            measures anything.  L{REGISTRY} if C{None}.
+        """
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self._registry = registry
+        self._counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+
+    def observe(self, value):
+        self._counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+    def time(self):
+        """
+        Start timing.
+
+        Use the result as a context manager or call its C{stop} method --
+        e.g. as a callback -- once done.  If collection is disabled, nothing
+        is measured.
+        """
+        if not (self._registry or REGISTRY).enabled:
+            return _NULL_TIMER
+        return _Timer(self)
+
+
+    def samples(self):
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), self._counts):
+            cumulative += count
+            yield self.name + "_bucket", ("le",), (_formatValue(bound),), \
+                cumulative
+        yield self.name + "_sum", (), (), self.sum
+        yield self.name + "_count", (), (), self.count
+
+
+
+class Registry(object):
+    """
+    A collection of metrics.
+
+    @ivar enabled: Whether timing hooks measure anything.
+    """
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self._metrics = {}
+
+
+    def register(self, metric):
+        """
+        Add I{metric}, replacing any metric of the same name.
+
+        @return: I{metric}
+        """
+        self._metrics[metric.name] = metric
+        return metric
+
+
+    def get(self, name):
+        return self._metrics[name]
+
+
+    def render(self):
+        """
+        Return all metrics in the Prometheus text exposition format.
+
+        @rtype: L{bytes}
+        """
+        lines = []
+        for name, metric in sorted(self._metrics.items()):
+            lines.append("# HELP {0} {1}".format(name, metric.help))
+            lines.append("# TYPE {0} {1}".format(name, metric.type))
+            for sampleName, labelNames, labelValues, value in \
+                    metric.samples():
+                lines.append("{0}{1} {2}".format(
+                    sampleName, _formatLabels(labelNames, labelValues),
+                    _formatValue(value),
+                ))
+        return ("\n".join(lines) + "\n").encode("utf-8")
+
+
+
+REGISTRY = Registry()
+
+DNS_LATENCY = REGISTRY.register(Histogram(
+    "danex_dns_lookup_seconds",
+    "Duration of TLSA lookups that miss the cache.",
+))
+HANDSHAKE_LATENCY = REGISTRY.register(Histogram(
+    "danex_tls_handshake_seconds",
+    "Duration of TLS handshakes once connected.",
+))
+MATCH_TIME = REGISTRY.register(Histogram(
+    "danex_match_seconds",
+    "Time spent matching TLSA records against certificate chains.",
+    buckets=(0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001,
+             0.0025, 0.005, 0.01),
+))
+CHECK_OUTCOMES = REGISTRY.register(Counter(
+    "danex_checks_total", "Finished checks by outcome.", ("outcome",),
+))
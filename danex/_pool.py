@@ -0,0 +1,188 @@
+# -*- test-case-name: danex.test.test_pool -*-
+# Copyright (c) Hynek Schlawack, Richard Wall
+# See LICENSE for details.
+
+from __future__ import absolute_import, division, print_function
+
+import threading
+
+from contextlib import contextmanager
+
+
+DEFAULT_POOL_SIZE = 4
+
+
+class _PooledContext(object):
+    """
+    A getdns context together with the number of queries it has served.
+    """
+    def __init__(self, context):
+        self.context = context
+        self.queries = 0
+
+
+
+class ContextPool(object):
+    """
+    A thread-safe pool of long-lived getdns contexts.
+
+    Creating a getdns context means setting up a resolver, loading the trust
+    anchors and starting with a cold upstream cache.  The pool keeps up to
+    C{size} idle contexts around so consecutive lookups can reuse them.
+
+    If all pooled contexts are checked out, a fresh context is created for the
+    caller.  It's returned into the pool when released if there's room,
+    otherwise it's dropped.
+
+    Only the synchronous getdns API -- L{danex._dane.lookup_tlsa_records}
+    and L{danex._dane.queryTLSA} -- uses pools.  The CLI and dane_doctor
+    resolve through L{danex._resolver} instead.
+
+    @ivar hits: Number of checkouts that were served by an idle context.
+    @ivar misses: Number of checkouts that had to create a new context.
+    @ivar recycled: Number of contexts that have been dropped because they
+        served C{maxQueries} queries or failed.
+    """
+    def __init__(self, getdns, size=DEFAULT_POOL_SIZE, maxQueries=1000):
+        """
+        @param getdns: The getdns API to create contexts with.
+        @param size: Maximum number of idle contexts to keep.
+        @type size: int
+        @param maxQueries: Number of queries after which a context is
+            replaced by a fresh one.  C{None} to never recycle.
+        @type maxQueries: int or None
+        """
+        self._getdns = getdns
+        self.size = size
+        self.maxQueries = maxQueries
+        self._idle = []
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.recycled = 0
+
+
+    def acquire(self):
+        """
+        Check out a context.
+
+        @rtype: L{_PooledContext}
+        """
+        with self._lock:
+            if self._idle:
+                self.hits += 1
+                return self._idle.pop()
+            self.misses += 1
+        return _PooledContext(self._getdns.context_create())
+
+
+    def release(self, pooled, broken=False):
+        """
+        Return a context that has been checked out using L{acquire}.
+
+        @param pooled: The context to return.
+        @type pooled: L{_PooledContext}
+        @param broken: Whether the context failed and must not be reused.
+        @type broken: bool
+        """
+        pooled.queries += 1
+        expired = (
+            self.maxQueries is not None
+            and pooled.queries >= self.maxQueries
+        )
+        with self._lock:
+            if broken or expired:
+                self.recycled += 1
+            elif len(self._idle) < self.size:
+                self._idle.append(pooled)
+
+
+    @contextmanager
+    def context(self):
+        """
+        Check out a context for the duration of a C{with} block.
+
+        If the block raises an exception, the context is recycled.
+        """
+        pooled = self.acquire()
+        try:
+            yield pooled.context
+        except BaseException:
+            self.release(pooled, broken=True)
+            raise
+        else:
+            self.release(pooled)
+
+
+    def clear(self):
+        """
+        Drop all idle contexts.
+        """
+        with self._lock:
+            self._idle = []
+
+
+    def resize(self, size):
+        """
+        Change C{size}, dropping idle contexts that don't fit anymore.
+
+        @type size: int
+        """
+        with self._lock:
+            self.size = size
+            del self._idle[size:]
+
+
+
+_pools = {}
+_poolsLock = threading.Lock()
+_poolSize = DEFAULT_POOL_SIZE
+
+
+def contextPoolFor(getdns):
+    """
+    Return the shared L{ContextPool} for I{getdns}.
+
+    @param getdns: A getdns API.
+
+    @rtype: L{ContextPool}
+    """
+    with _poolsLock:
+        try:
+            return _pools[getdns]
+        except KeyError:
+            pool = _pools[getdns] = ContextPool(getdns, size=_poolSize)
+            return pool
+
+
+def setPoolSize(size):
+    """
+    Set the size of the shared pools, both the existing ones and those that
+    L{contextPoolFor} creates later.
+
+    For applications that use L{danex._dane.lookup_tlsa_records} from
+    several threads.
+
+    @type size: int
+    """
+    global _poolSize
+    with _poolsLock:
+        _poolSize = size
+        pools = list(_pools.values())
+    for pool in pools:
+        pool.resize(size)
+
+
+def resetPools():
+    """
+    Drop all shared pools and their contexts and restore the default size.
+
+    Meant for tests that pass their own getdns API to L{contextPoolFor}
+    indirectly.
+    """
+    global _poolSize
+    with _poolsLock:
+        for pool in _pools.values():
+            pool.clear()
+        _pools.clear()
+        _poolSize = DEFAULT_POOL_SIZE
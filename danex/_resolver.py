@@ -0,0 +1,448 @@
+# -*- test-case-name: danex.test.test_resolver -*-
+# Copyright (c) Hynek Schlawack, Richard Wall
+# See LICENSE for details.
+
+"""
+Asynchronous TLSA lookups that run on the reactor.
+
+Instead of validating DNSSEC itself like getdns, the resolver in this module
+sends queries with the DO bit set to a validating recursive resolver --
+usually one on the local host -- and trusts its AD bit.  The AD bit of
+remote resolvers is only trusted on request, because nothing protects the
+path to them.  Each query is sent from its own ephemeral UDP port and
+responses must come from the queried server and repeat the question, so no
+threads are involved and spoofing an answer takes guessing both the message
+ID and the port.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import random
+import socket
+import struct
+
+import getdns
+
+from twisted.internet import defer
+from twisted.internet.abstract import isIPv6Address
+from twisted.internet.endpoints import TCP4ClientEndpoint, TCP6ClientEndpoint
+from twisted.internet.protocol import DatagramProtocol, Factory, Protocol
+from twisted.names import dns
+from twisted.python import log
+
+from . import _metrics
+from ._cache import TLSACache
+from ._dane import GetdnsResponseError, TLSARecord, tlsaDomainName
+
+
+TLSA = 52
+
+
+def parseTLSARecord(rdata):
+    """
+    Create a L{TLSARecord} from the wire format of TLSA RDATA.
+
+    @see: U{https://tools.ietf.org/html/rfc6698#section-2.1}
+
+    @type rdata: L{bytes}
+
+    @rtype: L{TLSARecord}
+    """
+    if len(rdata) < 3:
+        raise ValueError("TLSA RDATA too short.")
+    usage, selector, matchingType = struct.unpack("!BBB", rdata[:3])
+    return TLSARecord(rdata[3:], usage, selector, matchingType)
+
+
+def serversFromResolvConf(path="/etc/resolv.conf"):
+    """
+    Return the name servers configured in I{path}.
+
+    @rtype: L{list} of C{(host, port)} tuples
+    """
+    servers = []
+    try:
+        with open(path) as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) >= 2 and parts[0] == "nameserver":
+                    servers.append((parts[1], 53))
+    except IOError:
+        pass
+    return servers
+
+
+
+def _sameAddress(a, b):
+    """
+    Whether the C{(host, port)} tuples I{a} and I{b} denote the same address
+    even if their hosts are spelled differently.
+    """
+    if a[1] != b[1]:
+        return False
+    family = socket.AF_INET6 if isIPv6Address(a[0]) else socket.AF_INET
+    try:
+        return (socket.inet_pton(family, a[0])
+                == socket.inet_pton(family, b[0]))
+    except (socket.error, ValueError):
+        return False
+
+
+def isLoopback(host):
+    """
+    Whether I{host} is an IP address on the loopback interface.
+
+    @type host: L{str}
+    """
+    return host == "::1" or host.startswith(("127.", "::ffff:127."))
+
+
+
+class _DNSDatagramProtocol(DatagramProtocol):
+    """
+    Sends DNS queries over UDP and matches the responses by message ID,
+    source address and question.
+
+    Responses that don't match a query are dropped so that an off-path
+    attacker has to guess the message ID and the port to spoof one.
+    """
+    def __init__(self):
+        self._pending = {}
+
+
+    def query(self, address, message):
+        """
+        Send I{message} to I{address} using a free message ID.
+
+        @rtype: L{defer.Deferred} that fires with the response message.
+        """
+        while True:
+            message.id = random.randrange(1 << 16)
+            if message.id not in self._pending:
+                break
+
+        def cancel(d):
+            self._pending.pop(message.id, None)
+
+        d = defer.Deferred(cancel)
+        self._pending[message.id] = (address, list(message.queries), d)
+        self.transport.write(message.toStr(), address)
+        return d
+
+
+    def datagramReceived(self, data, address):
+        m = dns._EDNSMessage()
+        try:
+            m.fromStr(data)
+        except (EOFError, ValueError):
+            log.msg("Invalid DNS packet from {0}.".format(address))
+            return
+        try:
+            server, queries, d = self._pending[m.id]
+        except KeyError:
+            return
+        if not _sameAddress(address, server) or list(m.queries) != queries:
+            log.msg("Dropping unexpected DNS response from {0}.".format(
+                address
+            ))
+            return
+        del self._pending[m.id]
+        d.callback(m)
+
+
+
+class _DNSStreamProtocol(Protocol):
+    """
+    Sends a single DNS query over TCP and fires with the response.
+    """
+    def __init__(self, message):
+        self._message = message
+        self._buffer = b""
+        self.deferred = defer.Deferred()
+
+
+    def connectionMade(self):
+        data = self._message.toStr()
+        self.transport.write(struct.pack("!H", len(data)) + data)
+
+
+    def dataReceived(self, data):
+        self._buffer += data
+        if len(self._buffer) < 2:
+            return
+        (length,) = struct.unpack("!H", self._buffer[:2])
+        if len(self._buffer) - 2 < length:
+            return
+        m = dns._EDNSMessage()
+        m.fromStr(self._buffer[2:2 + length])
+        self.transport.loseConnection()
+        self.deferred, d = None, self.deferred
+        d.callback(m)
+
+
+    def connectionLost(self, reason):
+        if self.deferred is not None:
+            self.deferred, d = None, self.deferred
+            d.errback(reason)
+
+
+
+class TLSAResolver(object):
+    """
+    Resolves TLSA and MX records asynchronously using a validating resolver.
+
+    @ivar servers: The validating resolvers to query, in order.
+    @type servers: L{list} of C{(host, port)} tuples
+    @ivar timeout: Seconds to wait for each server to answer.
+    @ivar trustRemote: Whether to trust the AD bit of servers that aren't on
+        the loopback interface.  Only enable it if the path to them is
+        secured otherwise, for example by IPsec.
+    """
+    def __init__(self, reactor, servers=None, timeout=5, trustRemote=False):
+        if not servers:
+            servers = serversFromResolvConf() or [("127.0.0.1", 53)]
+        self.servers = servers
+        self.timeout = timeout
+        self.trustRemote = trustRemote
+        self._reactor = reactor
+
+
+    def _queryUDP(self, address, message):
+        """
+        Send I{message} to I{address} from a fresh ephemeral port that is
+        closed once the query is done.
+        """
+        proto = _DNSDatagramProtocol()
+        port = self._reactor.listenUDP(
+            0, proto, interface="::" if isIPv6Address(address[0]) else "",
+            maxPacketSize=65535,
+        )
+
+        def stop(res):
+            port.stopListening()
+            return res
+
+        return proto.query(address, message).addBoth(stop)
+
+
+    def _queryTCP(self, address, message):
+        host, port = address
+        if ":" in host:
+            endpoint = TCP6ClientEndpoint(self._reactor, host, port)
+        else:
+            endpoint = TCP4ClientEndpoint(self._reactor, host, port)
+        d = endpoint.connect(
+            Factory.forProtocol(lambda: _DNSStreamProtocol(message))
+        )
+        d.addCallback(lambda proto: proto.deferred)
+        return d
+
+
+    @defer.inlineCallbacks
+    def _query(self, name, recordType):
+        """
+        Query the configured servers in order until one answers.
+
+        The AD bit of the answer is cleared unless the server is trusted,
+        see L{trustRemote}.
+
+        @rtype: L{defer.Deferred} that fires with a
+            L{twisted.names.dns._EDNSMessage}.
+        """
+        for address in self.servers:
+            message = dns._EDNSMessage(
+                recDes=True, dnssecOK=True, authenticData=True,
+                maxSize=4096,
+                queries=[dns.Query(name, recordType, dns.IN)],
+            )
+            d = self._queryUDP(address, message)
+            d.addTimeout(self.timeout, self._reactor)
+            try:
+                response = yield d
+            except defer.TimeoutError:
+                continue
+            if response.trunc:
+                d = self._queryTCP(address, message)
+                d.addTimeout(self.timeout, self._reactor)
+                try:
+                    response = yield d
+                except defer.TimeoutError:
+                    continue
+            if not (self.trustRemote or isLoopback(address[0])):
+                response.authenticData = False
+            defer.returnValue(response)
+
+        raise GetdnsResponseError(getdns.GETDNS_RESPSTATUS_ALL_TIMEOUT)
+
+
+    def lookupTLSA(self, name):
+        """
+        Look up the TLSA records at I{name}.
+
+        @param name: A TLSA domain name as returned by L{tlsaDomainName}.
+
+        @rtype: L{defer.Deferred} that fires with a tuple of whether the
+            answer is DNSSEC-validated, a list of L{TLSARecord}s and the
+            minimum TTL of the answer.  If no TLSA records exist, it fails
+            with a L{GetdnsResponseError}.
+        """
+        d = self._query(name, TLSA)
+        d.addCallback(_tlsaFromResponse)
+        d.addBoth(_metrics.DNS_LATENCY.time().stop)
+        return d
+
+
+    def lookupMX(self, name):
+        """
+        Look up the mail exchangers of I{name}.
+
+        @param name: A mail domain.
+
+        @rtype: L{defer.Deferred} that fires with a tuple of whether the
+            answer is DNSSEC-validated, a list of the host names in order of
+            preference and the minimum TTL of the answer.  The list is empty
+            if the domain doesn't accept mail.
+        """
+        d = self._query(name, dns.MX)
+        d.addCallback(_mxFromResponse, name)
+        d.addBoth(_metrics.DNS_LATENCY.time().stop)
+        return d
+
+
+
+def _negativeTTL(response):
+    """
+    Return for how long a negative I{response} may be cached according to
+    the SOA record in its authority section.
+
+    @see: U{https://tools.ietf.org/html/rfc2308#section-5}
+
+    @rtype: int or None
+    """
+    ttls = [
+        min(rr.ttl, rr.payload.minimum)
+        for rr in response.authority
+        if rr.type == dns.SOA
+    ]
+    return min(ttls) if ttls else None
+
+
+def _checkRCode(response):
+    """
+    Raise a L{GetdnsResponseError} if I{response} isn't an answer.
+
+    A validating resolver answers with SERVFAIL if the data is bogus, all
+    other failures are reported as timeouts like getdns does if no upstream
+    gave a usable answer.
+    """
+    if response.rCode == dns.ENAME:
+        raise GetdnsResponseError(
+            getdns.GETDNS_RESPSTATUS_NO_NAME, _negativeTTL(response)
+        )
+    elif response.rCode == dns.ESERVER:
+        raise GetdnsResponseError(getdns.GETDNS_RESPSTATUS_ALL_BOGUS_ANSWERS)
+    elif response.rCode != dns.OK:
+        raise GetdnsResponseError(getdns.GETDNS_RESPSTATUS_ALL_TIMEOUT)
+
+
+def _tlsaFromResponse(response):
+    """
+    Extract the result of a TLSA lookup from a DNS response.
+    """
+    _checkRCode(response)
+    rv = []
+    for rr in response.answers:
+        if rr.type != TLSA:
+            continue
+        try:
+            rv.append(parseTLSARecord(rr.payload.data))
+        except ValueError:
+            log.msg("Skipping malformed TLSA record for {0}.".format(rr.name))
+    if not rv:
+        raise GetdnsResponseError(
+            getdns.GETDNS_RESPSTATUS_NO_NAME, _negativeTTL(response)
+        )
+    ttl = min(rr.ttl for rr in response.answers)
+    return response.authenticData, rv, ttl
+
+
+def _mxFromResponse(response, name):
+    """
+    Extract the result of an MX lookup for I{name} from a DNS response.
+
+    A domain without MX records has an implicit one that points to the
+    domain itself, a null MX means that the domain doesn't accept mail.
+
+    @see: U{https://tools.ietf.org/html/rfc5321#section-5.1}
+    @see: U{https://tools.ietf.org/html/rfc7505}
+    """
+    _checkRCode(response)
+    answers = [rr for rr in response.answers if rr.type == dns.MX]
+    if not answers:
+        return response.authenticData, [name], _negativeTTL(response)
+
+    exchanges = sorted(set(
+        (rr.payload.preference, rr.payload.name.name.decode("ascii").lower())
+        for rr in answers
+    ))
+    hosts = []
+    for _, host in exchanges:
+        if host and host not in hosts:
+            hosts.append(host)
+    ttl = min(rr.ttl for rr in answers)
+    return response.authenticData, hosts, ttl
+
+
+_resolver = None
+_cache = None
+
+
+def getResolver():
+    """
+    Return the process-wide L{TLSAResolver}, creating it on first use.
+    """
+    global _resolver
+    if _resolver is None:
+        from twisted.internet import reactor
+        _resolver = TLSAResolver(reactor)
+    return _resolver
+
+
+def getCache():
+    """
+    Return the process-wide L{TLSACache} in front of L{getResolver}, creating
+    it on first use.
+    """
+    global _cache
+    if _cache is None:
+        from twisted.internet import reactor
+        _cache = TLSACache(getResolver().lookupTLSA, reactor)
+    return _cache
+
+
+def setCache(cache):
+    """
+    Replace the process-wide cache that L{lookupTLSARecords} uses by default.
+
+    @param cache: An object with a C{lookup} method like L{TLSACache.lookup}.
+    """
+    global _cache
+    _cache = cache
+
+
+def lookupTLSARecords(parentDomain, port, proto, cache=None):
+    """
+    Asynchronous counterpart of L{danex._dane.lookup_tlsa_records}.
+
+    @param parentDomain: The domain with which the TLSA record is associated.
+    @param port: The port number with which the TLSA record is associated.
+    @param proto: The IP protocol with which the TLSA record is associated.
+    @param cache: The L{TLSACache} to use.  If C{None}, the one returned by
+        L{getCache} is used.
+
+    @rtype: L{defer.Deferred} that fires with a tuple of whether the answer
+        is DNSSEC-validated and a list of L{TLSARecord}s.
+    """
+    if cache is None:
+        cache = getCache()
+    return cache.lookup(tlsaDomainName(parentDomain, port, proto))
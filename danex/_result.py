@@ -0,0 +1,474 @@
+# -*- test-case-name: danex.test.test_result -*-
+# Copyright (c) Hynek Schlawack, Richard Wall
+# See LICENSE for details.
+
+"""
+The result of checking a target and serializers that write one result at a
+time.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import binascii
+import csv
+import json
+
+from twisted.python.failure import Failure
+
+from ._dane import USAGE, GetdnsResponseError, matchChain
+
+
+class EndpointResult(object):
+    """
+    The outcome of matching the certificate chain of one address of a
+    target.
+
+    @ivar address: The IP address.
+    @ivar matches: Whether the respective record matches the chain the
+        address presented.
+    @ivar error: A description of why the chain couldn't be retrieved or
+        C{None}.
+    """
+    def __init__(self, address, matches=(), error=None):
+        self.address = address
+        self.matches = list(matches)
+        self.error = error
+
+
+    @property
+    def doesMatch(self):
+        return self.error is None and any(self.matches)
+
+
+    def asDict(self):
+        return {
+            "address": self.address,
+            "doesMatch": self.doesMatch,
+            "matches": self.matches,
+            "error": self.error,
+        }
+
+
+
+class CheckResult(object):
+    """
+    The outcome of checking the TLSA setup of one target.
+
+    @ivar host: The checked host.
+    @ivar port: The checked port.
+    @ivar proto: The checked IP protocol.
+    @ivar trusted: Whether the TLSA records are DNSSEC-validated.
+    @ivar records: The L{danex._dane.TLSARecord}s found.
+    @ivar matches: Whether the respective record matches the presented
+        certificate chain.
+    @ivar error: A description of why the check failed or C{None}.
+    @ivar endpoints: The L{EndpointResult}s of each address if all
+        addresses of the host have been checked, otherwise empty.
+    @ivar resumed: Whether a chain comes from a resumed TLS session instead
+        of the server, see L{danex._tls.CertificateChain}.
+    """
+    def __init__(self, host, port, proto, trusted=False, records=(),
+                 matches=(), error=None, endpoints=(), resumed=False):
+        self.host = host
+        self.port = port
+        self.proto = proto
+        self.trusted = trusted
+        self.records = list(records)
+        self.matches = list(matches)
+        self.error = error
+        self.endpoints = list(endpoints)
+        self.resumed = resumed
+
+
+    @classmethod
+    def fromCheck(cls, target, res):
+        """
+        Create a result from what L{danex._check.checkTarget} fired with.
+
+        @param target: The C{(host, port, proto)} tuple that has been
+            checked or the line that couldn't be parsed.
+        @param res: The lookup result and certificate chain tuple or a
+            L{Failure}.
+
+        @rtype: L{CheckResult}
+        """
+        if not isinstance(target, tuple):
+            target = (target, None, None)
+        if isinstance(res, Failure):
+            return cls(*target, error=describeFailure(res))
+        (trusted, records), chain = res[:2]
+        endpointChains = res[2] if len(res) > 2 else ()
+        endpoints = [
+            EndpointResult(address, error=describeFailure(endpointChain))
+            if isinstance(endpointChain, Failure)
+            else EndpointResult(address, matchChain(records, endpointChain))
+            for address, endpointChain in endpointChains
+        ]
+        resumed = any(
+            getattr(c, "resumed", False)
+            for c in [chain] + [c for _, c in endpointChains]
+        )
+        return cls(*target, trusted=trusted, records=records,
+                   matches=matchChain(records, chain), endpoints=endpoints,
+                   resumed=resumed)
+
+
+    @property
+    def doesMatch(self):
+        """
+        Whether at least one record matches the chain and -- if all
+        addresses have been checked -- every address presented a matching
+        chain.
+        """
+        return any(self.matches) and all(
+            endpoint.doesMatch for endpoint in self.endpoints
+        )
+
+
+    @property
+    def hasInvalid(self):
+        return not all(record.valid for record in self.records)
+
+
+    def asDict(self):
+        """
+        Return the result as a JSON-compatible dict.
+        """
+        rv = {
+            "host": self.host,
+            "port": self.port,
+            "proto": self.proto,
+            "trusted": self.trusted,
+            "doesMatch": self.doesMatch,
+            "numRecs": len(self.records),
+            "tlsaRecords": [
+                {
+                    "usage": tlsa.usage.name,
+                    "selector": tlsa.selector.name,
+                    "matchingType": tlsa.matchingType.name,
+                    "certificateAssociationData": hexlify(tlsa.payload),
+                    "errors": tlsa.errors,
+                    "valid": tlsa.valid,
+                    "matches": match,
+                }
+                for tlsa, match in zip(self.records, self.matches)
+            ],
+            "error": self.error,
+        }
+        if self.endpoints:
+            rv["endpoints"] = [
+                endpoint.asDict() for endpoint in self.endpoints
+            ]
+        if self.resumed:
+            rv["resumed"] = True
+        return rv
+
+
+
+class MailResult(object):
+    """
+    The outcome of checking a mail domain.
+
+    @ivar domain: The checked mail domain.
+    @ivar mxTrusted: Whether the MX records are DNSSEC-validated.  If they
+        aren't, the TLSA records of the MX hosts mustn't be used.
+    @ivar hosts: The L{CheckResult}s of the MX hosts in order of preference.
+    @ivar error: A description of why the MX hosts couldn't be determined
+        or C{None}.
+    """
+    def __init__(self, domain, mxTrusted=False, hosts=(), error=None):
+        self.domain = domain
+        self.mxTrusted = mxTrusted
+        self.hosts = list(hosts)
+        self.error = error
+
+
+    @classmethod
+    def fromCheck(cls, target, res):
+        """
+        Create a result from what L{danex._mail.MailChecker.check} fired
+        with.
+
+        @param target: The C{(domain,)} tuple that has been checked or the
+            line that couldn't be parsed.
+        @param res: The MX lookup result or a L{Failure}.
+
+        @rtype: L{MailResult}
+        """
+        domain = target[0] if isinstance(target, tuple) else target
+        if isinstance(res, Failure):
+            return cls(domain, error=describeFailure(res))
+        mxTrusted, hosts = res
+        return cls(domain, mxTrusted, [
+            CheckResult.fromCheck(hostTarget, hostResult)
+            for hostTarget, hostResult in hosts
+        ])
+
+
+    @property
+    def doesMatch(self):
+        """
+        Whether the domain is protected by DANE as RFC 7672 defines it: the
+        MX RRset and the TLSA RRsets of all MX hosts are DNSSEC-validated
+        and every MX host presented a chain that matches one of its usable
+        TLSA records.
+        """
+        return bool(self.hosts) and self.mxTrusted and all(
+            smtpMatches(host) for host in self.hosts
+        )
+
+
+    def asDict(self):
+        """
+        Return the result as a JSON-compatible dict.
+        """
+        return {
+            "domain": self.domain,
+            "mxTrusted": self.mxTrusted,
+            "doesMatch": self.doesMatch,
+            "mx": [host.asDict() for host in self.hosts],
+            "error": self.error,
+        }
+
+
+
+# PKIX-TA and PKIX-EE records are unusable for SMTP, see
+# https://tools.ietf.org/html/rfc7672#section-3.1.3
+_SMTP_USAGES = (USAGE.DANE_TA, USAGE.DANE_EE)
+
+
+def smtpMatches(result):
+    """
+    Whether an MX host matches its TLSA records as RFC 7672 requires: they
+    are DNSSEC-validated and a DANE-TA or DANE-EE record matches the chain
+    of every checked address.
+
+    @type result: L{CheckResult}
+
+    @rtype: L{bool}
+    """
+    usable = [
+        record.valid and record.usage in _SMTP_USAGES
+        for record in result.records
+    ]
+
+    def matches(matches):
+        return any(u and m for u, m in zip(usable, matches))
+
+    return (
+        result.error is None and result.trusted and matches(result.matches)
+        and all(
+            endpoint.error is None and matches(endpoint.matches)
+            for endpoint in result.endpoints
+        )
+    )
+
+
+def hexlify(data):
+    return binascii.hexlify(data).decode("ascii")
+
+
+def describeFailure(failure):
+    """
+    Return a short description of why a check failed.
+
+    @type failure: L{Failure}
+
+    @rtype: L{str}
+    """
+    if failure.check(GetdnsResponseError):
+        return failure.value.errorText or str(failure.value.errorCode)
+    return failure.getErrorMessage() or failure.type.__name__
+
+
+
+class TextWriter(object):
+    """
+    Writes results as prose for humans.
+
+    @param headers: Whether to introduce each result with the target.
+    """
+    def __init__(self, stream, headers=True):
+        self._stream = stream
+        self._headers = headers
+
+
+    def _print(self, *args):
+        print(*args, file=self._stream)
+
+
+    def write(self, result):
+        if isinstance(result, MailResult):
+            self._writeMail(result)
+            return
+        if self._headers:
+            target = [result.host, result.port, result.proto]
+            self._print("=== " + " ".join(
+                str(part) for part in target if part is not None
+            ))
+        if result.error is not None:
+            self._print("ERROR: {0}".format(result.error))
+        else:
+            self._writeRecords(result)
+        if self._headers:
+            self._print()
+        self._stream.flush()
+
+
+    def _writeMail(self, result):
+        if self._headers:
+            self._print("=== {0} MX".format(result.domain))
+        if result.error is not None:
+            self._print("ERROR: {0}".format(result.error))
+        else:
+            numHosts = len(result.hosts)
+            self._print("{} MX host{} found.{}".format(
+                numHosts,
+                "s" if numHosts != 1 else "",
+                " (UNTRUSTED)" if not result.mxTrusted else "",
+            ))
+            for host in result.hosts:
+                self._print()
+                self._print("--- {0} {1} {2}".format(
+                    host.host, host.port, host.proto
+                ))
+                if host.error is not None:
+                    self._print("ERROR: {0}".format(host.error))
+                else:
+                    self._writeRecords(host)
+        if self._headers:
+            self._print()
+        self._stream.flush()
+
+
+    def _writeRecords(self, result):
+        numRecs = len(result.records)
+        self._print("{} TLSA record{} found.{}".format(
+            numRecs,
+            "s" if numRecs != 1 else "",
+            " (UNTRUSTED)" if numRecs and not result.trusted else "",
+        ))
+
+        for tlsa in result.records:
+            self._print(tlsa)
+
+        self._print()
+        for endpoint in result.endpoints:
+            if endpoint.error is not None:
+                status = "ERROR: " + endpoint.error
+            elif endpoint.doesMatch:
+                status = "matches"
+            else:
+                status = "does NOT match"
+            self._print("{0}: {1}".format(endpoint.address, status))
+        if result.endpoints:
+            self._print()
+        if result.resumed:
+            self._print(
+                "The certificate chain is from a resumed TLS session."
+            )
+        if result.hasInvalid:
+            self._print(
+                "INVALID TLSA records received."
+            )
+        elif result.doesMatch:
+            self._print(
+                "The server-sent certificate chain matches at least one of "
+                "the TLSA records."
+            )
+        else:
+            self._print(
+                "The server-sent certificate chain did NOT match any TLSA "
+                "record."
+            )
+
+
+
+class JSONLinesWriter(object):
+    """
+    Writes each result as a JSON object on a line of its own.
+    """
+    def __init__(self, stream):
+        self._stream = stream
+
+
+    def write(self, result):
+        self._stream.write(json.dumps(result.asDict(), sort_keys=True))
+        self._stream.write("\n")
+        self._stream.flush()
+
+
+
+class CSVWriter(object):
+    """
+    Writes a header and one row per result.
+
+    If I{mail} is true, the results are L{MailResult}s that are written as
+    one row per MX host, prefixed by the domain and whether the MX records
+    are trusted.
+    """
+    fields = ["host", "port", "proto", "trusted", "doesMatch", "numRecs",
+              "numValid", "numMatching", "error"]
+    mailFields = ["domain", "mxTrusted"] + fields
+
+    def __init__(self, stream, mail=False):
+        self._stream = stream
+        self._writer = csv.writer(stream)
+        self._writer.writerow(self.mailFields if mail else self.fields)
+
+
+    def write(self, result):
+        if isinstance(result, MailResult):
+            prefix = [result.domain, result.mxTrusted]
+            if result.error is not None:
+                self._writer.writerow(prefix + self._row(
+                    CheckResult(None, None, None, error=result.error)
+                ))
+            for host in result.hosts:
+                self._writer.writerow(prefix + self._row(host))
+        else:
+            self._writer.writerow(self._row(result))
+        self._stream.flush()
+
+
+    def _row(self, result):
+        return [
+            result.host,
+            result.port,
+            result.proto,
+            result.trusted,
+            result.doesMatch,
+            len(result.records),
+            sum(1 for record in result.records if record.valid),
+            sum(1 for match in result.matches if match),
+            result.error,
+        ]
+
+
+
+class MsgpackWriter(object):
+    """
+    Writes each result as a msgpack map, back to back.
+
+    Read them using C{msgpack.Unpacker}.
+
+    Requires the optional C{msgpack} package.
+    """
+    def __init__(self, stream):
+        import msgpack
+        self._packer = msgpack.Packer(use_bin_type=True)
+        self._stream = getattr(stream, "buffer", stream)
+
+
+    def write(self, result):
+        self._stream.write(self._packer.pack(result.asDict()))
+        self._stream.flush()
+
+
+
+WRITERS = {
+    "text": TextWriter,
+    "jsonl": JSONLinesWriter,
+    "csv": CSVWriter,
+    "msgpack": MsgpackWriter,
+}
@@ -0,0 +1,376 @@
+# -*- test-case-name: danex.test.test_store -*-
+# Copyright (c) Hynek Schlawack, Richard Wall
+# See LICENSE for details.
+
+"""
+An on-disk store of past check results that allows for incremental rescans.
+
+Every result is kept by its TLSA domain name together with when its TLSA
+answer expires, a hash of the TLSA RRset, the certificate chain that has
+been presented and when the server's certificate expires.  A rescan resolves
+only the names whose answers have expired and handshakes only if the RRset
+changed, the certificate is about to expire or hasn't been looked at in a
+while.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import calendar
+import hashlib
+import sqlite3
+import struct
+import time
+
+from OpenSSL import crypto
+from twisted.internet import defer
+
+from . import _check, _resolver, _tls
+from ._dane import GetdnsResponseError, TLSARecord, tlsaDomainName
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    name TEXT PRIMARY KEY,
+    checked REAL NOT NULL,
+    dnsExpires REAL NOT NULL,
+    errorCode INTEGER,
+    trusted INTEGER,
+    records BLOB,
+    rrsetHash BLOB,
+    handshaked REAL,
+    certFingerprint BLOB,
+    certExpires REAL,
+    chain BLOB
+)
+"""
+
+_RECORD_HEADER = struct.Struct("!BBBH")
+_CERT_HEADER = struct.Struct("!I")
+
+
+def packRecords(records):
+    """
+    Serialize TLSA records.
+
+    @type records: L{list} of L{TLSARecord}
+
+    @rtype: L{bytes}
+    """
+    return b"".join(
+        _RECORD_HEADER.pack(*record.rawValues() + (len(record.payload),))
+        + record.payload
+        for record in records
+    )
+
+
+def unpackRecords(data):
+    """
+    Deserialize TLSA records serialized by L{packRecords}.
+
+    @rtype: L{list} of L{TLSARecord}
+    """
+    rv = []
+    offset = 0
+    while offset < len(data):
+        usage, selector, matchingType, length = _RECORD_HEADER.unpack_from(
+            data, offset
+        )
+        offset += _RECORD_HEADER.size
+        rv.append(TLSARecord(data[offset:offset + length], usage, selector,
+                             matchingType))
+        offset += length
+    return rv
+
+
+def rrsetHash(records):
+    """
+    Return a digest of I{records} that doesn't depend on their order.
+
+    @rtype: L{bytes}
+    """
+    return hashlib.sha256(
+        b"".join(sorted(packRecords([record]) for record in records))
+    ).digest()
+
+
+def _packChain(chain):
+    ders = [crypto.dump_certificate(crypto.FILETYPE_ASN1, c) for c in chain]
+    return b"".join(_CERT_HEADER.pack(len(der)) + der for der in ders)
+
+
+def _unpackChain(data):
+    rv = []
+    offset = 0
+    while offset < len(data):
+        (length,) = _CERT_HEADER.unpack_from(data, offset)
+        offset += _CERT_HEADER.size
+        rv.append(crypto.load_certificate(
+            crypto.FILETYPE_ASN1, bytes(data[offset:offset + length])
+        ))
+        offset += length
+    return rv
+
+
+def certificateExpires(cert):
+    """
+    Return when I{cert} expires in seconds since the epoch.
+
+    @type cert: L{crypto.X509}
+
+    @rtype: L{float}
+    """
+    notAfter = cert.get_notAfter().decode("ascii")
+    return float(calendar.timegm(time.strptime(notAfter, "%Y%m%d%H%M%SZ")))
+
+
+
+class StoredResult(object):
+    """
+    A check result as kept by L{ScanStore}.
+
+    @ivar checked: When the result was last updated.
+    @ivar dnsExpires: When the TLSA answer expires.
+    @ivar errorCode: The getdns status of a negative answer, C{None} if
+        there are TLSA records.
+    @ivar trusted: Whether the TLSA records are DNSSEC-validated.
+    @ivar records: The L{TLSARecord}s.
+    @ivar rrsetHash: The L{rrsetHash} of C{records}.
+    @ivar handshaked: When the certificate chain was retrieved or C{None}.
+    @ivar certFingerprint: The SHA-256 digest of the server's certificate.
+    @ivar certExpires: When the server's certificate expires.
+    @ivar chain: The presented certificates, the server's own first, or
+        C{None} if there hasn't been a successful handshake.
+    """
+    def __init__(self, checked, dnsExpires, errorCode=None, trusted=False,
+                 records=(), rrsetHash=None, handshaked=None,
+                 certFingerprint=None, certExpires=None, chain=None):
+        self.checked = checked
+        self.dnsExpires = dnsExpires
+        self.errorCode = errorCode
+        self.trusted = trusted
+        self.records = list(records)
+        self.rrsetHash = rrsetHash
+        self.handshaked = handshaked
+        self.certFingerprint = certFingerprint
+        self.certExpires = certExpires
+        self.chain = chain
+
+
+
+class ScanStore(object):
+    """
+    Check results in an SQLite database, keyed by TLSA domain name.
+
+    Writes are committed in batches of C{commitEvery} and on L{close}.
+    """
+    def __init__(self, path, commitEvery=1000):
+        """
+        @param path: The database file.  It's created if it doesn't exist.
+        """
+        self._db = sqlite3.connect(path)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(_SCHEMA)
+        self.commitEvery = commitEvery
+        self._uncommitted = 0
+
+
+    def get(self, name):
+        """
+        Return the stored result for I{name}.
+
+        @rtype: L{StoredResult} or C{None}
+        """
+        row = self._db.execute(
+            "SELECT checked, dnsExpires, errorCode, trusted, records, "
+            "rrsetHash, handshaked, certFingerprint, certExpires, chain "
+            "FROM results WHERE name = ?", (name,)
+        ).fetchone()
+        if row is None:
+            return None
+        (checked, dnsExpires, errorCode, trusted, records, hash_, handshaked,
+         fingerprint, certExpires, chain) = row
+        return StoredResult(
+            checked, dnsExpires, errorCode, bool(trusted),
+            unpackRecords(bytes(records or b"")),
+            bytes(hash_) if hash_ is not None else None, handshaked,
+            bytes(fingerprint) if fingerprint is not None else None,
+            certExpires, _unpackChain(chain) if chain is not None else None,
+        )
+
+
+    def put(self, name, result):
+        """
+        Store I{result} for I{name}, replacing what has been stored before.
+
+        @type result: L{StoredResult}
+        """
+        chain = result.chain
+        self._db.execute(
+            "INSERT OR REPLACE INTO results VALUES "
+            "(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (name, result.checked, result.dnsExpires, result.errorCode,
+             int(result.trusted), sqlite3.Binary(packRecords(result.records)),
+             result.rrsetHash and sqlite3.Binary(result.rrsetHash),
+             result.handshaked,
+             result.certFingerprint and sqlite3.Binary(result.certFingerprint),
+             result.certExpires,
+             sqlite3.Binary(_packChain(chain)) if chain is not None else None)
+        )
+        self._uncommitted += 1
+        if self._uncommitted >= self.commitEvery:
+            self.commit()
+
+
+    def __len__(self):
+        return self._db.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+
+
+    def commit(self):
+        self._db.commit()
+        self._uncommitted = 0
+
+
+    def close(self):
+        self.commit()
+        self._db.close()
+
+
+
+class IncrementalChecker(object):
+    """
+    Checks targets like L{danex._check.checkTarget} and records the results
+    in a L{ScanStore}.
+
+    If C{incremental} is true, stored results are reused as far as possible:
+    a TLSA answer whose TTL hasn't expired isn't resolved again, and the
+    certificate chain is only retrieved again if the TLSA RRset changed, the
+    server's certificate expires within C{maxCertAge} or it's been longer
+    than C{maxCertAge} since the last handshake.
+
+    @ivar resolved: Number of TLSA lookups.
+    @ivar handshakes: Number of certificate chain retrievals.
+    @ivar reused: Number of checks that have been answered from the store
+        without any network traffic.
+    """
+    def __init__(self, store, reactor=None, incremental=True,
+                 maxCertAge=86400, timeout=None, resolve=None,
+                 retrieve=None):
+        """
+        @param store: The L{ScanStore} to use.
+        @param reactor: The reactor to use.  If C{None}, the global reactor
+            is used.
+        @param maxCertAge: Seconds after which a certificate chain is
+            retrieved again even if nothing indicates a change.
+        @param timeout: Seconds after which a check is given up.
+        @param resolve: Called with a TLSA domain name, returns a
+            L{defer.Deferred} like
+            L{danex._resolver.TLSAResolver.lookupTLSA}.  The process-wide
+            resolver is used if C{None}.
+        @param retrieve: Called with a host and a port, returns a
+            L{defer.Deferred} that fires with a certificate chain.
+        """
+        if reactor is None:
+            from twisted.internet import reactor
+        if resolve is None:
+            resolve = _resolver.getResolver().lookupTLSA
+        if retrieve is None:
+            def retrieve(host, port):
+                # A rescan needs what the server presents now, not the
+                # chain of a resumed session.
+                return _tls.retrieveCertificateChain(host, port,
+                                                     reactor=reactor,
+                                                     resume=False)
+        self._store = store
+        self._reactor = reactor
+        self._resolve = resolve
+        self._retrieve = retrieve
+        self.incremental = incremental
+        self.maxCertAge = maxCertAge
+        self.timeout = timeout
+        self.resolved = 0
+        self.handshakes = 0
+        self.reused = 0
+
+
+    def _certDue(self, entry, now):
+        return (
+            entry is None
+            or entry.chain is None
+            or entry.handshaked + self.maxCertAge <= now
+            or entry.certExpires - self.maxCertAge <= now
+        )
+
+
+    def check(self, host, port, proto):
+        """
+        Check a target.
+
+        @rtype: L{defer.Deferred} that fires like
+            L{danex._check.checkTarget}.
+        """
+        d = self._check(host, port, proto)
+        if self.timeout is not None:
+            d.addTimeout(self.timeout, self._reactor)
+        d.addBoth(_check._countOutcome)
+        return d
+
+
+    @defer.inlineCallbacks
+    def _check(self, host, port, proto):
+        name = tlsaDomainName(host, port, proto)
+        now = self._reactor.seconds()
+        entry = self._store.get(name) if self.incremental else None
+        fresh = entry is not None and entry.dnsExpires > now
+
+        if fresh and entry.errorCode is not None:
+            self.reused += 1
+            raise GetdnsResponseError(entry.errorCode, entry.dnsExpires - now)
+
+        chainD = None
+        if self._certDue(entry, now):
+            chainD = self._retrieveChain(host, port)
+
+        if fresh:
+            trusted, records = entry.trusted, entry.records
+            dnsExpires, hash_ = entry.dnsExpires, entry.rrsetHash
+        else:
+            self.resolved += 1
+            try:
+                trusted, records, ttl = yield self._resolve(name)
+            except Exception as e:
+                if chainD is not None:
+                    chainD.addErrback(lambda _: None)
+                    chainD.cancel()
+                if isinstance(e, GetdnsResponseError) and e.ttl:
+                    self._store.put(name, StoredResult(
+                        now, now + e.ttl, errorCode=e.errorCode,
+                    ))
+                raise
+            dnsExpires, hash_ = now + (ttl or 0), rrsetHash(records)
+
+        if chainD is None and hash_ != entry.rrsetHash:
+            chainD = self._retrieveChain(host, port)
+
+        if chainD is not None:
+            chain = yield chainD
+            handshaked = now
+        else:
+            chain, handshaked = entry.chain, entry.handshaked
+            if fresh:
+                self.reused += 1
+
+        self._store.put(name, StoredResult(
+            now, dnsExpires, trusted=trusted, records=records,
+            rrsetHash=hash_, handshaked=handshaked,
+            certFingerprint=hashlib.sha256(crypto.dump_certificate(
+                crypto.FILETYPE_ASN1, chain[0]
+            )).digest(),
+            certExpires=certificateExpires(chain[0]), chain=chain,
+        ))
+        defer.returnValue(((trusted, records), chain))
+
+
+    def _retrieveChain(self, host, port):
+        self.handshakes += 1
+        return self._retrieve(host, port)
@@ -4,34 +4,728 @@
 
 from __future__ import absolute_import, division, print_function
 
-import socket
+from collections import OrderedDict
 
 import idna
 
-from twisted.internet import threads
 from OpenSSL import SSL
+from twisted.internet import defer
+from twisted.internet.abstract import isIPAddress, isIPv6Address
+from twisted.internet.endpoints import (
+    HostnameEndpoint, TCP4ClientEndpoint, TCP6ClientEndpoint, wrapClientTLS,
+)
+from twisted.internet.error import ConnectionDone, DNSLookupError
+from twisted.internet.interfaces import (
+    IHandshakeListener, IOpenSSLClientConnectionCreator, IResolutionReceiver,
+)
+from twisted.internet.protocol import Factory, Protocol
+from twisted.protocols.basic import LineOnlyReceiver
+from zope.interface import implementer
 
+from . import _metrics
 
-def retrieveCertificate(hostname, port):
+
+try:
+    from OpenSSL._util import lib as _lib
+    _SSL_session_reused = _lib.SSL_session_reused
+except (ImportError, AttributeError):
+    _SSL_session_reused = None
+
+
+_context = None
+
+
+def _getContext():
+    """
+    Return the client context that is shared by all probes.
+
+    No verification is done because we're only interested in the
+    certificate the server presents.
+    """
+    global _context
+    if _context is None:
+        _context = SSL.Context(SSL.SSLv23_METHOD)
+    return _context
+
+
+
+class CertificateChain(list):
+    """
+    The certificates that a server presented, its own first.
+
+    @ivar resumed: Whether the handshake resumed a session.  If so, the
+        chain is the one stored in the session, not one the server just
+        sent, and it may be outdated.
+    """
+    resumed = False
+
+    def __init__(self, certificates, resumed=False):
+        list.__init__(self, certificates)
+        self.resumed = resumed
+
+
+
+def _sessionReused(connection):
+    """
+    Whether the handshake of I{connection} resumed a session.
+
+    pyOpenSSL doesn't wrap C{SSL_session_reused}, so this relies on its
+    private bindings.  If they aren't available, the session is reported as
+    not resumed.
+
+    @type connection: L{SSL.Connection}
+    """
+    ssl = getattr(connection, "_ssl", None)
+    if _SSL_session_reused is None or ssl is None:
+        return False
+    return bool(_SSL_session_reused(ssl))
+
+
+
+class SessionCache(object):
+    """
+    An LRU cache of TLS sessions and the fingerprints of the certificates
+    that have been presented, keyed by C{(hostname, port, address)}.
+
+    Offering a cached session lets the server resume it with an abbreviated
+    handshake that skips the asymmetric cryptography on both sides.  The
+    fingerprints tell whether a server presents a different certificate
+    than the last time it has been probed.
+
+    A resumed handshake doesn't transfer the certificate again, so sessions
+    are only offered as long as the last full handshake with the endpoint
+    is less than C{maxAge} seconds ago and the endpoint's TLSA RRset hasn't
+    changed since.
+
+    @ivar maxAge: Seconds after a full handshake during which sessions may
+        be resumed.
+    @ivar offered: Number of handshakes that offered a cached session.
+    @ivar resumed: Number of handshakes that resumed a session.
+    @ivar changed: Number of probes whose certificate differed from the one
+        seen before.
+    """
+    def __init__(self, maxSize=4096, maxAge=3600, clock=None):
+        """
+        @param maxSize: Maximum number of endpoints to remember.
+        @param clock: An L{IReactorTime} provider.  If C{None}, the global
+            reactor is used.
+        """
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.maxSize = maxSize
+        self.maxAge = maxAge
+        self._clock = clock
+        self._entries = OrderedDict()
+        self.offered = 0
+        self.resumed = 0
+        self.changed = 0
+
+
+    def __len__(self):
+        return len(self._entries)
+
+
+    def session(self, key, tag=None):
+        """
+        Return the session to offer when connecting to I{key}.
+
+        @param tag: Identifies the TLSA RRset of the endpoint.  Sessions that
+            have been established under a different one aren't offered.
+
+        @rtype: L{SSL.Session} or C{None}
+        """
+        entry = self._entries.get(key)
+        if (entry is None or entry.session is None or entry.tag != tag
+                or entry.seen + self.maxAge <= self._clock.seconds()):
+            return None
+        self.offered += 1
+        return entry.session
+
+
+    def fingerprint(self, key):
+        """
+        Return the SHA-256 fingerprint of the certificate that I{key}
+        presented last or C{None} if it hasn't been probed.
+
+        @rtype: L{bytes} or C{None}
+        """
+        entry = self._entries.get(key)
+        return entry.fingerprint if entry is not None else None
+
+
+    def certificateSeen(self, key, fingerprint, tag=None):
+        """
+        Remember that I{key} presented a certificate with I{fingerprint} in
+        a full handshake.
+
+        @param tag: Like L{session}'s.
+
+        @return: Whether the certificate differs from the last one seen.
+            Endpoints that haven't been probed before never changed.
+        @rtype: L{bool}
+        """
+        old = self._entries.pop(key, None)
+        changed = old is not None and old.fingerprint not in (
+            None, fingerprint,
+        )
+        if changed:
+            self.changed += 1
+        self._store(key, _SessionEntry(
+            None if old is None or changed else old.session,
+            fingerprint, self._clock.seconds(), tag,
+        ))
+        return changed
+
+
+    def sessionResumed(self, key):
+        """
+        Count that a handshake with I{key} resumed a session.
+        """
+        self.resumed += 1
+
+
+    def sessionEstablished(self, key, session):
+        """
+        Remember I{session} for the next connection to I{key}.
+
+        @param session: The session or C{None} to forget it, for instance
+            because the connection wasn't shut down cleanly.
+        """
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            if session is None:
+                return
+            entry = _SessionEntry(None, None, self._clock.seconds(), None)
+        entry.session = session
+        self._store(key, entry)
+
+
+    def _store(self, key, entry):
+        if self.maxSize <= 0:
+            return
+        self._entries[key] = entry
+        while len(self._entries) > self.maxSize:
+            self._entries.popitem(last=False)
+
+
+    def clear(self):
+        """
+        Forget all sessions and fingerprints.
+        """
+        self._entries.clear()
+
+
+
+class _SessionEntry(object):
+    """
+    What a L{SessionCache} knows about an endpoint.
+
+    @ivar seen: When the last full handshake happened.
+    """
+    __slots__ = ("session", "fingerprint", "seen", "tag")
+
+    def __init__(self, session, fingerprint, seen, tag):
+        self.session = session
+        self.fingerprint = fingerprint
+        self.seen = seen
+        self.tag = tag
+
+
+
+_sessions = None
+
+
+def getSessionCache():
+    """
+    Return the process-wide L{SessionCache}, creating it if necessary.
+    """
+    global _sessions
+    if _sessions is None:
+        _sessions = SessionCache()
+    return _sessions
+
+
+
+def _isIPLiteral(hostname):
+    return isIPAddress(hostname) or isIPv6Address(hostname)
+
+
+def _encodeHostname(hostname):
+    """
+    Encode I{hostname} for connecting to it.
+
+    IP literals -- which IDNA can't encode -- are passed on as they are.
+
+    @type hostname: L{unicode}
+
+    @rtype: L{bytes}
+    """
+    if _isIPLiteral(hostname):
+        return hostname.encode("ascii")
+    return idna.encode(hostname)
+
+
+def _serverName(hostname):
+    """
+    Return the SNI server name for I{hostname}.
+
+    @see: U{https://tools.ietf.org/html/rfc6066#section-3}
+
+    @type hostname: L{unicode}
+
+    @return: The IDNA-encoded I{hostname} or C{None} if it's an IP literal,
+        which mustn't be sent as SNI.
+    @rtype: L{bytes} or C{None}
+    """
+    if _isIPLiteral(hostname):
+        return None
+    return idna.encode(hostname)
+
+
+
+@implementer(IOpenSSLClientConnectionCreator)
+class _ProbeConnectionCreator(object):
+    """
+    Creates client connections that send I{hostname} as SNI unless it's
+    C{None} and offer I{session} if it's not C{None}.
+
+    @ivar connection: The last connection that has been created.
+    """
+    def __init__(self, hostname, context, session=None):
+        self._hostname = hostname
+        self._context = context
+        self._session = session
+        self.connection = None
+
+
+    def clientConnectionForTLS(self, tlsProtocol):
+        conn = SSL.Connection(self._context, None)
+        conn.set_app_data(tlsProtocol)
+        if self._hostname is not None:
+            conn.set_tlsext_host_name(self._hostname)
+        if self._session is not None:
+            conn.set_session(self._session)
+        conn.set_connect_state()
+        self.connection = conn
+        return conn
+
+
+
+@implementer(IHandshakeListener)
+class _CertificateProbe(Protocol):
+    """
+    Waits for the TLS handshake to finish and hangs up without sending any
+    application data.
+
+    If I{resume} is true, the session that I{sessions} holds for the
+    endpoint is offered.  Either way, the connection is shut down cleanly
+    afterwards so the new session stays resumable.  The shutdown is given up
+    after C{handshakeTimeout} seconds.
+
+    @ivar chain: A L{defer.Deferred} that fires with the
+        L{CertificateChain} that the peer presented.
+    """
+    def __init__(self, clock, handshakeTimeout, hostname, sessions,
+                 resume=False, tag=None):
+        self._clock = clock
+        self._handshakeTimeout = handshakeTimeout
+        self._hostname = hostname
+        self._sessions = sessions
+        self._resume = resume
+        self._tag = tag
+        self._key = None
+        self._connection = None
+        self._timeoutCall = None
+        self.chain = defer.Deferred(
+            lambda d: self.transport.abortConnection()
+        )
+
+
+    def connectionMade(self):
+        self._startTimer()
+        session = self._cachedSession()
+        if session is not None:
+            self._tlsConnection().set_session(session)
+
+
+    def _startTimer(self):
+        self._handshakeTimer = _metrics.HANDSHAKE_LATENCY.time()
+        self._timeoutCall = self._clock.callLater(
+            self._handshakeTimeout, self._timedOut
+        )
+
+
+    def _cachedSession(self):
+        peer = self.transport.getPeer()
+        self._key = (self._hostname, peer.port, peer.host)
+        if not self._resume or _SSL_session_reused is None:
+            # A resumed handshake that can't be told apart from a full one
+            # would be reported with the chain of the original handshake.
+            return None
+        return self._sessions.session(self._key, self._tag)
+
+
+    def _tlsConnection(self):
+        """
+        Return the L{SSL.Connection} of the probe.
+        """
+        return self.transport.getHandle()
+
+
+    def _timedOut(self):
+        self._timeoutCall = None
+        self._fire(failure=defer.TimeoutError(
+            "TLS handshake took longer than {0} seconds."
+            .format(self._handshakeTimeout)
+        ))
+        self.transport.abortConnection()
+
+
+    def handshakeCompleted(self):
+        self._handshakeTimer.stop()
+        connection = self._tlsConnection()
+        chain = CertificateChain(
+            connection.get_peer_cert_chain()
+            or [self.transport.getPeerCertificate()],
+            resumed=self._resume and _sessionReused(connection),
+        )
+        if chain.resumed:
+            self._sessions.sessionResumed(self._key)
+        else:
+            self._sessions.certificateSeen(
+                self._key, chain[0].digest("sha256"), self._tag
+            )
+        self._fire(chain)
+        self._connection = connection
+        self._timeoutCall = self._clock.callLater(
+            self._handshakeTimeout, self.transport.abortConnection
+        )
+        self.transport.loseConnection()
+
+
+    def connectionLost(self, reason):
+        if self._connection is not None:
+            self._sessions.sessionEstablished(
+                self._key,
+                self._connection.get_session()
+                if reason.check(ConnectionDone) else None,
+            )
+        self._fire(failure=reason)
+
+
+    def _fire(self, result=None, failure=None):
+        if self._timeoutCall is not None and self._timeoutCall.active():
+            self._timeoutCall.cancel()
+        self._timeoutCall = None
+        if self.chain is None:
+            return
+        d, self.chain = self.chain, None
+        if failure is not None:
+            d.errback(failure)
+        else:
+            d.callback(result)
+
+
+
+class SMTPError(Exception):
+    """
+    An SMTP server didn't let us start TLS.
+    """
+
+
+
+class _SMTPProbe(LineOnlyReceiver, _CertificateProbe):
+    """
+    Talks SMTP until the server agrees to start TLS and then waits for the
+    handshake like L{_CertificateProbe}.
+
+    The C{handshakeTimeout} covers the SMTP dialogue too.
+
+    @see: U{https://tools.ietf.org/html/rfc3207}
+    """
+    ehloName = b"localhost"
+
+    def __init__(self, *args, **kw):
+        _CertificateProbe.__init__(self, *args, **kw)
+        self._state = "greeting"
+        self._extensions = []
+        self._creator = None
+
+
+    def connectionMade(self):
+        self._startTimer()
+
+
+    def lineReceived(self, line):
+        code, more = line[:3], line[3:4] == b"-"
+        if self._state == "ehlo":
+            self._extensions.append(line[4:].split(b" ")[0].upper())
+        if more or self._state == "tls":
+            return
+
+        if self._state == "greeting" and code == b"220":
+            self._state = "ehlo"
+            self.sendLine(b"EHLO " + self.ehloName)
+        elif self._state == "ehlo" and code == b"250":
+            if b"STARTTLS" not in self._extensions:
+                self._refused("STARTTLS isn't supported.")
+                return
+            self._state = "starttls"
+            self.sendLine(b"STARTTLS")
+        elif self._state == "starttls" and code == b"220":
+            self._state = "tls"
+            self._creator = _ProbeConnectionCreator(
+                _serverName(self._hostname), _getContext(),
+                self._cachedSession(),
+            )
+            self.transport.startTLS(self._creator)
+        else:
+            self._refused(line.decode("utf-8", "replace"))
+
+
+    def _refused(self, reason):
+        self._fire(failure=SMTPError(reason))
+        self.sendLine(b"QUIT")
+        self.transport.loseConnection()
+
+
+    def _tlsConnection(self):
+        return self._creator.connection
+
+
+    def lineLengthExceeded(self, line):
+        self._refused("SMTP response too long.")
+
+
+
+_STARTTLS_PROBES = {
+    "smtp": _SMTPProbe,
+}
+
+
+def _probe(reactor, hostname, endpoint, handshakeTimeout, sessions,
+           starttls=None, resume=False, tag=None):
+    """
+    Connect to I{endpoint} and retrieve the certificate chain.
+
+    @rtype: L{defer.Deferred} that fires with the address that has been
+        connected to and the chain.
+    """
+    if starttls is None:
+        endpoint = wrapClientTLS(
+            _ProbeConnectionCreator(_serverName(hostname), _getContext()),
+            endpoint,
+        )
+        probeType = _CertificateProbe
+    else:
+        probeType = _STARTTLS_PROBES[starttls]
+    d = endpoint.connect(Factory.forProtocol(
+        lambda: probeType(reactor, handshakeTimeout, hostname, sessions,
+                          resume, tag)
+    ))
+
+    def connected(probe):
+        address = probe.transport.getPeer().host
+        return probe.chain.addCallback(lambda chain: (address, chain))
+
+    return d.addCallback(connected)
+
+
+def retrieveCertificateChain(hostname, port, reactor=None, connectTimeout=10,
+                             handshakeTimeout=10, sessions=None,
+                             starttls=None, resume=False, sessionTag=None):
+    """
+    Retrieve all certificates that a server presents in its handshake.
+
+    If I{hostname} has several addresses, the first one that accepts the
+    connection is used.
+
+    @type hostname: L{unicode}
+    @type port: int
+    @param reactor: The reactor to connect with.  If C{None}, the global
+        reactor is used.
+    @param connectTimeout: Seconds to wait for the TCP connection.
+    @param handshakeTimeout: Seconds to wait for the TLS handshake once
+        connected.
+    @param sessions: The L{SessionCache} to resume sessions from and to
+        record the presented certificate in.  If C{None}, the process-wide
+        one is used.
+    @param starttls: The application protocol to upgrade to TLS using its
+        STARTTLS command, for instance C{"smtp"}.  If C{None}, TLS is
+        spoken from the first byte.
+    @param resume: Whether to offer the session from I{sessions}.  A
+        resumed handshake yields the chain of the original handshake, so
+        only resume if a chain that is up to C{sessions.maxAge} seconds old
+        will do.
+    @param sessionTag: Identifies the TLSA RRset of the server.  Sessions
+        that have been established under another one aren't resumed.
+
+    @rtype: deferred that fires with a L{CertificateChain} of x509, the
+        server's own certificate first.  If the server refuses to start
+        TLS, it fails with an L{SMTPError}.
+    """
+    if reactor is None:
+        from twisted.internet import reactor
+    if sessions is None:
+        sessions = getSessionCache()
+    _checkStartTLS(starttls)
+    d = _probe(reactor, hostname, HostnameEndpoint(
+        reactor, _encodeHostname(hostname), int(port),
+        timeout=connectTimeout,
+    ), handshakeTimeout, sessions, starttls, resume, sessionTag)
+    d.addCallback(lambda res: res[1])
+    return d
+
+
+def _checkStartTLS(starttls):
+    if starttls is not None and starttls not in _STARTTLS_PROBES:
+        raise ValueError(
+            "Unknown STARTTLS protocol {0!r}.".format(starttls)
+        )
+
+
+def retrieveCertificate(hostname, port, **kw):
     """
+    Retrieve the certificate of a server.
+
+    Takes the same arguments as L{retrieveCertificateChain}.
+
     @type hostname: L{unicode}
     @type port: int
 
     @rtype: deferred that fires with an x509
     """
+    d = retrieveCertificateChain(hostname, port, **kw)
+    d.addCallback(lambda chain: chain[0])
+    return d
+
+
+
+@implementer(IResolutionReceiver)
+class _AddressCollector(object):
+    def __init__(self):
+        self.addresses = []
+        self.deferred = defer.Deferred()
+
+
+    def resolutionBegan(self, resolution):
+        pass
+
+
+    def addressResolved(self, address):
+        if address.host not in self.addresses:
+            self.addresses.append(address.host)
 
-    def handshake():
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        tls_ctx = SSL.Context(SSL.SSLv23_METHOD)
-        conn = SSL.Connection(
-            tls_ctx,
-            sock
+
+    def resolutionComplete(self):
+        self.deferred.callback(self.addresses)
+
+
+
+def resolveAddresses(hostname, port, reactor=None):
+    """
+    Look up all IPv4 and IPv6 addresses of I{hostname}.
+
+    @type hostname: L{unicode}
+    @param reactor: An L{IReactorPluggableNameResolver}.  If C{None}, the
+        global reactor is used.
+
+    @rtype: L{defer.Deferred} that fires with a L{list} of addresses in the
+        order of the resolver or fails with L{DNSLookupError} if there are
+        none.
+    """
+    if _isIPLiteral(hostname):
+        return defer.succeed([hostname])
+    if reactor is None:
+        from twisted.internet import reactor
+    collector = _AddressCollector()
+    reactor.nameResolver.resolveHostName(
+        collector, idna.encode(hostname).decode("ascii"), portNumber=port,
+    )
+
+    def check(addresses):
+        if not addresses:
+            raise DNSLookupError(hostname)
+        return addresses
+
+    return collector.deferred.addCallback(check)
+
+
+def retrieveCertificateChains(hostname, port, reactor=None,
+                              connectTimeout=10, handshakeTimeout=10,
+                              maxConcurrent=4, resolve=resolveAddresses,
+                              sessions=None, starttls=None, resume=False,
+                              sessionTag=None):
+    """
+    Retrieve the certificate chains of all addresses of a host.
+
+    The first chain is retrieved exactly like L{retrieveCertificateChain}
+    does while all addresses are looked up.  If the host has only one
+    address -- which is the common case -- that's it.  Otherwise, the
+    remaining addresses are probed concurrently.
+
+    @type hostname: L{unicode}
+    @type port: int
+    @param maxConcurrent: Maximum number of concurrent handshakes with the
+        host.
+    @param resolve: Called like L{resolveAddresses}.  For testing purposes.
+    @param sessions: Like L{retrieveCertificateChain}'s.  Sessions and
+        certificates are kept per address.
+
+    Other arguments are like L{retrieveCertificateChain}'s.
+
+    @rtype: L{defer.Deferred} that fires with a L{list} of C{(address,
+        result)} tuples, one per address.  C{result} is either the chain
+        that the address presented or a L{Failure}.
+    """
+    if reactor is None:
+        from twisted.internet import reactor
+    if sessions is None:
+        sessions = getSessionCache()
+    _checkStartTLS(starttls)
+    encoded = _encodeHostname(hostname)
+    semaphore = defer.DeferredSemaphore(maxConcurrent)
+    results = {}
+
+    def probe(address):
+        endpointType = (
+            TCP6ClientEndpoint if isIPv6Address(address)
+            else TCP4ClientEndpoint
         )
-        conn.connect((idna.encode(hostname).encode("ascii"), 443))
-        conn.do_handshake()
-        cert = conn.get_peer_certificate()
-        conn.shutdown()
-        conn.close()
-        return cert
+        d = _probe(reactor, hostname, endpointType(
+            reactor, address, int(port), timeout=connectTimeout,
+        ), handshakeTimeout, sessions, starttls, resume, sessionTag)
+        d.addCallback(lambda res: res[1])
+        d.addBoth(lambda res: results.__setitem__(address, res))
+        return d
+
+    def first(res):
+        address, chain = res
+        results[address] = chain
+        return address
+
+    firstD = semaphore.run(
+        _probe, reactor, hostname,
+        HostnameEndpoint(reactor, encoded, int(port), timeout=connectTimeout),
+        handshakeTimeout, sessions, starttls, resume, sessionTag,
+    )
+    firstD.addCallbacks(first, lambda f: None)
+
+    def probeOthers(res):
+        (_, firstAddress), (_, addresses) = res
+        if firstAddress is not None and firstAddress not in addresses:
+            addresses.insert(0, firstAddress)
+        d = defer.gatherResults([
+            semaphore.run(probe, address)
+            for address in addresses if address not in results
+        ])
+        d.addCallback(lambda _: [
+            (address, results[address]) for address in addresses
+        ])
+        return d
 
-    return threads.deferToThread(handshake)
+    d = defer.DeferredList([firstD, resolve(hostname, port, reactor)],
+                           fireOnOneErrback=True, consumeErrors=True)
+    d.addErrback(lambda f: f.value.subFailure)
+    d.addCallback(probeOthers)
+    return d
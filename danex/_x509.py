@@ -4,27 +4,23 @@
 
 from __future__ import absolute_import, division, print_function
 
-from OpenSSL import _util
+from OpenSSL import crypto
 
 
 def extractPublicKey(cert):
     """
     Extract the public key from a certificate.
 
+    Works for all key types that OpenSSL supports -- RSA, EC, Ed25519, ... --
+    and encodes the key only once.
+
+    If the same certificate is matched repeatedly, use
+    L{danex._dane.CertificateFingerprints.spki} which caches the result.
+
     @param cert: Certificate to be dissected.
     @type cert: x509
 
-    @return: Public key in ASN.1.
+    @return: DER-encoded SubjectPublicKeyInfo.
     @rtype: L{bytes}
     """
-    pk = cert.get_pubkey()
-
-    b = _util.binding
-    l = b.lib
-    ffi = b.ffi
-    rsa = l.EVP_PKEY_get1_RSA(pk._pkey)
-    buf = ffi.new("unsigned char **")
-    length = l.i2d_RSA_PUBKEY(rsa, buf)
-    pk = ffi.buffer(buf[0], length)[:]
-    ffi.gc(buf[0], l.OPENSSL_free)
-    return pk
+    return crypto.dump_publickey(crypto.FILETYPE_ASN1, cert.get_pubkey())
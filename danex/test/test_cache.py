@@ -0,0 +1,148 @@
+# Copyright (c) Hynek Schlawack, Richard Wall
+# See LICENSE for details.
+
+from __future__ import absolute_import, division, print_function
+
+from twisted.internet import defer
+from twisted.internet.task import Clock
+from twisted.trial.unittest import SynchronousTestCase
+
+from danex._cache import TLSACache
+from danex._dane import GetdnsResponseError
+
+
+class FakeResolver(object):
+    """
+    Records the names it's asked for and hands out unfired L{Deferred}s.
+    """
+    def __init__(self):
+        self.pending = []
+
+
+    def resolve(self, name):
+        d = defer.Deferred()
+        self.pending.append((name, d))
+        return d
+
+
+
+class TLSACacheTests(SynchronousTestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.resolver = FakeResolver()
+        self.cache = TLSACache(self.resolver.resolve, self.clock, maxSize=2)
+
+
+    def test_hit(self):
+        """
+        A cached answer is returned without resolving again.
+        """
+        d = self.cache.lookup("a")
+        self.resolver.pending[0][1].callback((True, ["rec"], 60))
+        self.successResultOf(d)
+
+        self.assertEqual(
+            (True, ["rec"]), self.successResultOf(self.cache.lookup("a"))
+        )
+        self.assertEqual(
+            (1, 1, 1), (len(self.resolver.pending), self.cache.hits,
+                        self.cache.misses)
+        )
+
+
+    def test_expiry(self):
+        """
+        Answers expire after their TTL.
+        """
+        self.cache.lookup("a")
+        self.resolver.pending[0][1].callback((True, [], 60))
+        self.clock.advance(60)
+        self.cache.lookup("a")
+
+        self.assertEqual(2, len(self.resolver.pending))
+
+
+    def test_maxTTL(self):
+        """
+        TTLs are capped at C{maxTTL}.
+        """
+        self.cache.maxTTL = 10
+        self.cache.lookup("a")
+        self.resolver.pending[0][1].callback((True, [], 60))
+        self.clock.advance(10)
+        self.cache.lookup("a")
+
+        self.assertEqual(2, len(self.resolver.pending))
+
+
+    def test_coalesce(self):
+        """
+        Concurrent lookups of the same name cause only one resolution.
+        """
+        d1 = self.cache.lookup("a")
+        d2 = self.cache.lookup("a")
+        self.resolver.pending[0][1].callback((False, ["rec"], 60))
+
+        self.assertEqual(
+            [(False, ["rec"])] * 2,
+            [self.successResultOf(d1), self.successResultOf(d2)]
+        )
+        self.assertEqual(
+            (1, 1), (len(self.resolver.pending), self.cache.coalesced)
+        )
+
+
+    def test_ownLists(self):
+        """
+        Coalesced and cached lookups don't share the list of records, so a
+        caller that changes it doesn't affect the others.
+        """
+        d1 = self.cache.lookup("a")
+        d2 = self.cache.lookup("a")
+        self.resolver.pending[0][1].callback((True, ["rec"], 60))
+        self.successResultOf(d1)[1].append("evil")
+
+        self.assertEqual((True, ["rec"]), self.successResultOf(d2))
+        self.successResultOf(self.cache.lookup("a"))[1].append("evil")
+        self.assertEqual(
+            (True, ["rec"]), self.successResultOf(self.cache.lookup("a"))
+        )
+
+
+    def test_negative(self):
+        """
+        Negative answers are cached for their TTL.
+        """
+        d = self.cache.lookup("a")
+        self.resolver.pending[0][1].errback(GetdnsResponseError(901, ttl=30))
+        self.failureResultOf(d, GetdnsResponseError)
+
+        f = self.failureResultOf(self.cache.lookup("a"), GetdnsResponseError)
+        self.assertEqual(901, f.value.errorCode)
+        self.assertEqual(1, len(self.resolver.pending))
+
+
+    def test_otherFailuresNotCached(self):
+        """
+        Failures without a TTL are not cached.
+        """
+        d = self.cache.lookup("a")
+        self.resolver.pending[0][1].errback(GetdnsResponseError(902))
+        self.failureResultOf(d, GetdnsResponseError)
+        self.cache.lookup("a")
+
+        self.assertEqual(2, len(self.resolver.pending))
+
+
+    def test_lru(self):
+        """
+        If the cache is full, the least recently used entry is dropped.
+        """
+        for i, name in enumerate(["a", "b"]):
+            self.cache.lookup(name)
+            self.resolver.pending[i][1].callback((True, [], 60))
+        self.cache.lookup("a")
+        self.cache.lookup("c")
+        self.resolver.pending[2][1].callback((True, [], 60))
+
+        self.assertEqual(["a", "c"], list(self.cache._entries))
@@ -0,0 +1,225 @@
+# Copyright (c) Hynek Schlawack, Richard Wall
+# See LICENSE for details.
+
+from __future__ import absolute_import, division, print_function
+
+from twisted.internet import defer, task
+from twisted.python.failure import Failure
+from twisted.trial.unittest import SynchronousTestCase
+
+from danex import _check
+from danex._dane import GetdnsResponseError, TLSARecord
+
+
+class ParseTargetsTests(SynchronousTestCase):
+    def test_parse(self):
+        """
+        Each non-empty, non-comment line is a target.
+        """
+        self.assertEqual(
+            [(("example.com", 443, "tcp"), None),
+             (("example.org", 25, "tcp"), None)],
+            list(_check.parseTargets([
+                "example.com 443 tcp\n",
+                "\n",
+                "# comment\n",
+                "  example.org   25 tcp  \n",
+            ]))
+        )
+
+
+    def test_malformed(self):
+        """
+        Malformed lines are passed on together with a L{ValueError}.
+        """
+        ((line, error),) = _check.parseTargets(["example.com https tcp"])
+
+        self.assertEqual("example.com https tcp", line)
+        self.assertIsInstance(error, ValueError)
+
+
+
+class CheckTargetsTests(SynchronousTestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.cooperator = task.Cooperator(
+            scheduler=lambda f: self.clock.callLater(0, f)
+        )
+        self.pending = {}
+        self.patch(_check, "checkTarget", self.fakeCheckTarget)
+        self.reports = []
+
+
+    def fakeCheckTarget(self, host, port, proto, timeout, reactor):
+        d = self.pending[host] = defer.Deferred()
+        return d
+
+
+    def checkTargets(self, targets, concurrency):
+        d = _check.checkTargets(
+            iter(targets), lambda *args: self.reports.append(args),
+            concurrency=concurrency, cooperator=self.cooperator,
+        )
+        self.clock.advance(0)
+        return d
+
+
+    def test_concurrency(self):
+        """
+        No more than C{concurrency} targets are checked at once and results
+        are reported as soon as they are available.
+        """
+        targets = [((str(i), 443, "tcp"), None) for i in range(3)]
+        d = self.checkTargets(targets, concurrency=2)
+
+        self.assertEqual(["0", "1"], sorted(self.pending))
+
+        self.pending["1"].callback("result")
+        self.clock.advance(0)
+
+        self.assertEqual([(("1", 443, "tcp"), "result")], self.reports)
+        self.assertEqual(["0", "1", "2"], sorted(self.pending))
+
+        self.pending["0"].callback("result")
+        self.pending["2"].callback("result")
+        self.clock.advance(0)
+        self.successResultOf(d)
+        self.assertEqual(3, len(self.reports))
+
+
+    def test_errors(self):
+        """
+        Malformed targets are reported without being checked.
+        """
+        error = ValueError()
+        d = self.checkTargets([("bogus", error)], concurrency=1)
+
+        self.successResultOf(d)
+        ((target, failure),) = self.reports
+        self.assertEqual(("bogus", error), (target, failure.value))
+        self.assertEqual({}, self.pending)
+
+
+    def test_reportFails(self):
+        """
+        If I{report} raises, the exception is logged and the remaining
+        targets are still checked and reported.
+        """
+        def report(target, res):
+            if target == "bogus":
+                raise RuntimeError("can't report")
+            self.reports.append((target, res))
+
+        d = _check.checkTargets(
+            iter([("bogus", ValueError()), (("0", 443, "tcp"), None)]),
+            report, concurrency=1, cooperator=self.cooperator,
+        )
+        self.clock.advance(0)
+        self.pending["0"].callback("result")
+        self.clock.advance(0)
+
+        self.successResultOf(d)
+        self.assertEqual([(("0", 443, "tcp"), "result")], self.reports)
+        self.assertEqual(1, len(self.flushLoggedErrors(RuntimeError)))
+
+
+
+class CheckTargetTests(SynchronousTestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.lookup = (True, [])
+        self.endpoints = []
+        self.patch(_check._resolver, "lookupTLSARecords",
+                   lambda *args: defer.succeed(self.lookup))
+        self.patch(_check._tls, "retrieveCertificateChains",
+                   lambda *args, **kw: defer.succeed(self.endpoints))
+
+
+    def test_allAddresses(self):
+        """
+        With C{allAddresses}, the chain of the first address that presented
+        one and the results of all addresses are added.
+        """
+        error = Failure(ValueError())
+        self.endpoints = [("192.0.2.1", error), ("192.0.2.2", ["chain"])]
+
+        res = self.successResultOf(_check.checkTarget(
+            "example.com", 443, "tcp", reactor=self.clock, allAddresses=True,
+        ))
+
+        self.assertEqual(((True, []), ["chain"], self.endpoints), res)
+
+
+    def test_allAddressesFailed(self):
+        """
+        If no address presented a chain, the check fails like the first
+        one.
+        """
+        self.endpoints = [("192.0.2.1", Failure(ValueError())),
+                          ("192.0.2.2", Failure(KeyError()))]
+
+        self.failureResultOf(_check.checkTarget(
+            "example.com", 443, "tcp", reactor=self.clock, allAddresses=True,
+        ), ValueError)
+
+
+
+    def test_resume(self):
+        """
+        With C{resume}, the TLSA records are looked up first and sessions
+        are tied to their RRset.
+        """
+        lookup = defer.Deferred()
+        retrieved = []
+        self.patch(_check._resolver, "lookupTLSARecords",
+                   lambda *args: lookup)
+
+        def retrieve(host, port, **kw):
+            retrieved.append(kw)
+            return defer.succeed(["chain"])
+
+        self.patch(_check._tls, "retrieveCertificateChain", retrieve)
+        d = _check.checkTarget("example.com", 443, "tcp", reactor=self.clock,
+                               resume=True)
+        self.assertEqual([], retrieved)
+        record = TLSARecord(b"FOO", 3, 1, 1)
+        lookup.callback((True, [record]))
+
+        self.assertEqual(((True, [record]), ["chain"]),
+                         self.successResultOf(d))
+        [kw] = retrieved
+        self.assertEqual(
+            (True, _check.rrsetTag([TLSARecord(b"FOO", 3, 1, 1)])),
+            (kw["resume"], kw["sessionTag"]),
+        )
+
+
+
+class RRsetTagTests(SynchronousTestCase):
+    def test_order(self):
+        """
+        The tag doesn't depend on the order of the records but on all of
+        their fields.
+        """
+        a, b = TLSARecord(b"A", 3, 1, 1), TLSARecord(b"B", 3, 1, 1)
+
+        self.assertEqual(_check.rrsetTag([a, b]), _check.rrsetTag([b, a]))
+        self.assertNotEqual(_check.rrsetTag([a]),
+                            _check.rrsetTag([TLSARecord(b"A", 2, 1, 1)]))
+
+
+
+class OutcomeTests(SynchronousTestCase):
+    def test_outcome(self):
+        """
+        Successes are "ok", DNS errors are named by their status and
+        everything else by the exception type.
+        """
+        self.assertEqual(
+            ["ok", "GETDNS_RESPSTATUS_NO_NAME", "TimeoutError"],
+            [_check.outcome(res) for res in [
+                ((True, []), []),
+                Failure(GetdnsResponseError(901)),
+                Failure(defer.TimeoutError()),
+            ]]
+        )
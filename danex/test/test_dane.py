@@ -3,6 +3,8 @@
 
 from __future__ import absolute_import, division, print_function
 
+import hashlib
+
 import getdns
 
 from twisted.trial.unittest import SynchronousTestCase
@@ -10,6 +12,8 @@ from twisted.python.filepath import FilePath
 from OpenSSL import crypto
 
 from danex import _dane
+from danex._pool import ContextPool, resetPools
+from danex.test.test_tls import CA_CERT
 
 
 class TLSADomainNameTests(SynchronousTestCase):
@@ -36,6 +40,24 @@ class GetdnsResponseErrorTests(SynchronousTestCase):
         )
 
 
+    def test_errorTextUnknown(self):
+        """
+        C{errorText} is C{None} for unknown status codes.
+        """
+        self.assertIs(None, _dane.GetdnsResponseError(-1).errorText)
+
+
+    def test_errorTextMapBuiltOnce(self):
+        """
+        The map of status codes to names is built on first use and reused.
+        """
+        self.patch(_dane, "_statusNames", None)
+        _dane.GetdnsResponseError(getdns.GETDNS_RESPSTATUS_NO_NAME).errorText
+        names = _dane._statusNames
+        _dane.GetdnsResponseError(getdns.GETDNS_RESPSTATUS_GOOD).errorText
+        self.assertIs(names, _dane._statusNames)
+
+
 class TLSARecordTests(SynchronousTestCase):
     def test_matchesCertificateCertTrue(self):
         """
@@ -95,6 +117,281 @@ class TLSARecordTests(SynchronousTestCase):
     test_matchesCertificateSPKITrue.skip = True
 
 
+    def test_fields(self):
+        """
+        The fields are looked up as constants and valid records have no
+        errors.
+        """
+        record = _dane.TLSARecord(b"abc", 3, 1, 2)
+        self.assertEqual(
+            (b"abc", _dane.USAGE.DANE_EE, _dane.SELECTOR.SPKI,
+             _dane.MATCHING_TYPE.SHA_512, True, {}),
+            (record.payload, record.usage, record.selector,
+             record.matchingType, record.valid, record.errors),
+        )
+
+
+    def test_invalid(self):
+        """
+        Undefined values make the record invalid and are reported in
+        C{errors}.
+        """
+        record = _dane.TLSARecord(b"abc", 3, 7, 9)
+        self.assertEqual(
+            (False, _dane.SELECTOR.INVALID, _dane.MATCHING_TYPE.INVALID, {
+                "selector": [("Invalid parameter", 7)],
+                "matchingType": [("Invalid parameter", 9)],
+            }),
+            (record.valid, record.selector, record.matchingType,
+             record.errors),
+        )
+        self.assertEqual((3, 7, 9), record.rawValues())
+
+
+    def test_immutable(self):
+        """
+        Records can't be changed and have no instance dict.
+        """
+        record = _dane.TLSARecord(b"abc", 3, 1, 1)
+        self.assertRaises(AttributeError, setattr, record, "usage", 0)
+        self.assertRaises(AttributeError, delattr, record, "payload")
+        self.assertFalse(hasattr(record, "__dict__"))
+        record.errors["usage"] = []
+        self.assertTrue(record.valid)
+
+
+    def test_repr(self):
+        """
+        The representation shows the fields, validity and errors.
+        """
+        self.assertEqual(
+            "<TLSARecord usage=<USAGE=DANE_EE> selector=<SELECTOR=SPKI> "
+            "matchingType=<MATCHING_TYPE=INVALID> valid=False "
+            "errors={'matchingType': [('Invalid parameter', 5)]}>",
+            str(_dane.TLSARecord(b"", 3, 1, 5)),
+        )
+
+
+
+class TLSARecordBatchTests(SynchronousTestCase):
+    def test_roundtrip(self):
+        """
+        Records come out of the batch like they went in, including invalid
+        ones.
+        """
+        batch = _dane.TLSARecordBatch()
+        self.assertEqual(0, batch.append(3, 1, 1, b"abc"))
+        self.assertEqual((1, 3), batch.extend([
+            _dane.TLSARecord(b"", 2, 0, 0),
+            _dane.TLSARecord(b"defg", 9, 1, 2),
+        ]))
+        self.assertEqual(3, len(batch))
+        self.assertEqual(
+            [(b"abc", (3, 1, 1), True), (b"", (2, 0, 0), True),
+             (b"defg", (9, 1, 2), False)],
+            [(r.payload, r.rawValues(), r.valid) for r in batch],
+        )
+        self.assertEqual(b"defg", batch.payload(2))
+        self.assertEqual(b"defg", batch[-1].payload)
+        self.assertEqual([b"", b"defg"],
+                         [r.payload for r in batch.records(1, 3)])
+        self.assertRaises(IndexError, lambda: batch[3])
+
+
+    def test_invalidFieldLeavesBatchUnchanged(self):
+        """
+        Fields that don't fit into a byte are refused without corrupting the
+        records that are added afterwards.
+        """
+        batch = _dane.TLSARecordBatch()
+        batch.append(3, 1, 1, b"abc")
+
+        self.assertRaises(OverflowError, batch.append, 3, 1, 256, b"x")
+        self.assertRaises(OverflowError, batch.extend, [
+            _dane.TLSARecord(b"def", 2, 0, 1),
+            _dane.TLSARecord(b"ghi", 300, 1, 1),
+        ])
+        batch.append(2, 0, 1, b"jk")
+
+        self.assertEqual(
+            [(b"abc", (3, 1, 1)), (b"jk", (2, 0, 1))],
+            [(r.payload, r.rawValues()) for r in batch],
+        )
+
+
+def loadCertificate(name):
+    """
+    Load a DER-encoded certificate from the test directory.
+    """
+    return crypto.load_certificate(
+        crypto.FILETYPE_ASN1,
+        FilePath(__file__).sibling(name).getContent()
+    )
+
+
+def certificateRecord(usage, cert):
+    """
+    Create a CERT/SHA-256 L{_dane.TLSARecord} with I{usage} for I{cert}.
+    """
+    return _dane.TLSARecord(
+        payload=hashlib.sha256(
+            crypto.dump_certificate(crypto.FILETYPE_ASN1, cert)
+        ).digest(),
+        usage=usage.value,
+        selector=_dane.SELECTOR.CERT.value,
+        matchingType=_dane.MATCHING_TYPE.SHA_256.value,
+    )
+
+
+class MatchChainTests(SynchronousTestCase):
+    def setUp(self):
+        self.leaf = loadCertificate('example_cert.bin')
+        self.issuer = CA_CERT
+
+
+    def test_endEntity(self):
+        """
+        EE records only match the first certificate of the chain.
+        """
+        self.assertEqual(
+            [True, False],
+            _dane.matchChain([
+                certificateRecord(_dane.USAGE.DANE_EE, self.leaf),
+                certificateRecord(_dane.USAGE.PKIX_EE, self.issuer),
+            ], [self.leaf, self.issuer])
+        )
+
+
+    def test_trustAnchor(self):
+        """
+        TA records only match the issuing certificates of the chain.
+        """
+        self.assertEqual(
+            [False, True],
+            _dane.matchChain([
+                certificateRecord(_dane.USAGE.DANE_TA, self.leaf),
+                certificateRecord(_dane.USAGE.PKIX_TA, self.issuer),
+            ], [self.leaf, self.issuer])
+        )
+
+
+    def test_invalid(self):
+        """
+        Invalid records never match.
+        """
+        self.assertEqual(
+            [False],
+            _dane.matchChain(
+                [_dane.TLSARecord(b"", 42, 0, 0)], [self.leaf]
+            )
+        )
+
+
+    def test_digestsComputedOnce(self):
+        """
+        Records with the same selector and matching type share the digest of
+        a certificate.
+        """
+        calls = []
+        select = _dane.SELECTOR_MAP[_dane.SELECTOR.CERT]
+        self.patch(_dane, "SELECTOR_MAP", {
+            _dane.SELECTOR.CERT: lambda cert: (
+                calls.append(cert) or select(cert)
+            ),
+        })
+        records = [
+            certificateRecord(_dane.USAGE.DANE_EE, self.leaf)
+            for _ in range(3)
+        ]
+
+        self.assertEqual(
+            [True] * 3, _dane.matchChain(records, [self.leaf])
+        )
+        self.assertEqual(1, len(calls))
+
+
+
+class CertificateFingerprintsTests(SynchronousTestCase):
+    def setUp(self):
+        self.fingerprints = _dane.CertificateFingerprints(
+            loadCertificate('example_cert.bin')
+        )
+
+
+    def test_digestMemoized(self):
+        """
+        Digests are only computed once.
+        """
+        digest = self.fingerprints.digest(
+            _dane.SELECTOR.CERT, _dane.MATCHING_TYPE.SHA_512
+        )
+
+        self.assertIs(
+            digest,
+            self.fingerprints.digest(
+                _dane.SELECTOR.CERT, _dane.MATCHING_TYPE.SHA_512
+            )
+        )
+        self.assertEqual(
+            hashlib.sha512(
+                FilePath(__file__).sibling('example_cert.bin').getContent()
+            ).digest(),
+            digest
+        )
+
+
+    def test_spkiCached(self):
+        """
+        The SubjectPublicKeyInfo is extracted only once.
+        """
+        self.assertIs(self.fingerprints.spki, self.fingerprints.spki)
+
+
+    def test_matchRecords(self):
+        """
+        L{_dane.CertificateFingerprints.matchRecords} matches each record of
+        an RRset.
+        """
+        cert = self.fingerprints.certificate
+        self.assertEqual(
+            [True, False, False],
+            self.fingerprints.matchRecords([
+                certificateRecord(_dane.USAGE.DANE_EE, cert),
+                certificateRecord(_dane.USAGE.DANE_EE, CA_CERT),
+                _dane.TLSARecord(b"", 42, 0, 0),
+            ])
+        )
+
+
+    def test_matchRecordsOnlyUsedDigests(self):
+        """
+        L{_dane.CertificateFingerprints.matchRecords} computes only the
+        digests that the records ask for, once each.
+        """
+        cert = self.fingerprints.certificate
+        record = certificateRecord(_dane.USAGE.DANE_EE, cert)
+
+        self.assertEqual([True, False, True], self.fingerprints.matchRecords(
+            [record, certificateRecord(_dane.USAGE.DANE_TA, CA_CERT), record]
+        ))
+        self.assertEqual(
+            [(_dane.SELECTOR.CERT, _dane.MATCHING_TYPE.SHA_256)],
+            list(self.fingerprints._digests),
+        )
+
+
+    def test_matchesCertificate(self):
+        """
+        L{_dane.TLSARecord.matchesCertificate} accepts fingerprints.
+        """
+        cert = self.fingerprints.certificate
+        self.assertTrue(
+            certificateRecord(_dane.USAGE.DANE_EE, cert)
+            .matchesCertificate(self.fingerprints)
+        )
+
+
+
 class FakeGetdns(object):
     """
     An in memory fake of the getdns api for testing.
@@ -115,10 +412,16 @@ class FakeGetdns(object):
     def general(self, context, name, request_type, extensions):
         """
         """
+        self.extensions = extensions
         return self._generalResult
 
 
 class TLSATests(SynchronousTestCase):
+    def setUp(self):
+        # Lookups without a pool use the shared one of their fake getdns.
+        self.addCleanup(resetPools)
+
+
     def test_tlsaCert(self):
         """
         L{_dane.lookup_tlsa_records} returns a L{_dane.TLSARecord} instance if
@@ -137,6 +440,62 @@ class TLSATests(SynchronousTestCase):
         )
 
 
+    def test_onlyValidationStatus(self):
+        """
+        L{_dane.lookup_tlsa_records} asks getdns for the DNSSEC status of
+        all answers, including bogus ones, but not for the validation chain.
+        """
+        fakeGetdns = FakeGetdns(
+            generalResult=createResults(status=getdns.GETDNS_RESPSTATUS_GOOD))
+        _dane.lookup_tlsa_records('example.com', 443, 'tcp',
+                                  getdns=fakeGetdns)
+        self.assertEqual(
+            (getdns.GETDNS_EXTENSION_TRUE, getdns.GETDNS_EXTENSION_TRUE, None),
+            (fakeGetdns.extensions.get("dnssec_return_status"),
+             fakeGetdns.extensions.get("dnssec_return_all_statuses"),
+             fakeGetdns.extensions.get("dnssec_return_validation_chain")),
+        )
+
+
+    def test_bogus(self):
+        """
+        Bogus answers are reported as C{GETDNS_RESPSTATUS_ALL_BOGUS_ANSWERS}
+        instead of as untrusted records.
+        """
+        results = createResults(status=getdns.GETDNS_RESPSTATUS_GOOD,
+                                selector=_dane.SELECTOR.CERT.value)
+        results['replies_tree'][0]['dnssec_status'] = (
+            getdns.GETDNS_DNSSEC_BOGUS
+        )
+        e = self.assertRaises(
+            _dane.GetdnsResponseError,
+            _dane.queryTLSA, '_443._tcp.example.com',
+            getdns=FakeGetdns(generalResult=results)
+        )
+
+        self.assertEqual(
+            (getdns.GETDNS_RESPSTATUS_ALL_BOGUS_ANSWERS, None),
+            (e.errorCode, e.ttl),
+        )
+
+
+    def test_noReplies(self):
+        """
+        A GOOD response without replies -- what getdns returns if it omits
+        bogus ones -- is reported as bogus, too.
+        """
+        results = createResults(status=getdns.GETDNS_RESPSTATUS_GOOD)
+        results['replies_tree'] = []
+        e = self.assertRaises(
+            _dane.GetdnsResponseError,
+            _dane.queryTLSA, '_443._tcp.example.com',
+            getdns=FakeGetdns(generalResult=results)
+        )
+
+        self.assertEqual(getdns.GETDNS_RESPSTATUS_ALL_BOGUS_ANSWERS,
+                         e.errorCode)
+
+
     def test_tlsaSPKI(self):
         """
         L{_dane.lookup_tlsa_records} returns a L{_dane.TLSARecord} instance if
@@ -175,6 +534,54 @@ class TLSATests(SynchronousTestCase):
         )
 
 
+    def test_usesPool(self):
+        """
+        L{_dane.lookup_tlsa_records} takes its context from the passed pool
+        and returns it afterwards.
+        """
+        fakeGetdns = FakeGetdns(
+            generalResult=createResults(status=getdns.GETDNS_RESPSTATUS_GOOD,
+                                        selector=_dane.SELECTOR.CERT.value))
+        pool = ContextPool(fakeGetdns)
+        for _ in range(2):
+            _dane.lookup_tlsa_records(
+                'example.com', 443, 'tcp', getdns=fakeGetdns, pool=pool)
+
+        self.assertEqual((1, 1), (pool.hits, pool.misses))
+
+
+    def test_queryTLSATTL(self):
+        """
+        L{_dane.queryTLSA} also returns the smallest TTL of the answers.
+        """
+        results = createResults(status=getdns.GETDNS_RESPSTATUS_GOOD,
+                                selector=_dane.SELECTOR.CERT.value)
+        results['replies_tree'][0]['answer'][0]['ttl'] = 450
+        _, _, ttl = _dane.queryTLSA(
+            '_443._tcp.example.com', getdns=FakeGetdns(generalResult=results))
+
+        self.assertEqual(450, ttl)
+
+
+    def test_queryTLSANegativeTTL(self):
+        """
+        Negative answers carry the lesser of the SOA's TTL and minimum.
+        """
+        results = createResults(status=getdns.GETDNS_RESPSTATUS_NO_NAME)
+        results['replies_tree'][0]['authority'] = [{
+            'type': getdns.GETDNS_RRTYPE_SOA,
+            'ttl': 900,
+            'rdata': {'minimum': 300},
+        }]
+        e = self.assertRaises(
+            _dane.GetdnsResponseError,
+            _dane.queryTLSA, '_443._tcp.example.com',
+            getdns=FakeGetdns(generalResult=results)
+        )
+
+        self.assertEqual(300, e.ttl)
+
+
 def createResults(status=getdns.GETDNS_RESPSTATUS_GOOD,
                   selector=None,
                   certificate_association_data=b"",):
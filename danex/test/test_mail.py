@@ -0,0 +1,165 @@
+# Copyright (c) Hynek Schlawack, Richard Wall
+# See LICENSE for details.
+
+from __future__ import absolute_import, division, print_function
+
+import getdns
+
+from twisted.internet import defer
+from twisted.trial.unittest import SynchronousTestCase
+
+from danex import _mail
+from danex._dane import GetdnsResponseError
+
+
+class ParseDomainsTests(SynchronousTestCase):
+    def test_parse(self):
+        """
+        Each line is a domain, comments and empty lines are skipped.
+        """
+        targets = list(_mail.parseDomains([
+            "example.com\n", "# comment\n", "\n", "example.org",
+        ]))
+        self.assertEqual(
+            [(("example.com",), None), (("example.org",), None)], targets
+        )
+
+
+    def test_malformed(self):
+        """
+        Lines with more than one word are reported as errors.
+        """
+        [(line, error)] = _mail.parseDomains(["example.com 25 tcp"])
+        self.assertEqual("example.com 25 tcp", line)
+        self.assertIsInstance(error, ValueError)
+
+
+
+class MailCheckerTests(SynchronousTestCase):
+    def setUp(self):
+        self.mx = {
+            "example.com": ["mx1.example.net", "mx2.example.net"],
+            "example.org": ["mx2.example.net"],
+            "example.info": [],
+        }
+        self.pending = {}
+        self.checker = _mail.MailChecker(
+            lookupMX=self.lookupMX, checkHost=self.checkHost,
+        )
+
+
+    def lookupMX(self, domain):
+        if domain not in self.mx:
+            return defer.fail(GetdnsResponseError(
+                getdns.GETDNS_RESPSTATUS_NO_NAME
+            ))
+        return defer.succeed((True, self.mx[domain], 300))
+
+
+    def checkHost(self, host):
+        d = self.pending[host] = defer.Deferred()
+        return d
+
+
+    def test_check(self):
+        """
+        All MX hosts are checked on port 25 and the results are returned in
+        order of preference.
+        """
+        d = self.checker.check("example.com")
+        self.pending["mx2.example.net"].callback("result2")
+        self.assertNoResult(d)
+        self.pending["mx1.example.net"].callback("result1")
+
+        self.assertEqual(
+            (True, [(("mx1.example.net", 25, "tcp"), "result1"),
+                    (("mx2.example.net", 25, "tcp"), "result2")]),
+            self.successResultOf(d),
+        )
+
+
+    def test_deduplicated(self):
+        """
+        MX hosts are only checked once, whether their check is still running
+        or already done.
+        """
+        first = self.checker.check("example.com")
+        second = self.checker.check("example.org")
+        self.pending.pop("mx2.example.net").callback("result2")
+        self.pending.pop("mx1.example.net").callback("result1")
+        third = self.checker.check("example.org")
+
+        self.assertEqual({}, self.pending)
+        for d in (second, third):
+            self.assertEqual([(("mx2.example.net", 25, "tcp"), "result2")],
+                             self.successResultOf(d)[1])
+        self.assertEqual(2, len(self.successResultOf(first)[1]))
+        self.assertEqual((2, 2), (self.checker.checked,
+                                  self.checker.deduplicated))
+
+
+    def test_failuresNotReused(self):
+        """
+        A failed check is passed to every domain that waited for it, but
+        later domains check the host again.
+        """
+        first = self.checker.check("example.org")
+        second = self.checker.check("example.org")
+        self.pending.pop("mx2.example.net").errback(ValueError("nope"))
+        third = self.checker.check("example.org")
+
+        for d in (first, second):
+            [(_, failure)] = self.successResultOf(d)[1]
+            self.assertTrue(failure.check(ValueError))
+        self.assertNoResult(third)
+        self.assertIn("mx2.example.net", self.pending)
+
+
+    def test_maxSize(self):
+        """
+        Only the C{maxSize} most recently used results are kept.
+        """
+        self.checker.maxSize = 1
+        self.checker.check("example.com")
+        self.pending.pop("mx1.example.net").callback("result1")
+        self.pending.pop("mx2.example.net").callback("result2")
+        self.successResultOf(self.checker.check("example.org"))
+
+        self.checker.check("example.com")
+
+        self.assertEqual(["mx1.example.net"], list(self.pending))
+
+
+    def test_maxConcurrent(self):
+        """
+        No more than C{maxConcurrent} MX hosts are checked at once across
+        all domains.
+        """
+        checker = _mail.MailChecker(
+            lookupMX=self.lookupMX, checkHost=self.checkHost,
+            maxConcurrent=1,
+        )
+        d = checker.check("example.com")
+        checker.check("example.org")
+
+        self.assertEqual(["mx1.example.net"], list(self.pending))
+        self.pending.pop("mx1.example.net").callback("result1")
+        self.assertEqual(["mx2.example.net"], list(self.pending))
+        self.pending.pop("mx2.example.net").callback("result2")
+        self.successResultOf(d)
+
+
+    def test_nullMX(self):
+        """
+        Domains that don't accept mail fail with L{_mail.NullMXError}.
+        """
+        self.failureResultOf(self.checker.check("example.info"),
+                             _mail.NullMXError)
+
+
+    def test_lookupFailed(self):
+        """
+        Failed MX lookups fail the check.
+        """
+        self.failureResultOf(self.checker.check("example.net"),
+                             GetdnsResponseError)
@@ -0,0 +1,107 @@
+# Copyright (c) Hynek Schlawack, Richard Wall
+# See LICENSE for details.
+
+from __future__ import absolute_import, division, print_function
+
+from twisted.trial.unittest import SynchronousTestCase
+
+from danex import _metrics
+
+
+class HistogramTests(SynchronousTestCase):
+    def setUp(self):
+        self.registry = _metrics.Registry(enabled=True)
+        self.histogram = self.registry.register(_metrics.Histogram(
+            "test_seconds", "Test.", buckets=(0.1, 1.0),
+            registry=self.registry,
+        ))
+
+
+    def test_render(self):
+        """
+        Buckets are cumulative and the last one is +Inf.
+        """
+        for value in [0.05, 0.1, 0.5, 2.0]:
+            self.histogram.observe(value)
+
+        self.assertEqual(
+            b"# HELP test_seconds Test.\n"
+            b"# TYPE test_seconds histogram\n"
+            b'test_seconds_bucket{le="0.1"} 2\n'
+            b'test_seconds_bucket{le="1"} 3\n'
+            b'test_seconds_bucket{le="+Inf"} 4\n'
+            b"test_seconds_sum 2.65\n"
+            b"test_seconds_count 4\n",
+            self.registry.render()
+        )
+
+
+    def test_time(self):
+        """
+        Timers observe once they are stopped and pass results through.
+        """
+        timer = self.histogram.time()
+
+        self.assertEqual(0, self.histogram.count)
+        self.assertEqual("result", timer.stop("result"))
+        self.assertEqual(1, self.histogram.count)
+
+        with self.histogram.time():
+            pass
+
+        self.assertEqual(2, self.histogram.count)
+
+
+    def test_disabled(self):
+        """
+        If the registry is disabled, timers are shared no-ops.
+        """
+        self.registry.enabled = False
+
+        with self.histogram.time() as timer:
+            pass
+
+        self.assertIs(_metrics._NULL_TIMER, timer)
+        self.assertEqual("result", timer.stop("result"))
+        self.assertEqual(0, self.histogram.count)
+
+
+
+class CounterTests(SynchronousTestCase):
+    def test_labels(self):
+        """
+        Counters are kept per label values which are escaped when rendered.
+        """
+        registry = _metrics.Registry()
+        counter = registry.register(
+            _metrics.Counter("test_total", "Test.", ("outcome",))
+        )
+
+        counter.inc("ok")
+        counter.inc("ok", amount=2)
+        counter.inc('bad "one"')
+
+        self.assertEqual(3, counter.value("ok"))
+        self.assertEqual(
+            b"# HELP test_total Test.\n"
+            b"# TYPE test_total counter\n"
+            b'test_total{outcome="bad \\"one\\""} 1\n'
+            b'test_total{outcome="ok"} 3\n',
+            registry.render()
+        )
+
+
+
+class CallbackMetricTests(SynchronousTestCase):
+    def test_render(self):
+        """
+        The value is computed on render.
+        """
+        registry = _metrics.Registry()
+        values = [1, 0.5]
+        registry.register(
+            _metrics.CallbackMetric("test", "Test.", values.pop)
+        )
+
+        self.assertIn(b"\ntest 0.5\n", registry.render())
+        self.assertIn(b"\ntest 1\n", registry.render())
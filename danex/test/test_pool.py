@@ -0,0 +1,166 @@
+# Copyright (c) Hynek Schlawack, Richard Wall
+# See LICENSE for details.
+
+from __future__ import absolute_import, division, print_function
+
+from twisted.trial.unittest import SynchronousTestCase
+
+from danex._pool import (
+    DEFAULT_POOL_SIZE, ContextPool, contextPoolFor, resetPools, setPoolSize
+)
+
+
+class CountingGetdns(object):
+    """
+    A getdns stand-in that hands out numbered contexts.
+    """
+    def __init__(self):
+        self.created = 0
+
+
+    def context_create(self):
+        self.created += 1
+        return self.created
+
+
+
+class ContextPoolTests(SynchronousTestCase):
+    def test_reuse(self):
+        """
+        A released context is handed out again and counted as a hit.
+        """
+        getdns = CountingGetdns()
+        pool = ContextPool(getdns)
+
+        with pool.context() as first:
+            pass
+        with pool.context() as second:
+            pass
+
+        self.assertEqual(
+            (first, 1, 1, 1),
+            (second, getdns.created, pool.hits, pool.misses)
+        )
+
+
+    def test_concurrentCheckouts(self):
+        """
+        If all contexts are checked out, a new one is created.
+        """
+        pool = ContextPool(CountingGetdns())
+
+        with pool.context() as first:
+            with pool.context() as second:
+                self.assertNotEqual(first, second)
+
+        self.assertEqual((0, 2), (pool.hits, pool.misses))
+
+
+    def test_size(self):
+        """
+        No more than C{size} idle contexts are kept.
+        """
+        pool = ContextPool(CountingGetdns(), size=1)
+        first, second = pool.acquire(), pool.acquire()
+        pool.release(first)
+        pool.release(second)
+
+        self.assertEqual([first], pool._idle)
+
+
+    def test_recycleAfterMaxQueries(self):
+        """
+        Contexts are replaced after serving C{maxQueries} queries.
+        """
+        getdns = CountingGetdns()
+        pool = ContextPool(getdns, maxQueries=2)
+
+        ctxs = []
+        for _ in range(3):
+            with pool.context() as ctx:
+                ctxs.append(ctx)
+
+        self.assertEqual(
+            ([1, 1, 2], 1),
+            (ctxs, pool.recycled)
+        )
+
+
+    def test_recycleOnError(self):
+        """
+        If the C{with} block fails, the context is dropped.
+        """
+        getdns = CountingGetdns()
+        pool = ContextPool(getdns)
+
+        def fail():
+            with pool.context():
+                raise ValueError()
+
+        self.assertRaises(ValueError, fail)
+        with pool.context() as ctx:
+            pass
+
+        self.assertEqual((2, 1), (ctx, pool.recycled))
+
+
+    def test_resize(self):
+        """
+        L{ContextPool.resize} drops the idle contexts that don't fit
+        anymore.
+        """
+        pool = ContextPool(CountingGetdns())
+        with pool.context():
+            with pool.context():
+                pass
+
+        pool.resize(1)
+
+        self.assertEqual((1, 1), (pool.size, len(pool._idle)))
+
+
+
+class SharedPoolTests(SynchronousTestCase):
+    def setUp(self):
+        self.addCleanup(resetPools)
+
+
+    def test_contextPoolFor(self):
+        """
+        L{contextPoolFor} returns the same pool for the same getdns API.
+        """
+        getdns = CountingGetdns()
+
+        self.assertIs(contextPoolFor(getdns), contextPoolFor(getdns))
+        self.assertIsNot(
+            contextPoolFor(getdns), contextPoolFor(CountingGetdns())
+        )
+
+
+    def test_setPoolSize(self):
+        """
+        L{setPoolSize} resizes the existing shared pools and the ones that
+        are created later.
+        """
+        existing = contextPoolFor(CountingGetdns())
+
+        setPoolSize(2)
+
+        self.assertEqual(
+            (2, 2), (existing.size, contextPoolFor(CountingGetdns()).size)
+        )
+
+
+    def test_resetPools(self):
+        """
+        L{resetPools} forgets the shared pools and restores the default
+        size.
+        """
+        getdns = CountingGetdns()
+        pool = contextPoolFor(getdns)
+        setPoolSize(1)
+
+        resetPools()
+
+        self.assertIsNot(pool, contextPoolFor(getdns))
+        self.assertEqual(DEFAULT_POOL_SIZE, contextPoolFor(getdns).size)
@@ -0,0 +1,420 @@
+# Copyright (c) Hynek Schlawack, Richard Wall
+# See LICENSE for details.
+
+from __future__ import absolute_import, division, print_function
+
+import getdns
+
+from twisted.internet import defer
+from twisted.internet.task import Clock
+from twisted.names import dns
+from twisted.trial.unittest import SynchronousTestCase
+
+from danex import _dane, _resolver
+
+
+class FakeDatagramTransport(object):
+    """
+    Records the datagrams written to it.
+    """
+    def __init__(self):
+        self.written = []
+
+
+    def write(self, data, address):
+        self.written.append((data, address))
+
+
+
+class FakeUDPPort(object):
+    def __init__(self, protocol):
+        self.protocol = protocol
+        self.listening = True
+
+
+    def stopListening(self):
+        self.listening = False
+
+
+
+class FakeUDPReactor(Clock):
+    """
+    A clock whose UDP ports write to L{FakeDatagramTransport}s.
+    """
+    def __init__(self):
+        Clock.__init__(self)
+        self.ports = []
+
+
+    def listenUDP(self, port, protocol, interface="", maxPacketSize=8192):
+        protocol.transport = FakeDatagramTransport()
+        self.ports.append(FakeUDPPort(protocol))
+        return self.ports[-1]
+
+
+
+def tlsaResponse(id=0, rCode=dns.OK, authenticData=True, rdatas=(),
+                 ttl=3600, soa=None, queries=()):
+    """
+    Create a DNS response message containing TLSA records with I{rdatas}.
+
+    @param soa: A C{(ttl, minimum)} tuple for a SOA record in the authority
+        section.
+    @param queries: The question section.
+    """
+    authority = []
+    if soa is not None:
+        authority.append(dns.RRHeader(
+            b"example.com", dns.SOA, ttl=soa[0],
+            payload=dns.Record_SOA(minimum=soa[1]),
+        ))
+    return dns._EDNSMessage(
+        id=id, answer=True, rCode=rCode, authenticData=authenticData,
+        queries=list(queries),
+        answers=[
+            dns.RRHeader(
+                b"_443._tcp.example.com", _resolver.TLSA, ttl=ttl,
+                payload=dns.UnknownRecord(rdata),
+            )
+            for rdata in rdatas
+        ],
+        authority=authority,
+    )
+
+
+
+class ParseTLSARecordTests(SynchronousTestCase):
+    def test_parse(self):
+        """
+        L{_resolver.parseTLSARecord} splits the RDATA into its fields.
+        """
+        rec = _resolver.parseTLSARecord(b"\x03\x01\x01FOOBAR")
+        self.assertEqual(
+            (_dane.USAGE.DANE_EE, _dane.SELECTOR.SPKI,
+             _dane.MATCHING_TYPE.SHA_256, b"FOOBAR"),
+            (rec.usage, rec.selector, rec.matchingType, rec.payload)
+        )
+
+
+    def test_tooShort(self):
+        """
+        RDATA shorter than the fixed fields raises L{ValueError}.
+        """
+        self.assertRaises(ValueError, _resolver.parseTLSARecord, b"\x03\x01")
+
+
+
+class ServersFromResolvConfTests(SynchronousTestCase):
+    def test_nameservers(self):
+        """
+        All C{nameserver} lines are returned in order.
+        """
+        path = self.mktemp()
+        with open(path, "w") as f:
+            f.write("search example.com\n"
+                    "nameserver 127.0.0.1\n"
+                    "nameserver ::1\n")
+        self.assertEqual(
+            [("127.0.0.1", 53), ("::1", 53)],
+            _resolver.serversFromResolvConf(path)
+        )
+
+
+    def test_missing(self):
+        """
+        A missing file results in no servers.
+        """
+        self.assertEqual([], _resolver.serversFromResolvConf(self.mktemp()))
+
+
+
+class DNSDatagramProtocolTests(SynchronousTestCase):
+    def test_matchesResponseByID(self):
+        """
+        Responses fire the L{Deferred} of the query with the same ID.
+        """
+        proto = _resolver._DNSDatagramProtocol()
+        proto.transport = FakeDatagramTransport()
+        d1 = proto.query(("127.0.0.1", 53), dns._EDNSMessage())
+        d2 = proto.query(("127.0.0.1", 53), dns._EDNSMessage())
+        id2 = dns._EDNSMessage()
+        id2.fromStr(proto.transport.written[1][0])
+
+        proto.datagramReceived(
+            tlsaResponse(id=id2.id).toStr(), ("127.0.0.1", 53)
+        )
+
+        self.assertNoResult(d1)
+        self.assertEqual(id2.id, self.successResultOf(d2).id)
+
+
+    def test_spoofedSource(self):
+        """
+        Responses from other addresses than the queried server are dropped.
+        """
+        proto = _resolver._DNSDatagramProtocol()
+        proto.transport = FakeDatagramTransport()
+        d = proto.query(("::1", 53), dns._EDNSMessage())
+        sent = dns._EDNSMessage()
+        sent.fromStr(proto.transport.written[0][0])
+
+        for address in [("192.0.2.1", 53), ("::1", 5353)]:
+            proto.datagramReceived(tlsaResponse(id=sent.id).toStr(), address)
+        self.assertNoResult(d)
+
+        proto.datagramReceived(
+            tlsaResponse(id=sent.id).toStr(), ("0:0::1", 53)
+        )
+        self.successResultOf(d)
+
+
+    def test_mismatchedQuestion(self):
+        """
+        Responses whose question differs from the query's are dropped.
+        """
+        question = dns.Query(b"_443._tcp.example.com", _resolver.TLSA)
+        proto = _resolver._DNSDatagramProtocol()
+        proto.transport = FakeDatagramTransport()
+        d = proto.query(("127.0.0.1", 53),
+                        dns._EDNSMessage(queries=[question]))
+        sent = dns._EDNSMessage()
+        sent.fromStr(proto.transport.written[0][0])
+
+        for queries in [
+            [],
+            [dns.Query(b"_443._tcp.example.org", _resolver.TLSA)],
+            [dns.Query(b"_443._tcp.example.com", dns.MX)],
+            [dns.Query(b"_443._tcp.example.com", _resolver.TLSA, dns.CH)],
+        ]:
+            proto.datagramReceived(
+                tlsaResponse(id=sent.id, queries=queries).toStr(),
+                ("127.0.0.1", 53),
+            )
+        self.assertNoResult(d)
+
+        proto.datagramReceived(
+            tlsaResponse(id=sent.id, queries=[
+                dns.Query(b"_443._TCP.Example.COM", _resolver.TLSA)
+            ]).toStr(),
+            ("127.0.0.1", 53),
+        )
+        self.successResultOf(d)
+
+
+    def test_cancel(self):
+        """
+        Cancelling a query forgets about it.
+        """
+        proto = _resolver._DNSDatagramProtocol()
+        proto.transport = FakeDatagramTransport()
+        d = proto.query(("127.0.0.1", 53), dns._EDNSMessage())
+        d.cancel()
+        self.failureResultOf(d)
+
+        self.assertEqual({}, proto._pending)
+
+
+
+class TLSAResolverTests(SynchronousTestCase):
+    def lookup(self, server, **kw):
+        """
+        Look up TLSA records using I{server} and answer with the AD bit set.
+
+        @return: Whether the answer is trusted.
+        """
+        reactor = FakeUDPReactor()
+        resolver = _resolver.TLSAResolver(reactor, servers=[server], **kw)
+        d = resolver.lookupTLSA(b"_443._tcp.example.com")
+        [port] = reactor.ports
+        query = dns._EDNSMessage()
+        query.fromStr(port.protocol.transport.written[0][0])
+        port.protocol.datagramReceived(tlsaResponse(
+            id=query.id, queries=query.queries,
+            rdatas=[b"\x03\x01\x01FOOBAR"],
+        ).toStr(), server)
+
+        self.assertFalse(port.listening)
+        return self.successResultOf(d)[0]
+
+
+    def test_portPerQuery(self):
+        """
+        Every query is sent from a port of its own which is closed once the
+        query is done.
+        """
+        reactor = FakeUDPReactor()
+        resolver = _resolver.TLSAResolver(
+            reactor, servers=[("127.0.0.1", 53)], timeout=1,
+        )
+        d1 = resolver.lookupTLSA(b"_443._tcp.example.com")
+        d2 = resolver.lookupTLSA(b"_443._tcp.example.org")
+
+        self.assertEqual(2, len(reactor.ports))
+        reactor.advance(1)
+        self.failureResultOf(d1, _dane.GetdnsResponseError)
+        self.failureResultOf(d2, _dane.GetdnsResponseError)
+        self.assertEqual([False, False],
+                         [port.listening for port in reactor.ports])
+
+
+    def test_trustsLoopback(self):
+        """
+        The AD bit of resolvers on the loopback interface is trusted.
+        """
+        self.assertTrue(self.lookup(("127.0.0.1", 53)))
+        self.assertTrue(self.lookup(("::1", 53)))
+
+
+    def test_distrustsRemote(self):
+        """
+        The AD bit of remote resolvers is only trusted on request.
+        """
+        self.assertFalse(self.lookup(("192.0.2.1", 53)))
+        self.assertTrue(self.lookup(("192.0.2.1", 53), trustRemote=True))
+
+
+
+class TLSAFromResponseTests(SynchronousTestCase):
+    def test_authenticated(self):
+        """
+        The AD bit of the response determines whether the result is trusted.
+        """
+        trusted, (rec,), _ = _resolver._tlsaFromResponse(
+            tlsaResponse(rdatas=[b"\x03\x01\x01FOOBAR"])
+        )
+        self.assertEqual((True, b"FOOBAR"), (trusted, rec.payload))
+
+
+    def test_unauthenticated(self):
+        """
+        Responses without the AD bit are untrusted.
+        """
+        trusted, _, _ = _resolver._tlsaFromResponse(
+            tlsaResponse(authenticData=False, rdatas=[b"\x03\x01\x01FOOBAR"])
+        )
+        self.assertFalse(trusted)
+
+
+    def test_nxdomain(self):
+        """
+        NXDOMAIN is reported like getdns does.
+        """
+        e = self.assertRaises(
+            _dane.GetdnsResponseError,
+            _resolver._tlsaFromResponse, tlsaResponse(rCode=dns.ENAME)
+        )
+        self.assertEqual(getdns.GETDNS_RESPSTATUS_NO_NAME, e.errorCode)
+
+
+    def test_ttl(self):
+        """
+        The smallest TTL of the answers is returned.
+        """
+        response = tlsaResponse(
+            rdatas=[b"\x03\x01\x01FOOBAR", b"\x03\x01\x01BARFOO"], ttl=600
+        )
+        response.answers[1].ttl = 300
+
+        _, _, ttl = _resolver._tlsaFromResponse(response)
+
+        self.assertEqual(300, ttl)
+
+
+    def test_negativeTTL(self):
+        """
+        Negative answers carry the lesser of the SOA's TTL and minimum.
+        """
+        e = self.assertRaises(
+            _dane.GetdnsResponseError,
+            _resolver._tlsaFromResponse,
+            tlsaResponse(rCode=dns.ENAME, soa=(900, 300))
+        )
+        self.assertEqual(300, e.ttl)
+
+
+    def test_noData(self):
+        """
+        A response without TLSA records is reported as NO_NAME.
+        """
+        e = self.assertRaises(
+            _dane.GetdnsResponseError,
+            _resolver._tlsaFromResponse, tlsaResponse()
+        )
+        self.assertEqual(getdns.GETDNS_RESPSTATUS_NO_NAME, e.errorCode)
+
+
+    def test_servfail(self):
+        """
+        SERVFAIL means that the validating resolver found bogus data.
+        """
+        e = self.assertRaises(
+            _dane.GetdnsResponseError,
+            _resolver._tlsaFromResponse, tlsaResponse(rCode=dns.ESERVER)
+        )
+        self.assertEqual(
+            getdns.GETDNS_RESPSTATUS_ALL_BOGUS_ANSWERS, e.errorCode
+        )
+
+
+
+def mxResponse(exchanges, authenticData=True, ttl=3600):
+    """
+    Create a DNS response message with MX records for the C{(preference,
+    host)} tuples I{exchanges}.
+    """
+    return dns._EDNSMessage(
+        answer=True, authenticData=authenticData,
+        answers=[
+            dns.RRHeader(
+                b"example.com", dns.MX, ttl=ttl,
+                payload=dns.Record_MX(preference, host),
+            )
+            for preference, host in exchanges
+        ],
+    )
+
+
+
+class MXFromResponseTests(SynchronousTestCase):
+    def test_preference(self):
+        """
+        The hosts are ordered by preference and duplicates are dropped.
+        """
+        self.assertEqual(
+            (True, ["mx1.example.net", "mx2.example.net"], 3600),
+            _resolver._mxFromResponse(mxResponse([
+                (20, b"mx2.example.net"), (10, b"MX1.example.net"),
+                (30, b"mx1.example.net"),
+            ]), "example.com"),
+        )
+
+
+    def test_implicit(self):
+        """
+        Domains without MX records are their own mail exchanger.
+        """
+        self.assertEqual(
+            (False, ["example.com"], None),
+            _resolver._mxFromResponse(mxResponse([], authenticData=False),
+                                      "example.com"),
+        )
+
+
+    def test_nullMX(self):
+        """
+        A null MX results in no hosts.
+        """
+        _, hosts, _ = _resolver._mxFromResponse(mxResponse([(0, b"")]),
+                                                "example.com")
+        self.assertEqual([], hosts)
+
+
+    def test_nxdomain(self):
+        """
+        NXDOMAIN is reported like for TLSA lookups.
+        """
+        e = self.assertRaises(
+            _dane.GetdnsResponseError, _resolver._mxFromResponse,
+            tlsaResponse(rCode=dns.ENAME), "example.com",
+        )
+        self.assertEqual(getdns.GETDNS_RESPSTATUS_NO_NAME, e.errorCode)
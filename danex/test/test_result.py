@@ -0,0 +1,310 @@
+# Copyright (c) Hynek Schlawack, Richard Wall
+# See LICENSE for details.
+
+from __future__ import absolute_import, division, print_function
+
+import csv
+import io
+import json
+
+import getdns
+import msgpack
+
+from twisted.python.failure import Failure
+from twisted.trial.unittest import SynchronousTestCase
+
+from danex import _dane, _result, _tls
+from danex.test.test_dane import certificateRecord, loadCertificate
+
+
+CERT = loadCertificate('example_cert.bin')
+
+
+def matchingResult():
+    """
+    Create a result for a target with one matching TLSA record.
+    """
+    return _result.CheckResult.fromCheck(
+        ("example.com", 443, "tcp"),
+        ((True, [certificateRecord(_dane.USAGE.DANE_EE, CERT)]), [CERT]),
+    )
+
+
+
+class CheckResultTests(SynchronousTestCase):
+    def test_fromCheck(self):
+        """
+        The records are matched against the chain.
+        """
+        result = matchingResult()
+
+        self.assertEqual(
+            (True, True, [True], None),
+            (result.trusted, result.doesMatch, result.matches, result.error)
+        )
+
+
+    def test_fromCheckFailure(self):
+        """
+        Failed checks carry a description of the error.
+        """
+        result = _result.CheckResult.fromCheck(
+            ("example.com", 443, "tcp"),
+            Failure(_dane.GetdnsResponseError(
+                getdns.GETDNS_RESPSTATUS_NO_NAME
+            )),
+        )
+
+        self.assertEqual("GETDNS_RESPSTATUS_NO_NAME", result.error)
+
+
+    def test_fromCheckResumed(self):
+        """
+        Chains of resumed sessions are marked in the result.
+        """
+        result = _result.CheckResult.fromCheck(
+            ("example.com", 443, "tcp"),
+            ((True, [certificateRecord(_dane.USAGE.DANE_EE, CERT)]),
+             _tls.CertificateChain([CERT], resumed=True)),
+        )
+
+        self.assertEqual((True, True),
+                         (result.resumed, result.asDict()["resumed"]))
+        self.assertNotIn("resumed", matchingResult().asDict())
+
+
+    def test_fromCheckEndpoints(self):
+        """
+        If all addresses have been checked, the records are matched against
+        the chain of every address and all of them have to match.
+        """
+        records = [certificateRecord(_dane.USAGE.DANE_EE, CERT)]
+        result = _result.CheckResult.fromCheck(
+            ("example.com", 443, "tcp"),
+            ((True, records), [CERT], [
+                ("192.0.2.1", [CERT]),
+                ("2001:db8::1", Failure(ValueError("nope"))),
+            ]),
+        )
+
+        self.assertEqual(
+            [("192.0.2.1", True, None), ("2001:db8::1", False, "nope")],
+            [(e.address, e.doesMatch, e.error) for e in result.endpoints],
+        )
+        self.assertEqual([True], result.matches)
+        self.assertFalse(result.doesMatch)
+        self.assertEqual(
+            ["192.0.2.1", "2001:db8::1"],
+            [e["address"] for e in result.asDict()["endpoints"]],
+        )
+
+
+    def test_fromCheckUnparseable(self):
+        """
+        Lines that couldn't be parsed are kept as host.
+        """
+        result = _result.CheckResult.fromCheck(
+            "bogus", Failure(ValueError("nope"))
+        )
+
+        self.assertEqual(
+            ("bogus", None, None, "nope"),
+            (result.host, result.port, result.proto, result.error)
+        )
+
+
+    def test_asDict(self):
+        """
+        L{_result.CheckResult.asDict} describes every record.
+        """
+        d = matchingResult().asDict()
+        (rec,) = d.pop("tlsaRecords")
+
+        self.assertEqual({
+            "host": "example.com",
+            "port": 443,
+            "proto": "tcp",
+            "trusted": True,
+            "doesMatch": True,
+            "numRecs": 1,
+            "error": None,
+        }, d)
+        self.assertEqual(
+            ("DANE_EE", "CERT", "SHA_256", True, True),
+            (rec["usage"], rec["selector"], rec["matchingType"],
+             rec["valid"], rec["matches"])
+        )
+
+
+
+def mailResult():
+    """
+    Create a result for a mail domain with a matching and a failed MX host.
+    """
+    return _result.MailResult.fromCheck(("example.com",), (True, [
+        (("mx1.example.com", 25, "tcp"),
+         ((True, [certificateRecord(_dane.USAGE.DANE_EE, CERT)]), [CERT])),
+        (("mx2.example.com", 25, "tcp"), Failure(ValueError("nope"))),
+    ]))
+
+
+
+class MailResultTests(SynchronousTestCase):
+    def test_fromCheck(self):
+        """
+        Every MX host gets a L{_result.CheckResult} and the domain only
+        matches if all of them do.
+        """
+        result = mailResult()
+
+        self.assertEqual(
+            ("example.com", True, False),
+            (result.domain, result.mxTrusted, result.doesMatch),
+        )
+        self.assertEqual(
+            [("mx1.example.com", 25, True, None),
+             ("mx2.example.com", 25, False, "nope")],
+            [(host.host, host.port, host.doesMatch, host.error)
+             for host in result.hosts],
+        )
+
+
+    def test_doesMatch(self):
+        """
+        A domain only matches if its MX RRset and the TLSA RRsets of all MX
+        hosts are trusted and a DANE-TA or DANE-EE record of every host
+        matches.
+        """
+        def result(mxTrusted=True, trusted=True, usage=_dane.USAGE.DANE_EE):
+            return _result.MailResult.fromCheck(("example.com",), (
+                mxTrusted, [(("mx.example.com", 25, "tcp"), (
+                    (trusted, [certificateRecord(usage, CERT)]), [CERT]
+                ))]
+            ))
+
+        self.assertEqual(
+            [True, False, False, False, False],
+            [r.doesMatch for r in [
+                result(), result(mxTrusted=False), result(trusted=False),
+                result(usage=_dane.USAGE.PKIX_EE),
+                result(usage=_dane.USAGE.PKIX_TA),
+            ]]
+        )
+
+
+    def test_fromCheckFailure(self):
+        """
+        A failed MX lookup is an error of the domain.
+        """
+        result = _result.MailResult.fromCheck(
+            ("example.com",), Failure(ValueError("nope"))
+        )
+        self.assertEqual(("nope", [], False),
+                         (result.error, result.hosts, result.doesMatch))
+
+
+    def test_asDict(self):
+        """
+        L{_result.MailResult.asDict} contains the dicts of the MX hosts.
+        """
+        d = mailResult().asDict()
+
+        self.assertEqual(
+            ("example.com", True, False, None,
+             ["mx1.example.com", "mx2.example.com"]),
+            (d["domain"], d["mxTrusted"], d["doesMatch"], d["error"],
+             [host["host"] for host in d["mx"]]),
+        )
+
+
+
+class WriterTests(SynchronousTestCase):
+    def test_text(self):
+        """
+        L{_result.TextWriter} writes prose.
+        """
+        stream = io.StringIO()
+        _result.TextWriter(stream).write(matchingResult())
+
+        lines = stream.getvalue().splitlines()
+        self.assertEqual(
+            ["=== example.com 443 tcp", "1 TLSA record found."], lines[:2]
+        )
+        self.assertIn(
+            "The server-sent certificate chain matches at least one of the "
+            "TLSA records.", lines
+        )
+
+
+    def test_textMail(self):
+        """
+        L{_result.TextWriter} writes each MX host of a mail domain.
+        """
+        stream = io.StringIO()
+        _result.TextWriter(stream).write(mailResult())
+
+        lines = stream.getvalue().splitlines()
+        self.assertEqual(["=== example.com MX", "2 MX hosts found."],
+                         lines[:2])
+        self.assertIn("--- mx1.example.com 25 tcp", lines)
+        self.assertIn("ERROR: nope", lines)
+
+
+    def test_jsonLines(self):
+        """
+        L{_result.JSONLinesWriter} writes one JSON object per line.
+        """
+        stream = io.StringIO()
+        writer = _result.JSONLinesWriter(stream)
+        writer.write(matchingResult())
+        writer.write(matchingResult())
+
+        lines = stream.getvalue().splitlines()
+        self.assertEqual(
+            [matchingResult().asDict()] * 2, [json.loads(l) for l in lines]
+        )
+
+
+    def test_csv(self):
+        """
+        L{_result.CSVWriter} writes a header and a row per result.
+        """
+        stream = io.StringIO()
+        _result.CSVWriter(stream).write(matchingResult())
+
+        header, row = csv.reader(io.StringIO(stream.getvalue()))
+        self.assertEqual(_result.CSVWriter.fields, header)
+        self.assertEqual(
+            ["example.com", "443", "tcp", "True", "True", "1", "1", "1", ""],
+            row
+        )
+
+
+    def test_csvMail(self):
+        """
+        In mail mode, L{_result.CSVWriter} writes a row per MX host that
+        starts with the domain.
+        """
+        stream = io.StringIO()
+        _result.CSVWriter(stream, mail=True).write(mailResult())
+
+        header, first, second = csv.reader(io.StringIO(stream.getvalue()))
+        self.assertEqual(_result.CSVWriter.mailFields, header)
+        self.assertEqual(["example.com", "True", "mx1.example.com", "25"],
+                         first[:4])
+        self.assertEqual(["mx2.example.com", "nope"],
+                         [second[2], second[-1]])
+
+
+    def test_msgpack(self):
+        """
+        L{_result.MsgpackWriter} writes a stream of maps.
+        """
+        stream = io.BytesIO()
+        writer = _result.MsgpackWriter(stream)
+        writer.write(matchingResult())
+        writer.write(matchingResult())
+
+        unpacked = list(msgpack.Unpacker(io.BytesIO(stream.getvalue())))
+        self.assertEqual(2, len(unpacked))
+        self.assertEqual("example.com", unpacked[0]["host"])
@@ -0,0 +1,230 @@
+# Copyright (c) Hynek Schlawack, Richard Wall
+# See LICENSE for details.
+
+from __future__ import absolute_import, division, print_function
+
+import importlib.util
+import io
+import os
+import subprocess
+import sys
+
+from twisted.internet import defer, task
+from twisted.internet.testing import MemoryReactorClock
+from twisted.python import usage
+from twisted.trial.unittest import SynchronousTestCase
+
+from danex import _check, _mail, _result
+from danex._dane import GetdnsResponseError
+from danex.__main__ import FORMATS, Options, _main
+from danex.test.test_tls import CERT
+
+
+class OptionsTests(SynchronousTestCase):
+    def test_single(self):
+        """
+        A single target is passed as three arguments.
+        """
+        options = Options()
+        options.parseOptions(["example.com", "443", "tcp"])
+
+        self.assertEqual(("example.com", "443", "tcp"), options["target"])
+
+
+    def test_batch(self):
+        """
+        Batch mode takes a file name and a concurrency limit.
+        """
+        options = Options()
+        options.parseOptions(["--batch", "-", "--concurrency", "10"])
+
+        self.assertEqual(("-", 10), (options["batch"], options["concurrency"]))
+
+
+    def test_batchFile(self):
+        """
+        The batch file is opened while parsing the options.
+        """
+        path = self.mktemp()
+        with open(path, "w") as f:
+            f.write("example.com 443 tcp\n")
+        options = Options()
+        options.parseOptions(["--batch", path])
+        self.addCleanup(options["batch-file"].close)
+
+        self.assertEqual("example.com 443 tcp\n",
+                         options["batch-file"].read())
+
+
+    def test_batchFileMissing(self):
+        """
+        A batch file that can't be read is a usage error.
+        """
+        e = self.assertRaises(
+            usage.UsageError,
+            Options().parseOptions, ["--batch", self.mktemp()]
+        )
+
+        self.assertIn("Can't read", str(e))
+
+
+    def test_batchAndTarget(self):
+        """
+        Batch mode and a single target are mutually exclusive.
+        """
+        self.assertRaises(
+            usage.UsageError,
+            Options().parseOptions, ["--batch", "-", "example.com", "443", "tcp"]
+        )
+
+
+    def test_wrongNumberOfArguments(self):
+        """
+        Without batch mode, exactly three arguments are required.
+        """
+        self.assertRaises(
+            usage.UsageError, Options().parseOptions, ["example.com"]
+        )
+
+
+    def test_storeRequiresBatch(self):
+        """
+        Results can only be stored in batch mode.
+        """
+        self.assertRaises(
+            usage.UsageError, Options().parseOptions,
+            ["--store", "x.db", "example.com", "443", "tcp"]
+        )
+
+
+    def test_incrementalRequiresStore(self):
+        """
+        Incremental scans need a store.
+        """
+        self.assertRaises(
+            usage.UsageError, Options().parseOptions,
+            ["--batch", "-", "--incremental"]
+        )
+
+
+    def test_allAddressesAndStore(self):
+        """
+        Stored results don't cover all addresses of a host.
+        """
+        self.assertRaises(
+            usage.UsageError, Options().parseOptions,
+            ["--batch", "-", "--store", "x.db", "--all-addresses"]
+        )
+
+
+    def test_mail(self):
+        """
+        In mail mode, a single mail domain is passed.
+        """
+        options = Options()
+        options.parseOptions(["--mail", "example.com"])
+
+        self.assertEqual(("example.com",), options["target"])
+        self.assertRaises(
+            usage.UsageError,
+            Options().parseOptions, ["--mail", "example.com", "25", "tcp"]
+        )
+
+
+    def test_formats(self):
+        """
+        The formats known to the option parser are the ones that have
+        writers.
+        """
+        self.assertEqual(sorted(_result.WRITERS), list(FORMATS))
+
+
+    def test_msgpackMissing(self):
+        """
+        The msgpack format is refused if msgpack isn't installed.
+        """
+        self.patch(importlib.util, "find_spec", lambda name: None)
+
+        e = self.assertRaises(
+            usage.UsageError, Options().parseOptions,
+            ["--format", "msgpack", "example.com", "443", "tcp"],
+        )
+        self.assertEqual(
+            "The msgpack format requires the msgpack package.", str(e)
+        )
+
+
+
+class MainTests(SynchronousTestCase):
+    def setUp(self):
+        self.out = io.StringIO()
+        self.patch(sys, "stdout", self.out)
+
+
+    def react(self, argv):
+        """
+        Run L{_main} like C{danex} does and return the exit status.
+        """
+        options = Options()
+        options.parseOptions(["--format", "jsonl"] + argv)
+        e = self.assertRaises(
+            SystemExit, task.react, _main, [options],
+            _reactor=MemoryReactorClock(),
+        )
+        return e.code
+
+
+    def test_failedCheck(self):
+        """
+        If the check of a single target fails, the error is written like in
+        batch mode and danex exits with status 1.
+        """
+        self.patch(_check, "checkTarget", lambda *args, **kw: defer.fail(
+            GetdnsResponseError(901)
+        ))
+
+        self.assertEqual(1, self.react(["example.com", "443", "tcp"]))
+        self.assertIn(u"GETDNS_RESPSTATUS_NO_NAME", self.out.getvalue())
+        self.assertEqual([], self.flushLoggedErrors())
+
+
+    def test_succeededCheck(self):
+        """
+        If the check succeeds, danex exits with status 0.
+        """
+        self.patch(_check, "checkTarget", lambda *args, **kw: defer.succeed(
+            ((True, []), [CERT])
+        ))
+
+        self.assertEqual(0, self.react(["example.com", "443", "tcp"]))
+
+
+    def test_failedMailCheck(self):
+        """
+        If the MX hosts of a mail domain can't be determined, danex exits
+        with status 1.
+        """
+        self.patch(_mail.MailChecker, "check", lambda self, domain: defer.fail(
+            GetdnsResponseError(901)
+        ))
+
+        self.assertEqual(1, self.react(["--mail", "example.com"]))
+        self.assertIn(u"GETDNS_RESPSTATUS_NO_NAME", self.out.getvalue())
+
+
+
+class StartupTests(SynchronousTestCase):
+    def test_lazyImports(self):
+        """
+        Importing the CLI doesn't import Twisted's networking, getdns or
+        pyOpenSSL; they're imported once the command line has been parsed.
+        """
+        out = subprocess.check_output([
+            sys.executable, "-c",
+            "import sys, danex.__main__\n"
+            "heavy = ('getdns', 'OpenSSL', 'idna', 'twisted.internet', "
+            "'danex._check', 'danex._dane', 'danex._result')\n"
+            "print(' '.join(sorted(m for m in sys.modules "
+            "if m.startswith(heavy))))",
+        ], env=dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path)))
+        self.assertEqual(b"", out.strip())
@@ -0,0 +1,243 @@
+# Copyright (c) Hynek Schlawack, Richard Wall
+# See LICENSE for details.
+
+from __future__ import absolute_import, division, print_function
+
+import hashlib
+
+import getdns
+
+from OpenSSL import crypto
+from twisted.internet import defer
+from twisted.internet.task import Clock
+from twisted.trial.unittest import SynchronousTestCase
+
+from danex import _store
+from danex._dane import GetdnsResponseError, TLSARecord
+from danex.testing import makeChain
+
+
+_, CHAIN = makeChain(keyType="ec")
+
+
+class PackRecordsTests(SynchronousTestCase):
+    def test_roundtrip(self):
+        """
+        L{_store.unpackRecords} restores what L{_store.packRecords}
+        serialized, including invalid fields.
+        """
+        records = [TLSARecord(b"abc", 3, 1, 1), TLSARecord(b"", 9, 0, 7)]
+        unpacked = _store.unpackRecords(_store.packRecords(records))
+        self.assertEqual(
+            [(b"abc", (3, 1, 1)), (b"", (9, 0, 7))],
+            [(r.payload, r.rawValues()) for r in unpacked],
+        )
+
+
+    def test_rrsetHash(self):
+        """
+        The hash of an RRset doesn't depend on the order of its records but
+        on their contents.
+        """
+        a, b = TLSARecord(b"abc", 3, 1, 1), TLSARecord(b"def", 2, 0, 1)
+        self.assertEqual(_store.rrsetHash([a, b]), _store.rrsetHash([b, a]))
+        self.assertNotEqual(_store.rrsetHash([a]),
+                            _store.rrsetHash([TLSARecord(b"abd", 3, 1, 1)]))
+
+
+
+class ScanStoreTests(SynchronousTestCase):
+    def test_roundtrip(self):
+        """
+        Stored results can be retrieved by name.
+        """
+        store = _store.ScanStore(":memory:")
+        store.put("_443._tcp.example.com", _store.StoredResult(
+            10, 20, trusted=True, records=[TLSARecord(b"abc", 3, 1, 1)],
+            rrsetHash=b"hash", handshaked=10, certFingerprint=b"fp",
+            certExpires=30, chain=CHAIN,
+        ))
+        entry = store.get("_443._tcp.example.com")
+
+        self.assertEqual(
+            (10, 20, None, True, [b"abc"], b"hash", 10, b"fp", 30),
+            (entry.checked, entry.dnsExpires, entry.errorCode, entry.trusted,
+             [r.payload for r in entry.records], entry.rrsetHash,
+             entry.handshaked, entry.certFingerprint, entry.certExpires),
+        )
+        self.assertEqual(
+            [c.digest("sha256") for c in CHAIN],
+            [c.digest("sha256") for c in entry.chain],
+        )
+        self.assertIs(None, store.get("_443._tcp.example.org"))
+        self.assertEqual(1, len(store))
+
+
+    def test_replace(self):
+        """
+        Storing a result replaces the previous one.
+        """
+        store = _store.ScanStore(":memory:")
+        store.put("a", _store.StoredResult(1, 2, errorCode=901))
+        store.put("a", _store.StoredResult(3, 4, errorCode=902))
+        self.assertEqual((1, 902), (len(store), store.get("a").errorCode))
+
+
+
+class IncrementalCheckerTests(SynchronousTestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.clock.advance(1000)
+        self.store = _store.ScanStore(":memory:")
+        self.answer = (True, [TLSARecord(b"abc", 3, 1, 1)], 300)
+
+
+    def resolve(self, name):
+        if isinstance(self.answer, Exception):
+            return defer.fail(self.answer)
+        return defer.succeed(self.answer)
+
+
+    def retrieve(self, host, port):
+        return defer.succeed(CHAIN)
+
+
+    def checker(self, **kw):
+        return _store.IncrementalChecker(
+            self.store, reactor=self.clock, resolve=self.resolve,
+            retrieve=self.retrieve, **kw
+        )
+
+
+    def check(self, checker):
+        return self.successResultOf(checker.check("example.com", 443, "tcp"))
+
+
+    def test_first(self):
+        """
+        Unknown targets are resolved and retrieved and the result is stored.
+        """
+        checker = self.checker()
+        (trusted, records), chain = self.check(checker)
+
+        self.assertEqual((True, [b"abc"], CHAIN),
+                         (trusted, [r.payload for r in records], chain))
+        self.assertEqual((1, 1, 0), (checker.resolved, checker.handshakes,
+                                     checker.reused))
+        entry = self.store.get("_443._tcp.example.com")
+        self.assertEqual(
+            (1300, 1000, hashlib.sha256(
+                crypto.dump_certificate(crypto.FILETYPE_ASN1, CHAIN[0])
+            ).digest()),
+            (entry.dnsExpires, entry.handshaked, entry.certFingerprint),
+        )
+        self.assertEqual(_store.certificateExpires(CHAIN[0]),
+                         entry.certExpires)
+
+
+    def test_fresh(self):
+        """
+        Results whose TLSA answer hasn't expired are reused without any
+        lookups.
+        """
+        self.check(self.checker())
+        checker = self.checker()
+        self.clock.advance(299)
+        (_, records), _ = self.check(checker)
+
+        self.assertEqual([b"abc"], [r.payload for r in records])
+        self.assertEqual((0, 0, 1), (checker.resolved, checker.handshakes,
+                                     checker.reused))
+
+
+    def test_expiredSameRRset(self):
+        """
+        Expired answers are resolved again, but the certificate isn't
+        retrieved if the RRset didn't change.
+        """
+        self.check(self.checker())
+        checker = self.checker()
+        self.clock.advance(300)
+        self.check(checker)
+
+        self.assertEqual((1, 0, 0), (checker.resolved, checker.handshakes,
+                                     checker.reused))
+        self.assertEqual(
+            1600, self.store.get("_443._tcp.example.com").dnsExpires
+        )
+
+
+    def test_expiredChangedRRset(self):
+        """
+        The certificate is retrieved again if the RRset changed.
+        """
+        self.check(self.checker())
+        checker = self.checker()
+        self.clock.advance(300)
+        self.answer = (True, [TLSARecord(b"def", 3, 1, 1)], 300)
+        self.check(checker)
+
+        self.assertEqual((1, 1), (checker.resolved, checker.handshakes))
+
+
+    def test_maxCertAge(self):
+        """
+        The certificate is retrieved again once it's older than
+        C{maxCertAge}.
+        """
+        self.check(self.checker())
+        checker = self.checker(maxCertAge=100)
+        self.clock.advance(100)
+        self.check(checker)
+
+        self.assertEqual((0, 1), (checker.resolved, checker.handshakes))
+
+
+    def test_negative(self):
+        """
+        Cacheable negative answers are stored and reused.
+        """
+        self.answer = GetdnsResponseError(
+            getdns.GETDNS_RESPSTATUS_NO_NAME, 60
+        )
+        checker = self.checker()
+        self.failureResultOf(checker.check("example.com", 443, "tcp"),
+                             GetdnsResponseError)
+        self.clock.advance(30)
+        f = self.failureResultOf(checker.check("example.com", 443, "tcp"),
+                                 GetdnsResponseError)
+
+        self.assertEqual(
+            (getdns.GETDNS_RESPSTATUS_NO_NAME, 30),
+            (f.value.errorCode, f.value.ttl),
+        )
+        self.assertEqual((1, 1), (checker.resolved, checker.reused))
+
+
+    def test_negativeUncacheable(self):
+        """
+        Negative answers without a TTL aren't stored.
+        """
+        self.answer = GetdnsResponseError(
+            getdns.GETDNS_RESPSTATUS_ALL_TIMEOUT
+        )
+        self.failureResultOf(
+            self.checker().check("example.com", 443, "tcp"),
+            GetdnsResponseError,
+        )
+        self.assertEqual(0, len(self.store))
+
+
+    def test_notIncremental(self):
+        """
+        Unless incremental, stored results are ignored but updated.
+        """
+        self.check(self.checker())
+        checker = self.checker(incremental=False)
+        self.clock.advance(10)
+        self.check(checker)
+
+        self.assertEqual((1, 1, 0), (checker.resolved, checker.handshakes,
+                                     checker.reused))
+        self.assertEqual(1010, self.store.get("_443._tcp.example.com").checked)
+
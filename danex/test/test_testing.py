@@ -0,0 +1,177 @@
+# Copyright (c) Hynek Schlawack, Richard Wall
+# See LICENSE for details.
+
+from __future__ import absolute_import, division, print_function
+
+import getdns
+
+from twisted.internet.task import Clock
+from twisted.test.proto_helpers import MemoryReactor
+from twisted.trial.unittest import SynchronousTestCase
+
+from danex import _dane
+from danex._pool import ContextPool
+from danex.testing import (
+    ScriptedGetdns, ScriptedResolver, TLSFarm, associationData, makeChain,
+)
+
+
+class ScriptedGetdnsTests(SynchronousTestCase):
+    def setUp(self):
+        self.sleeps = []
+        self.getdns = ScriptedGetdns(latency=0.5, sleep=self.sleeps.append)
+        self.pool = ContextPool(self.getdns)
+
+
+    def query(self, name):
+        return _dane.queryTLSA(name, getdns=self.getdns, pool=self.pool)
+
+
+    def test_records(self):
+        """
+        Added records are returned with their TTL and DNSSEC status after
+        the latency has passed.
+        """
+        self.getdns.addRecords(
+            "_443._tcp.example.com", [(3, 1, 1, b"abc")], ttl=60,
+            dnssecStatus=getdns.GETDNS_DNSSEC_INSECURE,
+        )
+        trusted, (record,), ttl = self.query("_443._tcp.example.com")
+        self.assertEqual(
+            (False, _dane.USAGE.DANE_EE, _dane.SELECTOR.SPKI,
+             _dane.MATCHING_TYPE.SHA_256, b"abc", 60),
+            (trusted, record.usage, record.selector, record.matchingType,
+             record.payload, ttl),
+        )
+        self.assertEqual([0.5], self.sleeps)
+
+
+    def test_error(self):
+        """
+        Added errors are raised with the negative TTL they've been added
+        with.
+        """
+        self.getdns.addError(
+            "_443._tcp.example.com", getdns.GETDNS_RESPSTATUS_ALL_TIMEOUT,
+            negativeTTL=30,
+        )
+        e = self.assertRaises(_dane.GetdnsResponseError,
+                              self.query, "_443._tcp.example.com")
+        self.assertEqual(
+            (getdns.GETDNS_RESPSTATUS_ALL_TIMEOUT, 30), (e.errorCode, e.ttl)
+        )
+
+
+    def test_unknown(self):
+        """
+        Names that haven't been added don't exist.
+        """
+        e = self.assertRaises(_dane.GetdnsResponseError,
+                              self.query, "_443._tcp.example.com")
+        self.assertEqual(
+            (getdns.GETDNS_RESPSTATUS_NO_NAME, 300), (e.errorCode, e.ttl)
+        )
+
+
+    def test_latency(self):
+        """
+        The latency can be overridden per name and may be a callable.
+        """
+        self.getdns.latency = lambda: 0.25
+        self.getdns.addRecords("a", [(3, 1, 1, b"abc")], latency=2)
+        self.getdns.addRecords("b", [(3, 1, 1, b"abc")])
+        self.query("a")
+        self.query("b")
+        self.assertEqual([2, 0.25], self.sleeps)
+
+
+    def test_queries(self):
+        """
+        Answered queries are counted by name.
+        """
+        self.getdns.addRecords("a", [(3, 1, 1, b"abc")])
+        self.query("a")
+        self.query("a")
+        self.getdns.remove("a")
+        self.assertRaises(_dane.GetdnsResponseError, self.query, "a")
+        self.assertEqual({"a": 3}, self.getdns.queries)
+
+
+
+class ScriptedResolverTests(SynchronousTestCase):
+    def test_lookupTLSA(self):
+        """
+        Answers arrive once the latency has passed on the reactor.
+        """
+        clock = Clock()
+        fake = ScriptedGetdns(latency=1)
+        fake.addRecords("a", [(3, 1, 1, b"abc")], ttl=60)
+        d = ScriptedResolver(fake, clock).lookupTLSA("a")
+        clock.advance(0.5)
+        self.assertNoResult(d)
+        clock.advance(0.5)
+        trusted, records, ttl = self.successResultOf(d)
+        self.assertEqual((True, [b"abc"], 60),
+                         (trusted, [r.payload for r in records], ttl))
+
+
+    def test_lookupTLSAError(self):
+        """
+        Errors fail the L{Deferred} with a L{_dane.GetdnsResponseError}.
+        """
+        clock = Clock()
+        d = ScriptedResolver(ScriptedGetdns(), clock).lookupTLSA("a")
+        clock.advance(0)
+        self.failureResultOf(d, _dane.GetdnsResponseError)
+
+
+
+class TLSFarmTests(SynchronousTestCase):
+    def test_publish(self):
+        """
+        L{TLSFarm.publish} adds records for each server that match its
+        chain: the server's own certificate for end entity usages, the CA
+        for trust anchor usages.
+        """
+        reactor = MemoryReactor()
+        farm = TLSFarm(reactor, size=1, keyType="ec")
+        self.successResultOf(farm.start())
+        self.assertEqual(1, len(reactor.sslServers))
+        [(port, chain)] = farm.servers
+        name = _dane.tlsaDomainName("127.0.0.1", port, "tcp")
+
+        for usage, selector in [(3, 1), (2, 0)]:
+            fake = ScriptedGetdns()
+            farm.publish(fake, usage=usage, selector=selector)
+            _, records, _ = _dane.tlsaFromResults(fake.respond(name)[0], fake)
+            self.assertEqual([True], _dane.matchChain(records, chain))
+
+
+    def test_targets(self):
+        """
+        L{TLSFarm.targets} cycles through the servers.
+        """
+        farm = TLSFarm(MemoryReactor())
+        farm.servers = [(1, None), (2, None)]
+        self.assertEqual(
+            [("127.0.0.1", 1, "tcp"), ("127.0.0.1", 2, "tcp"),
+             ("127.0.0.1", 1, "tcp")],
+            farm.targets(3),
+        )
+
+
+
+class AssociationDataTests(SynchronousTestCase):
+    def test_matches(self):
+        """
+        L{associationData} creates data that matches the certificate for
+        every selector and matching type.
+        """
+        _, (cert, _) = makeChain(keyType="ec")
+        for selector in (0, 1):
+            for matchingType in (0, 1, 2):
+                record = _dane.TLSARecord(
+                    associationData(cert, selector, matchingType),
+                    3, selector, matchingType,
+                )
+                self.assertTrue(record.matchesCertificate(cert))
@@ -0,0 +1,596 @@
+# Copyright (c) Hynek Schlawack, Richard Wall
+# See LICENSE for details.
+
+from __future__ import absolute_import, division, print_function
+
+from OpenSSL import SSL, crypto
+from twisted.internet import defer, reactor
+from twisted.internet.endpoints import (
+    SSL4ServerEndpoint, TCP4ServerEndpoint
+)
+from twisted.internet.error import ConnectionRefusedError
+from twisted.internet.protocol import Factory, Protocol
+from twisted.protocols.basic import LineOnlyReceiver
+from twisted.internet.ssl import CertificateOptions
+from twisted.internet.task import Clock
+from twisted.trial.unittest import TestCase
+
+from danex import _tls
+from danex.testing import makeCertificate, makeChain, makeKey
+
+
+_caKey = makeKey()
+CA_CERT = makeCertificate(u"Test CA", _caKey)
+CA = _caKey, CA_CERT
+_key, (CERT, _) = makeChain(ca=CA)
+CA_KEY = crypto.PKey.from_cryptography_key(_caKey)
+KEY = crypto.PKey.from_cryptography_key(_key)
+
+
+def dump(cert):
+    return crypto.dump_certificate(crypto.FILETYPE_ASN1, cert)
+
+
+class RecordingProtocol(Protocol):
+    """
+    Records all data it receives in its factory.
+    """
+    def connectionMade(self):
+        self.factory.connections += 1
+
+
+    def dataReceived(self, data):
+        self.factory.received.append(data)
+
+
+
+class RecordingFactory(Factory):
+    protocol = RecordingProtocol
+
+    def __init__(self):
+        self.connections = 0
+        self.received = []
+
+
+
+class FakeSMTPServer(LineOnlyReceiver):
+    """
+    Offers STARTTLS if C{factory.options} isn't C{None} and starts TLS with
+    them.
+    """
+    def connectionMade(self):
+        self.sendLine(b"220 mx.example.com ESMTP")
+
+
+    def lineReceived(self, line):
+        self.factory.received.append(line)
+        if line.startswith(b"EHLO "):
+            self.sendLine(b"250-mx.example.com")
+            if self.factory.options is not None:
+                self.sendLine(b"250-STARTTLS")
+            self.sendLine(b"250 8BITMIME")
+        elif line == b"STARTTLS":
+            self.sendLine(b"220 Ready to start TLS")
+            self.transport.startTLS(self.factory.options)
+        elif line == b"QUIT":
+            self.sendLine(b"221 Bye")
+            self.transport.loseConnection()
+
+
+    def connectionLost(self, reason):
+        self.factory.closed.callback(None)
+
+
+
+class FakeSMTPFactory(Factory):
+    protocol = FakeSMTPServer
+
+    def __init__(self, options):
+        self.options = options
+        self.received = []
+        self.closed = defer.Deferred()
+
+
+
+class RecordingSessionCache(_tls.SessionCache):
+    """
+    A session cache that knows when all probes have hung up.
+    """
+    def __init__(self):
+        _tls.SessionCache.__init__(self)
+        self.seen = 0
+        self.established = []
+        self._waiting = []
+
+
+    def certificateSeen(self, key, fingerprint, tag=None):
+        self.seen += 1
+        return _tls.SessionCache.certificateSeen(self, key, fingerprint, tag)
+
+
+    def sessionResumed(self, key):
+        self.seen += 1
+        _tls.SessionCache.sessionResumed(self, key)
+
+
+    def sessionEstablished(self, key, session):
+        _tls.SessionCache.sessionEstablished(self, key, session)
+        self.established.append((key, session))
+        if len(self.established) == self.seen:
+            waiting, self._waiting = self._waiting, []
+            for d in waiting:
+                d.callback(None)
+
+
+    def waitForClose(self):
+        """
+        Return a L{defer.Deferred} that fires once every probe that
+        completed its handshake has closed its connection.
+        """
+        if len(self.established) == self.seen:
+            return defer.succeed(None)
+        d = defer.Deferred()
+        self._waiting.append(d)
+        return d
+
+
+
+class SessionCacheTests(TestCase):
+    def test_fingerprint(self):
+        """
+        The fingerprint of the last certificate is kept and changes are
+        counted.
+        """
+        cache = _tls.SessionCache()
+        key = (u"example.com", 443, "192.0.2.1")
+
+        self.assertEqual(
+            (None, False, False, True, b"b", 1),
+            (cache.fingerprint(key), cache.certificateSeen(key, b"a"),
+             cache.certificateSeen(key, b"a"),
+             cache.certificateSeen(key, b"b"), cache.fingerprint(key),
+             cache.changed),
+        )
+
+
+    def test_session(self):
+        """
+        Established sessions are offered and counted.  Sessions of
+        endpoints whose certificate changed aren't.
+        """
+        cache = _tls.SessionCache()
+        key = (u"example.com", 443, "192.0.2.1")
+        session = object()
+        cache.certificateSeen(key, b"a")
+        cache.sessionEstablished(key, session)
+
+        self.assertEqual((session, b"a", 1),
+                         (cache.session(key), cache.fingerprint(key),
+                          cache.offered))
+        cache.certificateSeen(key, b"b")
+        self.assertIs(None, cache.session(key))
+
+
+    def test_maxAge(self):
+        """
+        Sessions are only offered for C{maxAge} seconds after the last full
+        handshake, however often they have been resumed since.
+        """
+        clock = Clock()
+        cache = _tls.SessionCache(maxAge=10, clock=clock)
+        key = (u"example.com", 443, "192.0.2.1")
+        cache.certificateSeen(key, b"a")
+        clock.advance(9)
+        cache.sessionEstablished(key, object())
+
+        self.assertIsNot(None, cache.session(key))
+        clock.advance(1)
+        self.assertIs(None, cache.session(key))
+        cache.certificateSeen(key, b"a")
+        self.assertIsNot(None, cache.session(key))
+
+
+    def test_tag(self):
+        """
+        Sessions are only offered under the TLSA RRset they have been
+        established under.
+        """
+        cache = _tls.SessionCache()
+        key = (u"example.com", 443, "192.0.2.1")
+        cache.certificateSeen(key, b"a", tag=1)
+        cache.sessionEstablished(key, object())
+
+        self.assertEqual((True, False, 1),
+                         (cache.session(key, 1) is not None,
+                          cache.session(key, 2) is not None,
+                          cache.offered))
+
+
+    def test_maxSize(self):
+        """
+        The least recently probed endpoints are forgotten first.
+        """
+        cache = _tls.SessionCache(maxSize=2)
+        for i in range(3):
+            cache.certificateSeen(i, b"a")
+        cache.sessionEstablished(1, object())
+        cache.certificateSeen(3, b"a")
+
+        self.assertEqual([None, b"a", None, b"a"],
+                         [cache.fingerprint(i) for i in range(4)])
+
+
+
+class RetrieveCertificateTests(TestCase):
+    def setUp(self):
+        self.sessions = RecordingSessionCache()
+        self.addCleanup(self.sessions.waitForClose)
+
+
+    @defer.inlineCallbacks
+    def listen(self, endpoint):
+        factory = RecordingFactory()
+        port = yield endpoint.listen(factory)
+        self.addCleanup(port.stopListening)
+        defer.returnValue((factory, port.getHost().port))
+
+
+    @defer.inlineCallbacks
+    def test_retrievesCertificate(self):
+        """
+        L{_tls.retrieveCertificate} connects to the given port and fires with
+        the certificate that the server presents, without sending any
+        application data.
+        """
+        factory, port = yield self.listen(SSL4ServerEndpoint(
+            reactor, 0, CertificateOptions(privateKey=KEY, certificate=CERT),
+            interface="127.0.0.1",
+        ))
+
+        cert = yield _tls.retrieveCertificate(u"127.0.0.1", port,
+                                              sessions=self.sessions)
+
+        self.assertEqual(dump(CERT), dump(cert))
+        self.assertEqual([], factory.received)
+
+
+    @defer.inlineCallbacks
+    def test_retrievesCertificateChain(self):
+        """
+        L{_tls.retrieveCertificateChain} fires with all certificates that
+        the server presents, its own first.
+        """
+        factory, port = yield self.listen(SSL4ServerEndpoint(
+            reactor, 0, CertificateOptions(
+                privateKey=KEY, certificate=CERT, extraCertChain=[CA_CERT],
+            ),
+            interface="127.0.0.1",
+        ))
+
+        chain = yield _tls.retrieveCertificateChain(u"127.0.0.1", port,
+                                                    sessions=self.sessions)
+
+        self.assertEqual(
+            [dump(CERT), dump(CA_CERT)], [dump(cert) for cert in chain]
+        )
+
+
+    @defer.inlineCallbacks
+    def test_serverName(self):
+        """
+        Host names are sent as SNI but IP literals aren't.
+        """
+        options = CertificateOptions(privateKey=KEY, certificate=CERT)
+        names = []
+        options.getContext().set_tlsext_servername_callback(
+            lambda connection: names.append(connection.get_servername())
+        )
+        factory, port = yield self.listen(SSL4ServerEndpoint(
+            reactor, 0, options, interface="127.0.0.1",
+        ))
+
+        for hostname in [u"127.0.0.1", u"localhost"]:
+            yield _tls.retrieveCertificateChain(hostname, port,
+                                                sessions=self.sessions)
+
+        self.assertEqual([None, b"localhost"], names)
+
+
+    @defer.inlineCallbacks
+    def test_handshakeTimeout(self):
+        """
+        If the server doesn't complete the handshake within
+        C{handshakeTimeout} seconds, the L{Deferred} fails with a
+        L{defer.TimeoutError}.
+        """
+        factory, port = yield self.listen(TCP4ServerEndpoint(
+            reactor, 0, interface="127.0.0.1",
+        ))
+
+        d = _tls.retrieveCertificate(u"127.0.0.1", port, handshakeTimeout=0.1,
+                                     sessions=self.sessions)
+
+        yield self.assertFailure(d, defer.TimeoutError)
+        self.assertEqual(1, factory.connections)
+
+
+    @defer.inlineCallbacks
+    def probeTwice(self, options, **kw):
+        """
+        Probe a server with I{options} on a fresh port, then probe it again
+        offering the session of the first probe.
+
+        @param kw: Passed to L{_tls.retrieveCertificateChain} for the second
+            probe.
+
+        @return: The port and the second chain.
+        """
+        factory, port = yield self.listen(SSL4ServerEndpoint(
+            reactor, 0, options, interface="127.0.0.1",
+        ))
+        yield _tls.retrieveCertificateChain(u"127.0.0.1", port,
+                                            sessions=self.sessions)
+        yield self.sessions.waitForClose()
+        chain = yield _tls.retrieveCertificateChain(
+            u"127.0.0.1", port, sessions=self.sessions, **kw
+        )
+        defer.returnValue((port, chain))
+
+
+    @defer.inlineCallbacks
+    def test_resumesSession(self):
+        """
+        The connection is shut down cleanly and, if I{resume} is true, its
+        session is resumed the next time the same address is probed.  The
+        chain is marked as coming from the resumed session.
+        """
+        port, chain = yield self.probeTwice(CertificateOptions(
+            privateKey=KEY, certificate=CERT, enableSessionTickets=True,
+        ), resume=True)
+        key = (u"127.0.0.1", port, "127.0.0.1")
+
+        self.assertEqual(key, self.sessions.established[0][0])
+        self.assertEqual(
+            (1, 1, CERT.digest("sha256"), 0),
+            (self.sessions.offered, self.sessions.resumed,
+             self.sessions.fingerprint(key), self.sessions.changed),
+        )
+        self.assertTrue(chain.resumed)
+        self.assertEqual(dump(CERT), dump(chain[0]))
+
+
+    @defer.inlineCallbacks
+    def test_noResumeByDefault(self):
+        """
+        Without I{resume}, every probe does a full handshake.
+        """
+        _, chain = yield self.probeTwice(CertificateOptions(
+            privateKey=KEY, certificate=CERT, enableSessionTickets=True,
+        ))
+
+        self.assertEqual((0, 0), (self.sessions.offered,
+                                  self.sessions.resumed))
+        self.assertFalse(chain.resumed)
+
+
+    @defer.inlineCallbacks
+    def test_noResumeWithoutBindings(self):
+        """
+        If pyOpenSSL's private bindings can't tell whether a handshake
+        resumed a session, no session is offered and every probe does a full
+        handshake even if I{resume} is true.
+        """
+        self.patch(_tls, "_SSL_session_reused", None)
+        _, chain = yield self.probeTwice(CertificateOptions(
+            privateKey=KEY, certificate=CERT, enableSessionTickets=True,
+        ), resume=True)
+
+        self.assertEqual((0, 0), (self.sessions.offered,
+                                  self.sessions.resumed))
+        self.assertFalse(chain.resumed)
+        self.assertEqual(dump(CERT), dump(chain[0]))
+
+
+    def test_sessionReusedWithoutBindings(self):
+        """
+        Without pyOpenSSL's private bindings, sessions are reported as not
+        resumed.
+        """
+        self.patch(_tls, "_SSL_session_reused", None)
+
+        self.assertFalse(_tls._sessionReused(
+            SSL.Connection(_tls._getContext())
+        ))
+
+
+    @defer.inlineCallbacks
+    def test_rotatedCertificate(self):
+        """
+        A resumed session yields the chain of the original handshake even if
+        the server rotated its certificate.  A full handshake is forced once
+        the session is older than C{maxAge} and detects the change.
+        """
+        newKey, (newCert, _) = makeChain(ca=CA)
+        options = CertificateOptions(
+            privateKey=KEY, certificate=CERT, enableSessionTickets=True,
+        )
+        rotated = CertificateOptions(
+            privateKey=crypto.PKey.from_cryptography_key(newKey),
+            certificate=newCert, enableSessionTickets=True,
+        ).getContext()
+        state = {"rotated": False}
+
+        def switch(connection):
+            # Connections keep the ticket keys of the original context.
+            if state["rotated"]:
+                connection.set_context(rotated)
+
+        options.getContext().set_tlsext_servername_callback(switch)
+        port, _ = yield self.probeTwice(options, resume=True)
+        yield self.sessions.waitForClose()
+        state["rotated"] = True
+
+        stale = yield _tls.retrieveCertificateChain(
+            u"127.0.0.1", port, sessions=self.sessions, resume=True,
+        )
+        yield self.sessions.waitForClose()
+        self.sessions.maxAge = 0
+        fresh = yield _tls.retrieveCertificateChain(
+            u"127.0.0.1", port, sessions=self.sessions, resume=True,
+        )
+
+        self.assertEqual((True, dump(CERT)), (stale.resumed, dump(stale[0])))
+        self.assertEqual((False, dump(newCert)),
+                         (fresh.resumed, dump(fresh[0])))
+        self.assertEqual(1, self.sessions.changed)
+
+
+
+class STARTTLSTests(TestCase):
+    def setUp(self):
+        self.sessions = RecordingSessionCache()
+        self.addCleanup(self.sessions.waitForClose)
+
+
+    @defer.inlineCallbacks
+    def listen(self, options):
+        factory = FakeSMTPFactory(options)
+        port = yield TCP4ServerEndpoint(
+            reactor, 0, interface="127.0.0.1",
+        ).listen(factory)
+        self.addCleanup(port.stopListening)
+        defer.returnValue((factory, port.getHost().port))
+
+
+    @defer.inlineCallbacks
+    def test_smtp(self):
+        """
+        With C{starttls="smtp"}, the chain is retrieved after an SMTP
+        STARTTLS upgrade.
+        """
+        factory, port = yield self.listen(CertificateOptions(
+            privateKey=KEY, certificate=CERT, extraCertChain=[CA_CERT],
+        ))
+
+        chain = yield _tls.retrieveCertificateChain(
+            u"127.0.0.1", port, starttls="smtp", sessions=self.sessions,
+        )
+
+        self.assertEqual(
+            [dump(CERT), dump(CA_CERT)], [dump(cert) for cert in chain]
+        )
+        self.assertEqual([b"EHLO localhost", b"STARTTLS"],
+                         factory.received[:2])
+
+
+    @defer.inlineCallbacks
+    def test_smtpWithoutSTARTTLS(self):
+        """
+        If the server doesn't offer STARTTLS, the retrieval fails with an
+        L{_tls.SMTPError} and the session is ended.
+        """
+        factory, port = yield self.listen(None)
+
+        d = _tls.retrieveCertificateChain(
+            u"127.0.0.1", port, starttls="smtp", sessions=self.sessions,
+        )
+
+        yield self.assertFailure(d, _tls.SMTPError)
+        yield factory.closed
+        self.assertEqual([b"EHLO localhost", b"QUIT"], factory.received)
+
+
+    def test_unknownProtocol(self):
+        """
+        Unknown STARTTLS protocols are rejected.
+        """
+        self.assertRaises(ValueError, _tls.retrieveCertificateChain,
+                          u"127.0.0.1", 25, starttls="gopher")
+
+
+
+class RetrieveCertificateChainsTests(TestCase):
+    def setUp(self):
+        self.sessions = RecordingSessionCache()
+        self.addCleanup(self.sessions.waitForClose)
+
+
+    @defer.inlineCallbacks
+    def listen(self, interface, port=0, key=KEY, cert=CERT):
+        port = yield SSL4ServerEndpoint(
+            reactor, port,
+            CertificateOptions(privateKey=key, certificate=cert),
+            interface=interface,
+        ).listen(RecordingFactory())
+        self.addCleanup(port.stopListening)
+        defer.returnValue(port.getHost().port)
+
+
+    def resolveTo(self, *addresses):
+        def resolve(hostname, port, reactor):
+            return defer.succeed(list(addresses))
+        return resolve
+
+
+    @defer.inlineCallbacks
+    def test_allAddresses(self):
+        """
+        L{_tls.retrieveCertificateChains} fires with the chain of every
+        address in the order of the resolver.
+        """
+        port = yield self.listen("127.0.0.1")
+        yield self.listen("127.0.0.2", port, key=CA_KEY, cert=CA_CERT)
+
+        res = yield _tls.retrieveCertificateChains(
+            u"127.0.0.1", port,
+            resolve=self.resolveTo("127.0.0.2", "127.0.0.1"),
+            sessions=self.sessions,
+        )
+
+        self.assertEqual(
+            [("127.0.0.2", dump(CA_CERT)), ("127.0.0.1", dump(CERT))],
+            [(address, dump(chain[0])) for address, chain in res],
+        )
+
+
+    @defer.inlineCallbacks
+    def test_failedAddress(self):
+        """
+        Addresses whose chain can't be retrieved are reported with the
+        failure.
+        """
+        port = yield self.listen("127.0.0.1")
+
+        res = yield _tls.retrieveCertificateChains(
+            u"127.0.0.1", port,
+            resolve=self.resolveTo("127.0.0.1", "127.0.0.2"),
+            sessions=self.sessions,
+        )
+
+        [(first, chain), (second, failure)] = res
+        self.assertEqual(("127.0.0.1", "127.0.0.2", dump(CERT)),
+                         (first, second, dump(chain[0])))
+        self.assertTrue(failure.check(ConnectionRefusedError))
+
+
+    @defer.inlineCallbacks
+    def test_ipv6Literal(self):
+        """
+        IPv6 literals are connected to without IDNA-encoding them.
+        """
+        port = yield self.listen("::1")
+
+        res = yield _tls.retrieveCertificateChains(u"::1", port,
+                                                   sessions=self.sessions)
+
+        self.assertEqual([("::1", dump(CERT))],
+                         [(address, dump(chain[0])) for address, chain in res])
+
+
+    def test_resolveLiteral(self):
+        """
+        IP addresses aren't looked up.
+        """
+        self.assertEqual(
+            ["::1"], self.successResultOf(_tls.resolveAddresses(u"::1", 443))
+        )
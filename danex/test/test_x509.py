@@ -5,10 +5,12 @@ from __future__ import absolute_import, division, print_function
 
 import hashlib
 
+from cryptography.hazmat.primitives import serialization
 from OpenSSL import crypto
 from twisted.trial.unittest import SynchronousTestCase
 
 from danex._x509 import extractPublicKey
+from danex.testing import makeCertificate, makeKey
 
 
 class TestX509(SynchronousTestCase):
@@ -30,6 +32,30 @@ class TestX509(SynchronousTestCase):
         )
 
 
+    def assertExtractsKey(self, key):
+        self.assertEqual(
+            key.public_key().public_bytes(
+                serialization.Encoding.DER,
+                serialization.PublicFormat.SubjectPublicKeyInfo,
+            ),
+            extractPublicKey(makeCertificate(u"example.com", key))
+        )
+
+
+    def test_extractEC(self):
+        """
+        extractPublicKey works with EC keys.
+        """
+        self.assertExtractsKey(makeKey("ec"))
+
+
+    def test_extractEd25519(self):
+        """
+        extractPublicKey works with Ed25519 keys.
+        """
+        self.assertExtractsKey(makeKey("ed25519"))
+
+
 CERT_SHA256 = (
     "9d73567ec8e8a7ee26f38defd52b02d8dbfd87b13da6485600e765ad1598b5ee"
 )
@@ -0,0 +1,372 @@
+# -*- test-case-name: danex.test.test_testing -*-
+# Copyright (c) Hynek Schlawack, Richard Wall
+# See LICENSE for details.
+
+"""
+Offline stand-ins for DNS and TLS servers for tests and load tests.
+
+A L{ScriptedGetdns} answers TLSA queries from records that have been added
+to it, with configurable latency, TTLs, DNSSEC status and errors.  It can be
+passed as the C{getdns} argument of L{danex._dane.lookup_tlsa_records} or be
+put behind L{ScriptedResolver} to serve the asynchronous TLSA lookups of
+the CLI and dane_doctor; MX lookups aren't scripted.  A L{TLSFarm} runs TLS
+servers on the loopback interface and publishes TLSA records for them.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import datetime
+import hashlib
+import itertools
+import time
+
+import getdns
+
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import ec, ed25519, rsa
+from cryptography.x509.oid import NameOID
+from OpenSSL import crypto
+from twisted.internet import defer, task
+from twisted.internet.endpoints import SSL4ServerEndpoint
+from twisted.internet.protocol import Factory, Protocol
+from twisted.internet.ssl import CertificateOptions
+
+from ._dane import tlsaDomainName, tlsaFromResults
+
+
+def makeKey(keyType="rsa"):
+    """
+    Create a private key.
+
+    @param keyType: C{"rsa"} for RSA-2048, C{"ec"} for P-256 or
+        C{"ed25519"} for Ed25519.
+    """
+    if keyType == "ec":
+        return ec.generate_private_key(ec.SECP256R1())
+    if keyType == "ed25519":
+        return ed25519.Ed25519PrivateKey.generate()
+    return rsa.generate_private_key(public_exponent=65537, key_size=2048)
+
+
+def makeCertificate(commonName, key, issuer=None):
+    """
+    Create a certificate for I{key} that is valid for a day.
+
+    @param issuer: The C{(key, certificate)} of the issuer.  Self-signed if
+        C{None}.
+
+    @rtype: L{crypto.X509}
+    """
+    subject = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, commonName)])
+    if issuer is None:
+        issuerKey, issuerName = key, subject
+    else:
+        issuerKey, issuerName = issuer[0], issuer[1].to_cryptography().subject
+    now = datetime.datetime.now(datetime.timezone.utc)
+    cert = x509.CertificateBuilder(
+        subject_name=subject,
+        issuer_name=issuerName,
+        public_key=key.public_key(),
+        serial_number=x509.random_serial_number(),
+        not_valid_before=now - datetime.timedelta(minutes=5),
+        not_valid_after=now + datetime.timedelta(days=1),
+    ).sign(
+        issuerKey,
+        None if isinstance(issuerKey, ed25519.Ed25519PrivateKey)
+        else hashes.SHA256()
+    )
+    return crypto.X509.from_cryptography(cert)
+
+
+def makeChain(commonName=u"localhost", keyType="rsa", ca=None):
+    """
+    Create a server certificate and the CA that issued it.
+
+    @param ca: The C{(key, certificate)} of the CA.  A new one is created if
+        C{None}.
+
+    @return: The server's private key and its chain, its own certificate
+        first.
+    @rtype: L{tuple}
+    """
+    if ca is None:
+        caKey = makeKey(keyType)
+        ca = caKey, makeCertificate(u"danex test CA", caKey)
+    key = makeKey(keyType)
+    cert = makeCertificate(commonName, key, issuer=ca)
+    return key, [cert, ca[1]]
+
+
+def associationData(cert, selector=1, matchingType=1):
+    """
+    Return the certificate association data of a TLSA record for I{cert}.
+
+    @type cert: L{crypto.X509}
+    @param selector: The selector as an integer.
+    @param matchingType: The matching type as an integer.
+
+    @rtype: L{bytes}
+    """
+    if selector == 1:
+        data = crypto.dump_publickey(crypto.FILETYPE_ASN1, cert.get_pubkey())
+    else:
+        data = crypto.dump_certificate(crypto.FILETYPE_ASN1, cert)
+    if matchingType == 1:
+        return hashlib.sha256(data).digest()
+    elif matchingType == 2:
+        return hashlib.sha512(data).digest()
+    return data
+
+
+
+class ScriptedGetdns(object):
+    """
+    A getdns API double whose C{general} answers TLSA queries from a table.
+
+    Names that haven't been added are answered with
+    C{GETDNS_RESPSTATUS_NO_NAME}.
+
+    @ivar latency: Default seconds each answer takes.  Either a number or a
+        callable without arguments that returns one -- e.g. to add jitter.
+    @ivar negativeTTL: TTL of the SOA record in answers for names that
+        haven't been added.  C{None} for no SOA record.
+    @ivar queries: Number of answered queries by name.
+    @type queries: L{dict}
+    """
+    def __init__(self, latency=0, negativeTTL=300, sleep=time.sleep):
+        """
+        @param sleep: Called with the latency of each answer by C{general}.
+        """
+        for k, v in getdns.__dict__.items():
+            if k.startswith("GETDNS_"):
+                setattr(self, k, v)
+        self.latency = latency
+        self.negativeTTL = negativeTTL
+        self.queries = {}
+        self._sleep = sleep
+        self._answers = {}
+
+
+    def addRecords(self, name, records, ttl=3600,
+                   dnssecStatus=getdns.GETDNS_DNSSEC_SECURE, latency=None):
+        """
+        Answer queries for I{name} with TLSA records.
+
+        @param records: C{(usage, selector, matchingType, data)} tuples.
+        @param ttl: The TTL of the records.
+        @param dnssecStatus: A C{GETDNS_DNSSEC_*} constant.
+        @param latency: Overrides the default latency for I{name}.
+        """
+        self._answers[name] = (latency, {
+            "status": getdns.GETDNS_RESPSTATUS_GOOD,
+            "replies_tree": [{
+                "dnssec_status": dnssecStatus,
+                "answer": [{
+                    "name": name,
+                    "type": getdns.GETDNS_RRTYPE_TLSA,
+                    "class": 1,
+                    "ttl": ttl,
+                    "rdata": {
+                        "certificate_usage": usage,
+                        "selector": selector,
+                        "matching_type": matchingType,
+                        "certificate_association_data": data,
+                    },
+                } for usage, selector, matchingType, data in records],
+                "authority": [],
+            }],
+        })
+
+
+    def addError(self, name, status, negativeTTL=None, latency=None):
+        """
+        Answer queries for I{name} with an error status.
+
+        @param status: A C{GETDNS_RESPSTATUS_*} constant.
+        @param negativeTTL: For how long the error may be cached, C{None} if
+            it mustn't.
+        @param latency: Overrides the default latency for I{name}.
+        """
+        self._answers[name] = latency, self._error(status, negativeTTL)
+
+
+    def _error(self, status, negativeTTL):
+        authority = []
+        if negativeTTL is not None:
+            authority.append({
+                "type": getdns.GETDNS_RRTYPE_SOA,
+                "class": 1,
+                "ttl": negativeTTL,
+                "rdata": {"minimum": negativeTTL},
+            })
+        return {
+            "status": status,
+            "replies_tree": [{"answer": [], "authority": authority}],
+        }
+
+
+    def remove(self, name):
+        """
+        Forget what has been added for I{name}.
+        """
+        self._answers.pop(name, None)
+
+
+    def respond(self, name):
+        """
+        Return the response for I{name} without waiting.
+
+        @return: The getdns response dict and the seconds it should take.
+        @rtype: L{tuple}
+        """
+        self.queries[name] = self.queries.get(name, 0) + 1
+        try:
+            latency, results = self._answers[name]
+        except KeyError:
+            latency, results = None, self._error(
+                getdns.GETDNS_RESPSTATUS_NO_NAME, self.negativeTTL
+            )
+        if latency is None:
+            latency = self.latency
+        if callable(latency):
+            latency = latency()
+        return results, latency
+
+
+    def context_create(self):
+        return object()
+
+
+    def general(self, context, name, request_type, extensions):
+        results, latency = self.respond(name)
+        if latency:
+            self._sleep(latency)
+        return results
+
+
+
+class ScriptedResolver(object):
+    """
+    Answers asynchronous TLSA lookups from a L{ScriptedGetdns}, like
+    L{danex._resolver.TLSAResolver} does from the network.  It has no
+    C{lookupMX}, so mail domains can't be checked against it.
+
+    The latency of the answers is waited for using the reactor, so no thread
+    is blocked.
+    """
+    def __init__(self, getdns, reactor):
+        self.getdns = getdns
+        self._reactor = reactor
+
+
+    def lookupTLSA(self, name):
+        """
+        Look up the TLSA records at I{name}.
+
+        @rtype: L{defer.Deferred} that fires like
+            L{danex._resolver.TLSAResolver.lookupTLSA}.
+        """
+        results, latency = self.getdns.respond(name)
+        return task.deferLater(
+            self._reactor, latency, tlsaFromResults, results, self.getdns
+        )
+
+
+
+class _Silent(Protocol):
+    pass
+
+
+
+class TLSFarm(object):
+    """
+    TLS servers on the loopback interface, each with its own certificate
+    issued by a CA that all of them share.
+
+    The servers only complete the handshake and never send any data.
+
+    @ivar servers: C{(port, chain)} tuples of the running servers.
+    """
+    def __init__(self, reactor, size=10, keyType="rsa",
+                 interface="127.0.0.1"):
+        """
+        @param size: Number of servers.
+        @param keyType: C{"rsa"} or C{"ec"}.
+        @param interface: The IPv4 address to listen on.
+        """
+        self.size = size
+        self.keyType = keyType
+        self.interface = interface
+        self.servers = []
+        self._reactor = reactor
+        self._ports = []
+
+
+    @defer.inlineCallbacks
+    def start(self):
+        """
+        Generate the certificates and start listening.
+
+        @rtype: L{defer.Deferred} that fires with C{None} once all servers
+            are listening.
+        """
+        caKey = makeKey(self.keyType)
+        ca = caKey, makeCertificate(u"danex test CA", caKey)
+        factory = Factory.forProtocol(_Silent)
+        for _ in range(self.size):
+            key, chain = makeChain(keyType=self.keyType, ca=ca)
+            options = CertificateOptions(
+                privateKey=crypto.PKey.from_cryptography_key(key),
+                certificate=chain[0],
+                extraCertChain=chain[1:],
+            )
+            port = yield SSL4ServerEndpoint(
+                self._reactor, 0, options, interface=self.interface
+            ).listen(factory)
+            self._ports.append(port)
+            self.servers.append((port.getHost().port, chain))
+
+
+    def stop(self):
+        """
+        Stop all servers.
+
+        @rtype: L{defer.Deferred}
+        """
+        ports, self._ports, self.servers = self._ports, [], []
+        return defer.gatherResults([
+            defer.maybeDeferred(port.stopListening) for port in ports
+        ])
+
+
+    def publish(self, getdns, usage=3, selector=1, matchingType=1, **kw):
+        """
+        Add matching TLSA records for all servers to I{getdns}.
+
+        Records with a trust anchor usage refer to the CA, others to the
+        server's own certificate.
+
+        @type getdns: L{ScriptedGetdns}
+        @param kw: Passed to L{ScriptedGetdns.addRecords}.
+        """
+        for port, chain in self.servers:
+            cert = chain[1] if usage in (0, 2) else chain[0]
+            getdns.addRecords(
+                tlsaDomainName(self.interface, port, "tcp"),
+                [(usage, selector, matchingType,
+                  associationData(cert, selector, matchingType))],
+                **kw
+            )
+
+
+    def targets(self, count):
+        """
+        Return I{count} C{(host, port, proto)} targets, cycling through the
+        servers.
+        """
+        return [
+            (self.interface, port, "tcp")
+            for (port, _), _ in zip(itertools.cycle(self.servers),
+                                    range(count))
+        ]
@@ -18,8 +18,13 @@ setup(
     install_requires=[
         'getdns',
         'idna',
-        'pyopenssl',
+        'pyopenssl>=16.0',
         'twisted',
         "txsockjs",
+        "pyyaml",
     ],
+    extras_require={
+        "msgpack": ["msgpack"],
+        "brotli": ["brotli"],
+    },
 )